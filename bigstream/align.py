@@ -1,10 +1,12 @@
 import sys
+import time
 import numpy as np
 import SimpleITK as sitk
 import bigstream.utility as ut
 from bigstream.configure_irm import configure_irm
 from bigstream.transform import apply_transform, compose_transform_list
 from bigstream.metrics import patch_mutual_information
+from bigstream.numpy_align import numpy_affine_align
 from bigstream import features
 import cv2
 
@@ -740,6 +742,9 @@ def affine_align(
     mov_origin=None,
     static_transform_list=[],
     default=None,
+    telemetry=None,
+    engine='itk',
+    pyramid=None,
     **kwargs,
 ):
     """
@@ -808,6 +813,33 @@ def affine_align(
     default : 4x4 array (default: identity matrix)
         If the optimization fails, print error message but return this value
 
+    telemetry : dict (default: None)
+        If given, this dict is filled with a record of the optimization:
+        'initial_metric', 'final_metric', 'iterations', 'stop_condition',
+        'fallback' (True if the default was returned), and 'error' (the
+        exception message if ITK raised one). With progress='trace' in kwargs
+        it also holds 'metric_curve' and the (level, iteration, metric)
+        tuples as 'trace'. 'stopped_early' lists the (level, iteration)
+        pairs at which the early stopping controller ended a level
+
+    engine : string (default: 'itk')
+        'itk' optimizes with SimpleITK as configured by `configure_irm`.
+        'numpy' optimizes with bigstream.numpy_align.numpy_affine_align:
+        analytic gradients in vectorized numpy and L-BFGS, much faster for
+        small images. It supports the 'MS' and 'C' metrics and affine static
+        transforms; from kwargs it uses metric, shrink_factors, smooth_sigmas,
+        and optimizer_args['numberOfIterations'] and ignores the rest. It runs
+        with the BLAS threads of the process budget, see
+        bigstream.utility.set_thread_budget. Unsupported configurations fall
+        back to 'itk'.
+
+    pyramid : bigstream.utility.PyramidCache (default: None)
+        If given, the levels described by shrink_factors and smooth_sigmas
+        are taken from (or added to) this cache and optimized one after
+        the other, each level initialized with the result of the previous
+        one, instead of letting ITK rebuild the pyramid internally. Then
+        telemetry also holds one record per level in 'levels'.
+
     **kwargs : any additional arguments
         Passed to `configure_irm`
         This is where you would set things like:
@@ -819,6 +851,41 @@ def affine_align(
         The affine or rigid transform matrix matching moving to fixed
     """
 
+    # optimize cached pyramid levels one at a time
+    if pyramid is not None:
+        shrink_factors = kwargs.pop('shrink_factors', (1,))
+        smooth_sigmas = kwargs.pop('smooth_sigmas', (0,))
+        if telemetry is None: telemetry = {}
+        telemetry['levels'] = []
+        for iii, (shrink_factor, smooth_sigma) in enumerate(zip(shrink_factors, smooth_sigmas)):
+            X = _pyramid_level(
+                pyramid, fix, mov, fix_mask, mov_mask,
+                fix_spacing, mov_spacing, alignment_spacing,
+                shrink_factor, smooth_sigma,
+            )
+            record = {}
+            initial_condition = affine_align(
+                *X[:4], rigid=rigid,
+                fix_mask=X[4], mov_mask=X[5],
+                initial_condition=initial_condition,
+                fix_origin=fix_origin, mov_origin=mov_origin,
+                static_transform_list=static_transform_list,
+                default=default if iii == 0 else None,
+                telemetry=record, engine=engine,
+                shrink_factors=(1,), smooth_sigmas=(0,),
+                **kwargs,
+            )
+            telemetry['levels'].append(record)
+
+        # summarize levels
+        levels = telemetry['levels']
+        telemetry['fallback'] = all(x.get('fallback', True) for x in levels)
+        telemetry['iterations'] = sum(x.get('iterations', 0) for x in levels)
+        for key in ['initial_metric', 'stop_condition', 'final_metric', 'error']:
+            values = [x[key] for x in levels if key in x]
+            if values: telemetry[key] = values[0 if key == 'initial_metric' else -1]
+        return initial_condition
+
     # determine the correct default
     if default is None: default = np.eye(fix.ndim + 1)
     initial_transform_given = isinstance(initial_condition, np.ndarray)
@@ -832,13 +899,28 @@ def affine_align(
     static_transform_spacing = a
     static_transform_origin = b
 
-    # skip sample and convert inputs to sitk images
+    # skip sample
     X = apply_alignment_spacing(
         fix, mov,
         fix_mask, mov_mask,
         fix_spacing, mov_spacing,
         alignment_spacing,
     )
+
+    # numpy engine supports only some metrics and affine static transforms
+    if telemetry is None: telemetry = {}
+    if engine == 'numpy':
+        metric = kwargs.get('metric', 'MMI')
+        affine_statics = all(x.shape == (fix.ndim+1,)*2 for x in static_transform_list)
+        if metric in ('MS', 'C') and affine_statics:
+            return _numpy_affine_align(
+                X, rigid, initial_condition, fix_origin, mov_origin,
+                static_transform_list, default, telemetry, **kwargs,
+            )
+        print(f"numpy engine does not support metric {metric} or static deformations,",
+              "using itk", flush=True)
+
+    # convert inputs to sitk images
     fix, mov, fix_mask, mov_mask = images_to_sitk(
         *X, fix_origin, mov_origin,
     )
@@ -886,11 +968,21 @@ def affine_align(
     if mov_mask is not None: irm.SetMetricMovingMask(mov_mask)
 
     # execute alignment, for any exceptions return default
+    telemetry['fallback'] = True
     try:
         initial_metric_value = irm.MetricEvaluate(fix, mov)
+        telemetry['initial_metric'] = initial_metric_value
         irm.Execute(fix, mov)
         final_metric_value = irm.MetricEvaluate(fix, mov)
+        telemetry['final_metric'] = final_metric_value
+        telemetry['iterations'] = irm.GetOptimizerIteration()
+        telemetry['stop_condition'] = irm.GetOptimizerStopConditionDescription()
+        if irm.trace is not None:
+            telemetry['metric_curve'] = [x[2] for x in irm.trace]
+            telemetry['trace'] = irm.trace
+        telemetry['stopped_early'] = irm.stopped_early
     except Exception as e:
+        telemetry['error'] = str(e)
         print("Registration failed due to ITK exception:\n", e)
         print("Returning default", flush=True)
         return default
@@ -898,6 +990,7 @@ def affine_align(
     # if registration improved metric return result
     # otherwise return default
     if final_metric_value < initial_metric_value:
+        telemetry['fallback'] = False
         print("Registration succeeded", flush=True)
         return ut.affine_transform_to_matrix(transform)
     else:
@@ -907,6 +1000,81 @@ def affine_align(
         return default
 
 
+def _pyramid_level(
+    pyramid, fix, mov, fix_mask, mov_mask,
+    fix_spacing, mov_spacing, alignment_spacing,
+    shrink_factor, smooth_sigma,
+):
+    """
+    Images and spacings of one pyramid level: fix, mov, fix_spacing,
+    mov_spacing, fix_mask, mov_mask. As in the ITK pyramid only the fixed
+    image (the sampling grid) is decimated, the moving image is smoothed
+    but interpolated at full resolution. Masks are only skip sampled.
+    """
+
+    fix_level, fix_level_spacing = pyramid.level(
+        fix, fix_spacing, alignment_spacing, shrink_factor, smooth_sigma,
+    )
+    mov_level, mov_level_spacing = pyramid.level(
+        mov, mov_spacing, alignment_spacing, 1, smooth_sigma,
+    )
+    if fix_mask is not None:
+        spacing = ut.relative_spacing(fix_mask, fix, fix_spacing)
+        fix_mask = pyramid.level(fix_mask, spacing, alignment_spacing)[0]
+    if mov_mask is not None:
+        spacing = ut.relative_spacing(mov_mask, mov, mov_spacing)
+        mov_mask = pyramid.level(mov_mask, spacing, alignment_spacing)[0]
+    return (fix_level, mov_level, fix_level_spacing, mov_level_spacing,
+            fix_mask, mov_mask)
+
+
+def _numpy_affine_align(
+    X, rigid, initial_condition, fix_origin, mov_origin,
+    static_transform_list, default, telemetry, **kwargs,
+):
+    """
+    affine_align with the numpy engine on already skip sampled images
+    """
+
+    # apply the process budget
+    ut.set_thread_budget()
+
+    # execute alignment, for any exceptions return default
+    telemetry['fallback'] = True
+    try:
+        transform, record = numpy_affine_align(
+            X[0], X[1], X[4], X[5],
+            rigid=rigid,
+            initial_condition=initial_condition,
+            fix_mask=X[2], mov_mask=X[3],
+            fix_mask_spacing=X[6], mov_mask_spacing=X[7],
+            fix_origin=fix_origin, mov_origin=mov_origin,
+            static_transform_list=static_transform_list,
+            metric=kwargs['metric'],
+            shrink_factors=kwargs.get('shrink_factors', (1,)),
+            smooth_sigmas=kwargs.get('smooth_sigmas', (0,)),
+            iterations=kwargs.get('optimizer_args', {}).get('numberOfIterations', 100),
+        )
+        telemetry.update(record)
+    except Exception as e:
+        telemetry['error'] = str(e)
+        print("Registration failed due to exception:\n", e)
+        print("Returning default", flush=True)
+        return default
+
+    # if registration improved metric return result
+    # otherwise return default
+    if telemetry['final_metric'] < telemetry['initial_metric']:
+        telemetry['fallback'] = False
+        print("Registration succeeded", flush=True)
+        return transform
+    else:
+        print("Optimization failed to improve metric")
+        print(f"METRIC VALUES initial: {telemetry['initial_metric']} final: {telemetry['final_metric']}")
+        print("Returning default", flush=True)
+        return default
+
+
 def deformable_align(
     fix,
     mov,
@@ -921,6 +1089,8 @@ def deformable_align(
     mov_origin=None,
     static_transform_list=[],
     default=None,
+    telemetry=None,
+    pyramid=None,
     **kwargs,
 ):
     """
@@ -994,6 +1164,21 @@ def deformable_align(
         the parameters and displacement field for an identity
         transform are returned.
 
+    telemetry : dict (default: None)
+        If given, this dict is filled with a record of the optimization:
+        'initial_metric', 'final_metric', 'iterations', 'stop_condition',
+        'fallback' (True if the default was returned), and 'error' (the
+        exception message if ITK raised one). With progress='trace' in kwargs
+        it also holds 'metric_curve' and the (level, iteration, metric)
+        tuples as 'trace'. 'stopped_early' lists the (level, iteration)
+        pairs at which the early stopping controller ended a level
+
+    pyramid : bigstream.utility.PyramidCache (default: None)
+        If given and shrink_factors has a single level, that level is
+        taken from (or added to) this cache instead of being rebuilt by
+        ITK. Multi level alignments still use the ITK pyramid, which also
+        refines the control point grid between levels.
+
     **kwargs : any additional arguments
         Passed to `configure_irm`
         This is where you would set things like:
@@ -1021,6 +1206,18 @@ def deformable_align(
     static_transform_spacing = a
     static_transform_origin = b
 
+    # take a single level pyramid from the cache
+    shrink_factors = kwargs.get('shrink_factors', (1,))
+    if pyramid is not None and len(shrink_factors) == 1:
+        smooth_sigma = kwargs.get('smooth_sigmas', (0,))[0]
+        fix, mov, fix_spacing, mov_spacing, fix_mask, mov_mask = _pyramid_level(
+            pyramid, fix, mov, fix_mask, mov_mask,
+            fix_spacing, mov_spacing, alignment_spacing,
+            shrink_factors[0], smooth_sigma,
+        )
+        alignment_spacing = None
+        kwargs = {**kwargs, 'shrink_factors':(1,), 'smooth_sigmas':(0,)}
+
     # skip sample and convert inputs to sitk images
     X = apply_alignment_spacing(
         fix, mov,
@@ -1072,11 +1269,22 @@ def deformable_align(
         default = (params, field)
 
     # execute alignment, for any exceptions return default
+    if telemetry is None: telemetry = {}
+    telemetry['fallback'] = True
     try:
         initial_metric_value = irm.MetricEvaluate(fix, mov)
+        telemetry['initial_metric'] = initial_metric_value
         irm.Execute(fix, mov)
         final_metric_value = irm.MetricEvaluate(fix, mov)
+        telemetry['final_metric'] = final_metric_value
+        telemetry['iterations'] = irm.GetOptimizerIteration()
+        telemetry['stop_condition'] = irm.GetOptimizerStopConditionDescription()
+        if irm.trace is not None:
+            telemetry['metric_curve'] = [x[2] for x in irm.trace]
+            telemetry['trace'] = irm.trace
+        telemetry['stopped_early'] = irm.stopped_early
     except Exception as e:
+        telemetry['error'] = str(e)
         print("Registration failed due to ITK exception:\n", e)
         print("Returning default", flush=True)
         return default
@@ -1084,6 +1292,7 @@ def deformable_align(
     # if registration improved metric return result
     # otherwise return default
     if final_metric_value < initial_metric_value:
+        telemetry['fallback'] = False
         params = np.concatenate((transform.GetFixedParameters(), transform.GetParameters()))
         field = ut.bspline_to_displacement_field(
             transform, initial_fix_shape,
@@ -1111,6 +1320,8 @@ def alignment_pipeline(
     mov_origin=None,
     static_transform_list=[],
     return_format='flatten',
+    telemetry=None,
+    share_pyramid=False,
     **kwargs,
 ):
     """
@@ -1178,6 +1389,22 @@ def alignment_pipeline(
                        ['random', 'affine', 'deform', 'deform', 'affine', 'deform']
                        will return a list of 4 transforms.
         'flatten' : compose all transforms regardless of type into a single transform
+        'compact' : one transform per step, deforms are given as b-spline parameters
+                    (see bigstream.utility.bspline_parameters_to_transform) instead
+                    of displacement fields. These are much smaller and can be rendered
+                    on any grid later.
+
+    telemetry : list (default: None)
+        If given, one dict per step is appended to this list with the step
+        name, its run time in seconds, and for 'rigid', 'affine', and 'deform'
+        steps the optimization record described in `affine_align`
+
+    share_pyramid : bool (default: False)
+        If True the 'rigid', 'affine', and 'deform' steps share one
+        bigstream.utility.PyramidCache, so each smoothed and downsampled
+        level of fix and mov is computed once for the whole pipeline
+        instead of by ITK in every step. See the `pyramid` argument of
+        `affine_align` and `deformable_align`.
 
     **kwargs : any additional keyword arguments
         Global arguments that apply to all alignment steps
@@ -1208,15 +1435,33 @@ def alignment_pipeline(
              'affine':lambda **c: affine_align(*a, **{**b, **c}),
              'deform':lambda **c: deformable_align(*a, **{**b, **c})[1],}
 
+    # compact format keeps b-spline parameters, prefixed with the dimension
+    if return_format == 'compact':
+        align['deform'] = lambda **c: np.concatenate(
+            ([fix.ndim], deformable_align(*a, **{**b, **c})[0])
+        )
+
+    # one pyramid for all steps
+    if share_pyramid:
+        kwargs = {'pyramid':ut.PyramidCache(), **kwargs}
+
     # loop over steps
     new_transforms = []
     for alignment, arguments in steps:
         arguments = {**kwargs, **arguments}
+        if alignment not in ['rigid', 'affine', 'deform']:
+            arguments.pop('pyramid', None)
         arguments['static_transform_list'] = static_transform_list + new_transforms
+        record = {'step': alignment}
+        if alignment in ['rigid', 'affine', 'deform']:
+            arguments['telemetry'] = record
+        start_time = time.time()
         new_transforms.append(align[alignment](**arguments))
+        record['seconds'] = time.time() - start_time
+        if telemetry is not None: telemetry.append(record)
 
     # return in the requested format
-    if return_format == 'independent':
+    if return_format in ['independent', 'compact']:
         return new_transforms
     elif return_format == 'compressed':
         shapes = np.array([x.shape for x in new_transforms], dtype=object)
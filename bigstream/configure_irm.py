@@ -1,8 +1,13 @@
-import os
+import threading
+from collections import deque
 import SimpleITK as sitk
 import bigstream.utility as ut
 
 
+# configured irm objects for reuse, one pool per thread
+_irm_pool = threading.local()
+
+
 # interpolator switch
 interpolator_switch = {
     '0':sitk.sitkNearestNeighbor,
@@ -30,6 +35,11 @@ def configure_irm(
     sampling_percentage=None,
     exhaustive_step_sizes=None,
     callback=None,
+    progress=None,
+    early_stopping_window=None,
+    early_stopping_tolerance=1e-4,
+    threads=None,
+    reuse=False,
 ):
     """
     Wrapper exposing the itk::simple::ImageRegistrationMethod API
@@ -121,8 +131,43 @@ def configure_irm(
     callback : callable object, e.g. function (default: None)
         A function run at every iteration of optimization
         Should take only the ImageRegistrationMethod object as input: `irm`
-        If None then the Level, Iteration, and Metric values are
-        printed at each iteration
+        If given then `progress` is ignored
+
+    progress : None, 'print', int, or 'trace' (default: None)
+        How optimization progress is reported when no `callback` is given.
+        Every Python callback costs a round trip through the GIL, so by
+        default nothing is installed and the optimizer runs uninterrupted.
+        Options:
+            None:       No per iteration callback
+            'print':    Level, Iteration, and Metric are printed every iteration
+            int N:      Level, Iteration, and Metric are printed every N iterations
+            'trace':    (level, iteration, metric) tuples are appended to the
+                        list `irm.trace`, nothing is printed
+
+    early_stopping_window : int (default: None)
+        If given, the metric values of the last `early_stopping_window`
+        iterations are watched and optimization of the current level is
+        stopped with `irm.StopRegistration` once the relative improvement
+        over that window falls below `early_stopping_tolerance`. The window
+        restarts at each level. The (level, iteration) pairs at which
+        levels were stopped are recorded in the list `irm.stopped_early`
+
+    early_stopping_tolerance : float (default: 1e-4)
+        Relative metric improvement over the window below which a level
+        is considered converged
+
+    threads : int (default: None)
+        Number of threads used by this registration object. By default the budget from
+        bigstream.utility.get_thread_budget: available cores split over the
+        task threads of the dask worker, if running in one
+
+    reuse : bool (default: False)
+        If True, the configured object is kept in a per thread pool keyed
+        by all of the above arguments. Later calls with the same arguments
+        get the pooled object back with its masks and moving initial
+        transform cleared, instead of building a new one. Callers must set
+        the initial transform (and masks, if any) before every use. Ignored
+        if a `callback` is given.
 
     Returns
     -------
@@ -131,13 +176,26 @@ def configure_irm(
         images and a transform type to be ready for optimization.
     """
 
-    # identify number of physical cores available
-    ncores = ut.get_number_of_cores()
+    # apply the process budget, this irm may use a different number of threads
+    ut.set_thread_budget()
+    threads = ut.get_thread_budget(threads)
+
+    # return pooled irm if one with this configuration exists
+    key = None
+    if reuse and callback is None:
+        key = repr((
+            metric, optimizer, sampling, interpolator,
+            tuple(shrink_factors), tuple(smooth_sigmas),
+            sorted(metric_args.items()), sorted(optimizer_args.items()),
+            sampling_percentage, exhaustive_step_sizes, progress,
+            early_stopping_window, early_stopping_tolerance, threads,
+        ))
+        pool = _irm_pool.__dict__.setdefault('irms', {})
+        if key in pool: return _reset_irm(pool[key])
 
     # initialize IRM object, be completely sure nthreads is set
-    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(2*ncores)
     irm = sitk.ImageRegistrationMethod()
-    irm.SetNumberOfThreads(2*ncores)
+    irm.SetNumberOfThreads(threads)
 
     # set interpolator
     irm.SetInterpolator(interpolator_switch[interpolator])
@@ -186,15 +244,79 @@ def configure_irm(
     irm.SetSmoothingSigmasPerLevel(smooth_sigmas)
     irm.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
 
+    # fresh records for every execution, the irm may be reused
+    def reset_records():
+        irm.trace = [] if progress == 'trace' else None
+        irm.stopped_early = []
+    reset_records()
+    irm.AddCommand(sitk.sitkStartEvent, reset_records)
+
     # set callback function
-    if callback is None:
+    if callback is None and progress == 'trace':
         def callback(irm):
             level = irm.GetCurrentLevel()
             iteration = irm.GetOptimizerIteration()
             metric = irm.GetMetricValue()
+            irm.trace.append((level, iteration, metric))
+    elif callback is None and progress is not None:
+        every = 1 if progress == 'print' else int(progress)
+        def callback(irm):
+            iteration = irm.GetOptimizerIteration()
+            if iteration % every: return
+            level = irm.GetCurrentLevel()
+            metric = irm.GetMetricValue()
             print("LEVEL: ", level, " ITERATION: ", iteration, " METRIC: ", metric, flush=True)
-    irm.AddCommand(sitk.sitkIterationEvent, lambda: callback(irm))
+    if callback is not None:
+        irm.AddCommand(sitk.sitkIterationEvent, lambda: callback(irm))
+
+    # stop each level once the metric plateaus
+    if early_stopping_window:
+        controller = _early_stopping_controller(
+            irm, early_stopping_window, early_stopping_tolerance,
+        )
+        irm.AddCommand(sitk.sitkIterationEvent, controller)
+
+    # keep in pool if reusable
+    if key is not None:
+        if len(pool) >= 16: pool.clear()
+        pool[key] = irm
 
     # return configured irm
     return irm
 
+
+def _reset_irm(irm):
+    """
+    Clear the masks and moving initial transform of a pooled
+    ImageRegistrationMethod so it can be used for a new alignment
+    """
+
+    irm.SetMetricFixedMask(sitk.Image())
+    irm.SetMetricMovingMask(sitk.Image())
+    ndim = irm.GetMovingInitialTransform().GetDimension()
+    irm.SetMovingInitialTransform(sitk.Transform(ndim, sitk.sitkIdentity))
+    return irm
+
+
+def _early_stopping_controller(irm, window, tolerance):
+    """
+    Build an iteration command that stops the current level of an
+    ImageRegistrationMethod when its metric stops improving
+    """
+
+    history = deque(maxlen=window+1)
+    last = [None, None]
+    def controller():
+        level = irm.GetCurrentLevel()
+        iteration = irm.GetOptimizerIteration()
+        if level != last[0] or last[1] is None or iteration <= last[1]:
+            history.clear()
+        last[:] = level, iteration
+        history.append(irm.GetMetricValue())
+        if len(history) <= window: return
+        improvement = (history[0] - history[-1]) / max(abs(history[0]), 1e-12)
+        if improvement < tolerance:
+            irm.stopped_early.append((level, iteration))
+            irm.StopRegistration()
+            history.clear()
+    return controller
@@ -1,9 +1,11 @@
 import numpy as np
-import os, tempfile
+from itertools import product
 import SimpleITK as sitk
 from bigstream.configure_irm import configure_irm
 import bigstream.utility as ut
-from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import maximum_filter, uniform_filter
 from ClusterWrap.decorator import cluster
 
 
@@ -17,6 +19,9 @@ def patch_mutual_information(
     fix_mask=None,
     mov_mask=None,
     return_metric_image=False,
+    engine='itk',
+    bins=32,
+    threads=None,
     **kwargs,
 ):
     """
@@ -44,9 +49,23 @@ def patch_mutual_information(
         mask over moving data (only data in foreground is considered)
     return_metric_image : bool (default: False)
         Return an image with local MIs
+    engine : string (default: 'itk')
+        'itk' evaluates the irm metric on every patch, one at a time.
+        'numpy' bins both images once and computes joint histograms for
+        batches of patches at a time with np.bincount, in parallel threads.
+        Both return negative MI (lower is better) but the estimators
+        differ, so values are only comparable within one engine. The
+        'numpy' engine takes no irm arguments; if any are given in kwargs
+        the 'itk' engine is used instead.
+    bins : int (default: 32)
+        Number of intensity bins per image for the 'numpy' engine
+    threads : int (default: None)
+        Number of threads for the 'numpy' engine. If None, the thread
+        budget from bigstream.utility.get_thread_budget.
     **kwargs : any additional arguments
-        Passed to bigstream.configure_irm.configure_irm
-        Use these arguments to parameterize the metric
+        Passed to bigstream.configure_irm.configure_irm for the 'itk' engine
+        Use these arguments to parameterize the metric. Giving any of these
+        selects the 'itk' engine.
 
     Returns
     -------
@@ -57,44 +76,39 @@ def patch_mutual_information(
         The local MIs rendered in an image
     """
 
-    # create sitk versions of data
-    fix_sitk = ut.numpy_to_sitk(fix.transpose(2, 1, 0), spacing[::-1])
-    fix_sitk = sitk.Cast(fix_sitk, sitk.sitkFloat32)
-    mov_sitk = ut.numpy_to_sitk(mov.transpose(2, 1, 0), spacing[::-1])
-    mov_sitk = sitk.Cast(mov_sitk, sitk.sitkFloat32)
-
     # determine patch sample centers
-    samples = np.zeros_like(fix)
-    radius = np.round(radius / spacing).astype(np.uint16)
-    stride = np.round(stride / spacing).astype(np.uint16)
+    samples = np.zeros(fix.shape, dtype=bool)
+    radius = np.round(radius / spacing).astype(int)
+    stride = np.round(stride / spacing).astype(int)
     samples[tuple(slice(r, -r, s) for r, s in zip(radius, stride))] = 1
     if fix_mask is not None: samples = samples * fix_mask
     if mov_mask is not None: samples = samples * mov_mask
     samples = np.column_stack(np.nonzero(samples))
 
-    # create irm and containers for results
-    irm = configure_irm(**kwargs)
-    if return_metric_image:
-        metric_image = np.zeros(fix.shape, dtype=np.float32)
-    scores = []
+    # irm arguments only have meaning for the itk engine
+    if engine == 'numpy' and kwargs:
+        print(f"WARNING: irm arguments {sorted(kwargs)} are not supported by the "
+              "'numpy' engine, using the 'itk' engine", flush=True)
+        engine = 'itk'
+
+    # score all patches
+    if engine == 'numpy':
+        scores = _patch_mutual_information_numpy(
+            fix, mov, samples, radius, bins, threads,
+        )
+    elif engine == 'itk':
+        scores = _patch_mutual_information_itk(fix, mov, spacing, samples, radius, **kwargs)
+    else:
+        raise ValueError(f"engine must be 'numpy' or 'itk', got {engine}")
 
-    # score all blocks
-    for sample in samples:
-        # get patches
-        patch = tuple(slice(s-r, s+r+1) for s, r in zip(sample, radius))
-        f = fix_sitk[patch]
-        m = mov_sitk[patch]
-        # evaluate metric
-        try:
-            scores.append( irm.MetricEvaluate(f, m) )
-        except Exception as e:
-            scores.append( 0 )
-        # update metric image
-        if return_metric_image:
-            metric_image[patch] = scores[-1]
+    # render metric image, patches later in scan order overwrite earlier ones
+    if return_metric_image:
+        order = np.zeros(fix.shape, dtype=np.int64)
+        order[tuple(samples.T)] = np.arange(1, len(samples) + 1)
+        order = maximum_filter(order, size=tuple(2 * radius + 1), mode='constant')
+        metric_image = np.concatenate(([0], scores)).astype(np.float32)[order]
 
     # threshold scores
-    scores = np.array(scores)
     if percentile_cutoff > 0:
         cutoff = np.percentile(-scores, percentile_cutoff)
         scores = scores[-scores > cutoff]
@@ -106,6 +120,64 @@ def patch_mutual_information(
         return np.mean(scores)
 
 
+def _patch_mutual_information_itk(fix, mov, spacing, samples, radius, **kwargs):
+
+    # create sitk versions of data
+    fix_sitk = ut.numpy_to_sitk(fix.transpose(2, 1, 0), spacing[::-1])
+    fix_sitk = sitk.Cast(fix_sitk, sitk.sitkFloat32)
+    mov_sitk = ut.numpy_to_sitk(mov.transpose(2, 1, 0), spacing[::-1])
+    mov_sitk = sitk.Cast(mov_sitk, sitk.sitkFloat32)
+
+    # score all blocks
+    irm = configure_irm(**kwargs)
+    scores = []
+    for sample in samples:
+        patch = tuple(slice(s-r, s+r+1) for s, r in zip(sample, radius))
+        try:
+            scores.append( irm.MetricEvaluate(fix_sitk[patch], mov_sitk[patch]) )
+        except Exception as e:
+            scores.append( 0 )
+    return np.array(scores)
+
+
+def _patch_mutual_information_numpy(fix, mov, samples, radius, bins, threads, batch_size=1024):
+
+    # bin intensities once, joint bin codes for every voxel
+    codes = np.zeros(fix.shape, dtype=np.intp)
+    for image, scale in ((fix, bins), (mov, 1)):
+        mn, mx = np.min(image), np.max(image)
+        binned = np.zeros(image.shape, dtype=np.intp)
+        if mx > mn:
+            binned = ((image - mn) * (bins / (mx - mn))).astype(np.intp)
+            np.minimum(binned, bins - 1, out=binned)
+        codes += binned * scale
+    windows = sliding_window_view(codes, tuple(2 * radius + 1))
+    nbins = bins**2
+
+    # n log(n) for every possible bin count, MI from counts is then a lookup
+    size = int(np.prod(2 * radius + 1))
+    xlogx = np.arange(size + 1, dtype=np.float64)
+    xlogx[1:] *= np.log(xlogx[1:])
+
+    # joint histograms for a batch of patches with one bincount
+    def score_batch(batch):
+        patches = windows[tuple(batch.T - radius[:, None])].reshape(len(batch), -1)
+        patches = patches + np.arange(len(batch))[:, None] * nbins
+        joint = np.bincount(patches.ravel(), minlength=len(batch) * nbins)
+        joint = joint.reshape(len(batch), bins, bins)
+        mi = xlogx[joint].sum(axis=(1, 2))
+        mi -= xlogx[joint.sum(axis=2)].sum(axis=1)
+        mi -= xlogx[joint.sum(axis=1)].sum(axis=1)
+        return -(mi / size + np.log(size))
+
+    # run batches in parallel threads
+    if len(samples) == 0: return np.zeros(0)
+    threads = ut.get_thread_budget(threads)
+    batches = np.array_split(samples, int(np.ceil(len(samples) / batch_size)))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return np.concatenate(list(pool.map(score_batch, batches)))
+
+
 def local_correlation_coefficient(
     fix,
     mov,
@@ -113,6 +185,8 @@ def local_correlation_coefficient(
     radius,
     return_image=False,
     tolerance=1e-6,
+    dtype=np.float64,
+    intensity_ranges=None,
 ):
     """
     Compute correlation coefficient for neighborhoods around every voxel
@@ -146,6 +220,17 @@ def local_correlation_coefficient(
     tolerance : float (default: 1e-6)
         The lower bound on variance for CC to adequately be computed
 
+    dtype : numpy dtype (default: np.float64)
+        Precision of the intermediate images. Local means are always accumulated
+        in double precision; with np.float32 they are stored in single precision,
+        which halves memory at a small cost in accuracy. Images are centered on
+        their global mean first for stability.
+
+    intensity_ranges : tuple of two (min, max) tuples (default: None)
+        The intensity ranges of fix and mov that `tolerance` is relative to.
+        If None, the 0.1 and 99.9 percentiles of each image are used. Give
+        these when computing LCC piecewise so all pieces use the same ranges.
+
     Returns
     -------
     LCC : float
@@ -158,61 +243,223 @@ def local_correlation_coefficient(
     # convert radius to integer voxel units
     radius = np.round(radius / spacing).astype(int)
 
-    # get local means and variances, use high precision and zero center images for stability
-    fix_means = fix.astype(np.longdouble) - np.mean(fix)
-    mov_means = mov.astype(np.longdouble) - np.mean(mov)
-    fix_square = fix_means**2
-    mov_square = mov_means**2
-    fix_mov_product = fix_means * mov_means
-    fix_means = _local_means(fix_means, radius)
-    mov_means = _local_means(mov_means, radius)
-    fix_var = _local_means(fix_square, radius) - fix_means**2
-    mov_var = _local_means(mov_square, radius) - mov_means**2
-    fix_mov_cov = _local_means(fix_mov_product, radius) - fix_means*mov_means
+    # get local means and variances, zero center images for stability
+    fix_centered = fix.astype(dtype) - np.mean(fix, dtype=np.float64).astype(dtype)
+    mov_centered = mov.astype(dtype) - np.mean(mov, dtype=np.float64).astype(dtype)
+    fix_means = _local_means(fix_centered, radius, dtype)
+    mov_means = _local_means(mov_centered, radius, dtype)
+    fix_mov_cov = _local_means(fix_centered * mov_centered, radius, dtype)
+    fix_mov_cov -= fix_means * mov_means
+    fix_var = _local_means(fix_centered**2, radius, dtype)
+    fix_var -= fix_means**2
+    del fix_centered, fix_means
+    mov_var = _local_means(mov_centered**2, radius, dtype)
+    mov_var -= mov_means**2
+    del mov_centered, mov_means
 
     # compute LCCs
     with np.errstate(divide='ignore', invalid='ignore'):
         lcc = fix_mov_cov**2 / (fix_var * mov_var)
 
     # replace NaNs (occur when there is no data, or data values are constant)
-    mn, mx = np.percentile(fix, [0.1, 99.9])
-    fix_mask = fix_var / (mx - mn) < tolerance
-    mn, mx = np.percentile(mov, [0.1, 99.9])
-    mov_mask = mov_var / (mx - mn) < tolerance
+    if intensity_ranges is None:
+        intensity_ranges = [np.percentile(x, [0.1, 99.9]) for x in (fix, mov)]
+    (fix_mn, fix_mx), (mov_mn, mov_mx) = intensity_ranges
+    fix_mask = fix_var / (fix_mx - fix_mn) < tolerance
+    mov_mask = mov_var / (mov_mx - mov_mn) < tolerance
     lcc[fix_mask + mov_mask] = 0.
-    
+
     # return
     if return_image:
-        return lcc.mean(), lcc.astype(np.float32)
+        return lcc.mean(dtype=np.float64), lcc.astype(np.float32)
     else:
-        return lcc.mean()
+        return lcc.mean(dtype=np.float64)
 
 
-def _local_means(image, radius):
+def _local_means(image, radius, dtype=np.float64):
 
-    # create a high precision summed area table (normalized by neighborhood volume)
-    image = image.astype(np.longdouble) / np.prod(2 * np.array(radius) + 1)
-    sat = np.pad(image, tuple((r+1, r) for r in radius), mode='reflect')
-    for iii in range(image.ndim):
-        sat.cumsum(axis=iii, out=sat)
+    # box filter with reflected boundaries, accumulates in double precision
+    size = tuple(2 * np.array(radius) + 1)
+    return uniform_filter(image, size=size, mode='mirror', output=dtype)
 
-    # take appropriate differences to get local sums (actually means because already normalized)
-    binary_strings = ["".join(x) for x in product("01", repeat=image.ndim)]
-    means = np.copy(sat[_get_crop(binary_strings.pop(-1), radius)])
-    for binary_string in binary_strings:
-        sign = (-1)**(image.ndim - np.sum([int(x) for x in binary_string]))
-        crop = _get_crop(binary_string, radius)
-        means += sign * sat[crop]
-    return means
 
+@cluster
+def distributed_local_correlation_coefficient(
+    fix,
+    mov,
+    spacing,
+    radius,
+    blocksize,
+    write_path=None,
+    tolerance=1e-6,
+    dtype=np.float32,
+    threshold=None,
+    stats_path=None,
+    cluster=None,
+    cluster_kwargs={},
+    temporary_directory=None,
+):
+    """
+    Compute the local correlation coefficient image of two large images
+    blockwise on distributed hardware. Blocks are padded with a halo of
+    `radius` so the result matches `local_correlation_coefficient` on the
+    whole image. Summary statistics are computed for every block, use them
+    to flag misaligned regions.
+
+    Parameters
+    ----------
+    fix : ndarray or zarr array
+        One of the images, typically the fixed image
+
+    mov : ndarray or zarr array
+        The other image, typically the aligned moving image
+        fix and mov must be sampled on the exact same grid
+
+    spacing : 1d array
+        The voxel spacing of the input images in physical units
+
+    radius : float
+        The half width of the neighborhood around each voxel in physical units
+
+    blocksize : iterable
+        The shape of blocks in voxels, used as given; a blocksize that is a
+        multiple of the chunk shape of a zarr `fix` avoids partial chunk
+        reads. Output chunks are the same as the blocks.
+
+    write_path : string (default: None)
+        Location on disk to write the LCC image as a zarr array. If None
+        the LCC image is returned in memory.
+
+    tolerance : float (default: 1e-6)
+        The lower bound on variance for CC to adequately be computed
 
-def _get_crop(binary_string, radius):
+    dtype : numpy dtype (default: np.float32)
+        Precision of intermediate images in every block. See
+        `local_correlation_coefficient`.
 
-    crop = []
-    for bit, r in zip(binary_string, radius):
-        if bit == "0": crop.append( slice(None, -2*r - 1, None) )
-        else: crop.append( slice(2*r + 1, None, None) )
-    return tuple(crop)
+    threshold : float (default: None)
+        If given, blocks whose mean LCC is below this value are flagged
+
+    stats_path : string (default: None)
+        Path to write the block statistics. Json lines, or Parquet if the path
+        ends in '.parquet' (requires pandas).
+
+    cluster : ClusterWrap.cluster object (default: None)
+        Only set if you have constructed your own static cluster. The default behavior
+        is to construct a cluster for the duration of this function, then close it
+        when the function is finished.
+
+    cluster_kwargs : dict (default: {})
+        Arguments passed to ClusterWrap.cluster
+        If working with an LSF cluster, this will be
+        ClusterWrap.janelia_lsf_cluster. If on a workstation
+        this will be ClusterWrap.local_cluster.
+        This is how distribution parameters are specified.
+
+    temporary_directory : string (default: None)
+        Temporary files are created during computation. The temporary files will be
+        in their own folder within the `temporary_directory`. The default is the
+        current directory. Temporary files are removed if the function completes
+        successfully. zarr, N5, HDF5, and memory mapped inputs are read in place,
+        only inputs held in memory are written to temporary files.
+
+    Returns
+    -------
+    LCC_image : ndarray or zarr array
+        The local correlation coefficients, a zarr array if write_path is given
+
+    block_stats : list of dicts
+        One record per block: its index, voxel count, mean, minimum, 10th
+        percentile, and median LCC, the fraction of voxels with enough variance
+        to compute LCC, and whether it is flagged (if threshold is given)
+    """
+
+    # plan blocks and chunks, the halo is the neighborhood radius
+    radius_voxels = np.round(radius / np.array(spacing)).astype(int)
+    blocksize, _, zarr_blocks, _ = ut.plan_blocks(
+        fix.shape, blocksize, radius_voxels / np.array(blocksize),
+        fix.dtype.itemsize, chunks=getattr(fix, 'chunks', None),
+    )
+
+    # share images with workers, only in memory data is copied to disk
+    temporary_directory = ut.LazyTemporaryDirectory(temporary_directory)
+    fix_zarr = ut.shared_array(fix, zarr_blocks, temporary_directory.path('fix.zarr'))
+    mov_zarr = ut.shared_array(mov, zarr_blocks, temporary_directory.path('mov.zarr'))
+
+    # global intensity ranges from a skip sampled subset of about 1e7 voxels
+    factor = max(1, int(np.ceil((np.prod(fix.shape) / 1e7) ** (1 / fix.ndim))))
+    intensity_ranges = [
+        np.percentile(ut.SkipSampledArray(x, (factor,) * fix.ndim)[...], [0.1, 99.9])
+        for x in (fix_zarr, mov_zarr)
+    ]
+
+    # output
+    if write_path:
+        output = ut.create_zarr(write_path, fix.shape, tuple(blocksize), np.float32)
+    else:
+        output = np.zeros(fix.shape, dtype=np.float32)
+
+    # define blocks
+    nblocks = np.ceil(np.array(fix.shape) / blocksize).astype(int)
+    blocks = []
+    for block_index in np.ndindex(*nblocks):
+        start = np.array(block_index) * blocksize
+        stop = np.minimum(fix.shape, start + blocksize)
+        core = tuple(slice(int(x), int(y)) for x, y in zip(start, stop))
+        start = np.maximum(0, start - radius_voxels)
+        stop = np.minimum(fix.shape, stop + radius_voxels)
+        padded = tuple(slice(int(x), int(y)) for x, y in zip(start, stop))
+        blocks.append((block_index, core, padded))
+
+    # closure for one block
+    def lcc_single_block(block):
+
+        # compute lcc over the padded block, crop out the halo
+        block_index, core, padded = block
+        _, lcc = local_correlation_coefficient(
+            fix_zarr[padded], mov_zarr[padded], spacing, radius,
+            return_image=True, tolerance=tolerance, dtype=dtype,
+            intensity_ranges=intensity_ranges,
+        )
+        crop = tuple(slice(x.start - y.start, x.stop - y.start) for x, y in zip(core, padded))
+        lcc = lcc[crop]
+
+        # summarize
+        stats = {
+            'block_index': block_index,
+            'voxels': lcc.size,
+            'mean': float(np.mean(lcc)),
+            'min': float(np.min(lcc)),
+            'p10': float(np.percentile(lcc, 10)),
+            'median': float(np.median(lcc)),
+            'valid_fraction': float(np.count_nonzero(lcc) / lcc.size),
+        }
+        if threshold is not None:
+            stats['flagged'] = stats['mean'] < threshold
+
+        # write result or return it
+        if write_path:
+            output[core] = lcc
+            return True, stats
+        return lcc, stats
+    # END: closure
+
+    # compute all blocks, a bounded number at a time
+    block_stats = [None] * len(blocks)
+    for iii, (result, stats) in ut.bounded_map(cluster.client, lcc_single_block, blocks):
+        if not write_path:
+            output[blocks[iii][1]] = result
+        block_stats[iii] = stats
+
+    # report
+    if stats_path: ut.write_records(stats_path, block_stats)
+    voxels = np.array([x['voxels'] for x in block_stats])
+    means = np.array([x['mean'] for x in block_stats])
+    message = f'LCC mean: {np.sum(voxels * means) / np.sum(voxels):.4g} blocks: {len(blocks)}'
+    if threshold is not None:
+        message += f" flagged: {sum(x['flagged'] for x in block_stats)}"
+    print(message, flush=True)
+    return output, block_stats
 
 
 @cluster
@@ -221,6 +468,7 @@ def roi_correlations(
     mov,
     rois,
     radius=None,
+    batched=True,
     cluster=None,
     cluster_kwargs={},
     temporary_directory=None,
@@ -244,6 +492,12 @@ def roi_correlations(
     radius : int or tuple of int (default: None)
         How much to extend the ROI along each axis.
 
+    batched : bool (default: True)
+        If True, ROIs are grouped by the chunk that contains their center.
+        Each group is one task that reads the bounding box of its ROIs once
+        and computes all their correlations with summed area tables. If
+        False, each ROI is its own task. Use batched for many small ROIs.
+
     cluster : ClusterWrap.cluster object (default: None)
         Only set if you have constructed your own static cluster. The default behavior
         is to construct a cluster for the duration of this function, then close it
@@ -260,7 +514,8 @@ def roi_correlations(
         Temporary files are created during alignment. The temporary files will be
         in their own folder within the `temporary_directory`. The default is the
         current directory. Temporary files are removed if the function completes
-        successfully.
+        successfully. zarr, N5, HDF5, and memory mapped inputs are read in place,
+        only inputs held in memory are written to temporary files.
 
     Returns
     -------
@@ -268,40 +523,110 @@ def roi_correlations(
         The correlation between fix and mov in all rois
     """
 
-    # ensure zarr images
-    temporary_directory = tempfile.TemporaryDirectory(
-        prefix='.', dir=temporary_directory or os.getcwd(),
-    )
-    zarr_blocks = [128,]* fix.ndim
-    fix_zarr_path = temporary_directory.name + '/fix.zarr'
-    mov_zarr_path = temporary_directory.name + '/mov.zarr'
-    fix_zarr = ut.numpy_to_zarr(fix, zarr_blocks, fix_zarr_path)
-    mov_zarr = ut.numpy_to_zarr(mov, zarr_blocks, mov_zarr_path)
+    # nothing to compute
+    if len(rois) == 0: return np.zeros(0)
 
     # ensure radius is a tuple
     if radius is not None and not isinstance(radius, tuple):
         radius = (radius,) * fix.ndim
 
-    # record shape
-    full_shape = fix.shape
-
-    def roi_correlation(roi):
+    # chunk temporary copies to fit the typical roi, reuse native chunks
+    extents = [[s.stop - s.start for s in roi] for roi in rois]
+    extents = np.median(extents, axis=0) + 2 * np.array(radius or 0)
+    extents = np.clip(extents, 32, 128).astype(int)
+    _, _, zarr_blocks, _ = ut.plan_blocks(
+        fix.shape, extents, 0, fix.dtype.itemsize, chunks=getattr(fix, 'chunks', None),
+    )
 
-        # adjust for radius
-        if radius is not None:
-            new_roi = []
-            for s, r, sh in zip(roi, radius, full_shape):
-                new_roi.append(slice(max(s.start - r, 0), min(s.stop + r, sh)))
-            roi = tuple(new_roi)
+    # share images with workers, only in memory data is copied to disk
+    temporary_directory = ut.LazyTemporaryDirectory(temporary_directory)
+    fix_zarr = ut.shared_array(fix, zarr_blocks, temporary_directory.path('fix.zarr'))
+    mov_zarr = ut.shared_array(mov, zarr_blocks, temporary_directory.path('mov.zarr'))
 
-        # crop and flatten the data
-        fix_crop = fix_zarr[roi].flatten()
-        mov_crop = mov_zarr[roi].flatten()
+    # record shape
+    full_shape = fix.shape
 
-        # return correlation
-        return np.corrcoef(fix_crop, mov_crop)[0, 1]
+    # per roi task
+    if not batched:
+
+        def roi_correlation(roi):
+
+            # adjust for radius
+            if radius is not None:
+                new_roi = []
+                for s, r, sh in zip(roi, radius, full_shape):
+                    new_roi.append(slice(max(s.start - r, 0), min(s.stop + r, sh)))
+                roi = tuple(new_roi)
+
+            # crop and flatten the data
+            fix_crop = fix_zarr[roi].flatten()
+            mov_crop = mov_zarr[roi].flatten()
+
+            # return correlation
+            return np.corrcoef(fix_crop, mov_crop)[0, 1]
+
+        # run everything in parallel
+        futures = cluster.client.map(roi_correlation, rois)
+        return np.array(cluster.client.gather(futures))
+
+    # roi corners adjusted for radius
+    starts = np.array([[s.start for s in roi] for roi in rois])
+    stops = np.array([[s.stop for s in roi] for roi in rois])
+    if radius is not None:
+        starts = np.maximum(starts - radius, 0)
+        stops = np.minimum(stops + radius, full_shape)
+
+    # group rois by the chunk that contains their center
+    centers = (starts + stops) // 2
+    _, groups = np.unique(centers // zarr_blocks, axis=0, return_inverse=True)
+    groups = groups.reshape(-1)
+    order = np.argsort(groups, kind='stable')
+    splits = np.flatnonzero(np.diff(groups[order])) + 1
+    batches = [(starts[x], stops[x]) for x in np.split(order, splits)]
+
+    def roi_correlation_batch(batch):
+
+        # read the bounding box of all rois once, center for stability
+        starts, stops = batch
+        lo, hi = starts.min(axis=0), stops.max(axis=0)
+        bbox = tuple(slice(int(a), int(b)) for a, b in zip(lo, hi))
+        fix_box = fix_zarr[bbox].astype(np.float64)
+        mov_box = mov_zarr[bbox].astype(np.float64)
+        fix_box -= fix_box.mean()
+        mov_box -= mov_box.mean()
+
+        # sums over every roi with summed area tables
+        starts, stops = starts - lo, stops - lo
+        sx = _roi_sums(fix_box, starts, stops)
+        sy = _roi_sums(mov_box, starts, stops)
+        sxy = _roi_sums(fix_box * mov_box, starts, stops)
+        sxx = _roi_sums(fix_box**2, starts, stops)
+        syy = _roi_sums(mov_box**2, starts, stops)
+
+        # pearson correlation from sums
+        n = np.prod(stops - starts, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (n*sxy - sx*sy) / np.sqrt((n*sxx - sx**2) * (n*syy - sy**2))
+
+    # run everything in parallel, one array per batch
+    futures = cluster.client.map(roi_correlation_batch, batches)
+    correlations = np.empty(len(rois))
+    correlations[order] = np.concatenate(cluster.client.gather(futures))
+    return correlations
+
+
+def _roi_sums(image, starts, stops):
+
+    # summed area table with a leading row of zeros along every axis
+    sat = np.pad(image, ((1, 0),) * image.ndim)
+    for iii in range(image.ndim):
+        sat.cumsum(axis=iii, out=sat)
 
-    # run everything in parallel
-    futures = cluster.client.map(roi_correlation, rois)
-    return np.array(cluster.client.gather(futures))
+    # inclusion-exclusion over the corners of every roi
+    sums = np.zeros(len(starts))
+    for corner in product((0, 1), repeat=image.ndim):
+        index = np.where(np.array(corner, dtype=bool), stops, starts)
+        sign = (-1)**(image.ndim - sum(corner))
+        sums += sign * sat[tuple(index.T)]
+    return sums
 
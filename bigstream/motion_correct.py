@@ -166,7 +166,12 @@ def motion_correct(
         This is how distribution parameters are specified.
 
     kwargs : any additional arguments
-        Passed to configure_irm. Control the nature of alignments through these arguments
+        Passed to affine_align and configure_irm. Control the nature of alignments
+        through these arguments. Pass engine='numpy' to align frames with
+        bigstream.numpy_align, which is faster for small frames; it uses only
+        numberOfIterations from optimizer_args, see affine_align. Pass
+        reuse=True to keep configured registration objects between frames
+        aligned by the same worker thread, see configure_irm.
 
     Returns
     -------
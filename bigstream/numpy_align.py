@@ -0,0 +1,358 @@
+import numpy as np
+from functools import reduce
+from itertools import product
+from scipy.ndimage import gaussian_filter, center_of_mass
+from scipy.optimize import minimize
+
+
+def numpy_affine_align(
+    fix,
+    mov,
+    fix_spacing,
+    mov_spacing,
+    rigid=False,
+    initial_condition=None,
+    fix_mask=None,
+    mov_mask=None,
+    fix_mask_spacing=None,
+    mov_mask_spacing=None,
+    fix_origin=None,
+    mov_origin=None,
+    static_transform_list=[],
+    metric='MS',
+    shrink_factors=(1,),
+    smooth_sigmas=(0,),
+    iterations=100,
+):
+    """
+    Rigid or affine alignment optimized entirely in numpy. Metrics and their
+    analytic gradients are computed with vectorized float32 arithmetic and
+    parameters are optimized with L-BFGS. There is no per iteration callback.
+    Intended for small images, e.g. heavily skip sampled frames for motion
+    correction, where ITK overhead dominates.
+
+    Parameters
+    ----------
+    fix : nd-array
+        the fixed image
+
+    mov : nd-array
+        the moving image; `fix.ndim` must equal `mov.ndim`
+
+    fix_spacing : 1d-array
+        The spacing in physical units between voxels of the fixed image
+
+    mov_spacing : 1d-array
+        The spacing in physical units between voxels of the moving image
+
+    rigid : bool (default: False)
+        Restrict the alignment to rigid motion only
+
+    initial_condition : str or 4x4 ndarray (default: None)
+        "CENTER" initializes with a center of mass alignment. If a matrix
+        is given the optimization is initialized with that transform.
+
+    fix_mask : binary nd-array (default: None)
+        Only fixed image voxels in the foreground are used
+
+    mov_mask : binary nd-array (default: None)
+        Only fixed image voxels that map into the foreground are used
+
+    fix_mask_spacing : 1d-array (default: None)
+        The voxel spacing of fix_mask
+
+    mov_mask_spacing : 1d-array (default: None)
+        The voxel spacing of mov_mask
+
+    fix_origin : 1d-array (default: None)
+        Origin of the fixed image
+
+    mov_origin : 1d-array (default: None)
+        Origin of the moving image
+
+    static_transform_list : list of 4x4 arrays (default: [])
+        Affine transforms applied to the moving image before the
+        transform being optimized. Deformation fields are not supported.
+
+    metric : string (default: 'MS')
+        'MS' : mean squared difference
+        'C' : negative normalized cross correlation
+
+    shrink_factors : tuple of int (default: (1,))
+        Downsampling factor for each level of the pyramid
+
+    smooth_sigmas : tuple of float (default: (0,))
+        Gaussian smoothing in physical units for each level of the pyramid
+
+    iterations : int (default: 100)
+        Maximum number of L-BFGS iterations per level
+
+    Returns
+    -------
+    transform : 4x4 array
+        The affine or rigid transform matrix matching moving to fixed
+
+    telemetry : dict
+        'initial_metric', 'final_metric', 'iterations', and 'stop_condition'
+        The metrics are evaluated on the full resolution, unsmoothed images
+    """
+
+    # defaults and formatting
+    ndim = fix.ndim
+    fix_spacing = np.array(fix_spacing, dtype=np.float64)
+    mov_spacing = np.array(mov_spacing, dtype=np.float64)
+    if fix_origin is None: fix_origin = np.zeros(ndim)
+    if mov_origin is None: mov_origin = np.zeros(ndim)
+    fix_origin, mov_origin = np.array(fix_origin), np.array(mov_origin)
+    if metric not in ('MS', 'C'):
+        raise ValueError(f"metric must be 'MS' or 'C', got {metric}")
+
+    # initial transform
+    if isinstance(initial_condition, str) and initial_condition == "CENTER":
+        a, b = fix, mov
+        if fix_mask is not None and mov_mask is not None: a, b = fix_mask, mov_mask
+        a_spacing = fix_spacing if a is fix else fix_mask_spacing
+        b_spacing = mov_spacing if b is mov else mov_mask_spacing
+        initial_condition = np.eye(ndim + 1)
+        initial_condition[:ndim, -1] = (
+            mov_origin + np.array(center_of_mass(b)) * b_spacing -
+            fix_origin - np.array(center_of_mass(a)) * a_spacing
+        )
+    if initial_condition is None: initial_condition = np.eye(ndim + 1)
+
+    # everything applied after the optimized transform is one affine
+    outer = reduce(np.matmul, static_transform_list, np.eye(ndim + 1))
+    outer = outer @ initial_condition
+
+    # parameters are about the fixed image center, scaled by its radius
+    center = fix_origin + (np.array(fix.shape) - 1) * fix_spacing / 2
+    scale = max(np.linalg.norm((np.array(fix.shape) - 1) * fix_spacing) / 2, 1.)
+    nrotations = 3 if ndim == 3 else 1
+    nparams = (nrotations if rigid else ndim**2) + ndim
+    params = np.zeros(nparams)
+
+    # closure to evaluate metric and gradient on one level of the pyramid
+    def objective(params, level):
+        matrix, jacobians = _parameters_to_matrix(params, ndim, rigid, center, scale)
+        value, grad_linear, grad_translation = _metric_and_gradient(
+            outer @ matrix, outer, level, mov_origin, metric,
+        )
+        grad_augmented = np.concatenate((grad_linear, grad_translation[:, None]), axis=1)
+        grad = [np.sum(grad_augmented * j) for j in jacobians]
+        return value, np.concatenate((grad, grad_translation))
+
+    # coarse to fine
+    telemetry = {'iterations': 0}
+    full = _level(fix, mov, fix_mask, mov_mask, fix_spacing, mov_spacing,
+                  fix_mask_spacing, mov_mask_spacing, fix_origin, mov_origin, 1, 0)
+    telemetry['initial_metric'] = objective(params, full)[0]
+    for shrink, sigma in zip(shrink_factors, smooth_sigmas):
+        level = full
+        if shrink != 1 or sigma != 0:
+            level = _level(fix, mov, fix_mask, mov_mask, fix_spacing, mov_spacing,
+                           fix_mask_spacing, mov_mask_spacing, fix_origin, mov_origin,
+                           shrink, sigma)
+        result = minimize(
+            objective, params, args=(level,), jac=True, method='L-BFGS-B',
+            options={'maxiter': iterations},
+        )
+        params = result.x
+        telemetry['iterations'] += int(result.nit)
+        telemetry['stop_condition'] = str(result.message)
+    telemetry['final_metric'] = objective(params, full)[0]
+
+    # return the optimized transform, without static transforms
+    matrix, _ = _parameters_to_matrix(params, ndim, rigid, center, scale)
+    return initial_condition @ matrix, telemetry
+
+
+def _level(
+    fix, mov, fix_mask, mov_mask,
+    fix_spacing, mov_spacing, fix_mask_spacing, mov_mask_spacing,
+    fix_origin, mov_origin, shrink, sigma,
+):
+    """
+    Smooth and shrink images for one pyramid level, return fixed sample
+    coordinates and values and the moving image
+    """
+
+    # smooth in physical units, then subsample
+    def prepare(image, spacing):
+        image = image.astype(np.float32)
+        if sigma > 0: image = gaussian_filter(image, sigma / spacing)
+        return image[(slice(None, None, shrink),) * image.ndim], spacing * shrink
+    fix, fix_spacing = prepare(fix, fix_spacing)
+    mov, mov_spacing = prepare(mov, mov_spacing)
+
+    # fixed sample coordinates in physical units, restricted to the mask
+    coords = np.indices(fix.shape, dtype=np.float32).reshape(fix.ndim, -1).T
+    coords = coords * fix_spacing.astype(np.float32) + fix_origin.astype(np.float32)
+    values = fix.reshape(-1)
+    if fix_mask is not None:
+        keep = _sample_nearest(fix_mask, (coords - fix_origin) / fix_mask_spacing) != 0
+        coords, values = coords[keep], values[keep]
+
+    return {
+        'coords': coords,
+        'values': values,
+        'mov': np.ascontiguousarray(mov),
+        'mov_spacing': mov_spacing,
+        'mov_mask': mov_mask,
+        'mov_mask_spacing': mov_mask_spacing,
+    }
+
+
+def _metric_and_gradient(matrix, outer, level, mov_origin, metric):
+    """
+    Metric value and its gradient with respect to the linear part and
+    translation of the transform applied before `outer`
+    """
+
+    # map fixed samples into moving voxel coordinates
+    ndim = level['mov'].ndim
+    coords = level['coords']
+    spacing = level['mov_spacing']
+    linear = (matrix[:ndim, :ndim] / spacing[:, None]).T.astype(np.float32)
+    offset = ((matrix[:ndim, -1] - mov_origin) / spacing).astype(np.float32)
+    voxels = coords @ linear + offset
+    inside = np.all((voxels >= 0) & (voxels <= np.array(level['mov'].shape) - 1), axis=1)
+    if level['mov_mask'] is not None:
+        mask_voxels = voxels[inside] * (spacing / level['mov_mask_spacing'])
+        inside[inside] = _sample_nearest(level['mov_mask'], mask_voxels) != 0
+    if not np.any(inside):
+        raise ValueError("All samples map outside the moving image")
+    coords, voxels, fixed = coords[inside], voxels[inside], level['values'][inside]
+
+    # interpolate moving image and its gradient
+    moving, gradients = _interpolate_with_gradient(level['mov'], voxels, level['mov_spacing'])
+
+    # metric and its derivative with respect to each moving value
+    if metric == 'MS':
+        difference = moving - fixed
+        value = np.mean(difference**2, dtype=np.float64)
+        weights = 2 * difference / len(difference)
+    elif metric == 'C':
+        fixed = fixed - fixed.mean()
+        moving = moving - moving.mean()
+        fixed_norm = np.linalg.norm(fixed) + 1e-12
+        moving_norm = np.linalg.norm(moving) + 1e-12
+        correlation = np.dot(fixed, moving) / (fixed_norm * moving_norm)
+        value = -correlation
+        weights = -(fixed / fixed_norm - correlation * moving / moving_norm) / moving_norm
+
+    # chain rule through outer transform, then to linear part and translation
+    h = (weights[:, None] * gradients) @ outer[:ndim, :ndim].astype(np.float32)
+    return float(value), h.T @ coords, h.sum(axis=0)
+
+
+def _interpolate_with_gradient(image, voxels, spacing):
+    """
+    Linear interpolation of image at voxel coordinates inside the image and
+    the exact gradient of the interpolant in physical units, from one gather
+    of the corners around every coordinate
+    """
+
+    # corner indices and fractional offsets
+    shape = np.array(image.shape)
+    base = np.minimum(np.floor(voxels).astype(np.intp), np.maximum(shape - 2, 0))
+    fraction = (voxels - base).astype(np.float32)
+    strides = np.array(image.strides) // image.itemsize
+    base = base @ strides
+    flat = image.reshape(-1)
+
+    # an axis of length one is constant, both its corners are the same voxel
+    steps = np.where(shape > 1, strides, 0)
+
+    # gather all corners, then interpolate one axis at a time from the last,
+    # the derivative along each axis is interpolated along the remaining ones
+    corners = [flat[base + np.dot(c, steps)] for c in product((0, 1), repeat=image.ndim)]
+    values = np.stack(corners).reshape((2,) * image.ndim + (-1,))
+    derivatives = []
+    for axis in reversed(range(image.ndim)):
+        f = fraction[:, axis]
+        derivatives = [d[..., 0, :] + (d[..., 1, :] - d[..., 0, :]) * f for d in derivatives]
+        lo, hi = values[..., 0, :], values[..., 1, :]
+        derivatives.insert(0, hi - lo)
+        values = lo + derivatives[0] * f
+    return values, np.stack(derivatives, axis=1) / spacing.astype(np.float32)
+
+
+def _parameters_to_matrix(params, ndim, rigid, center, scale):
+    """
+    Build the matrix x -> L(x - center) + center + t from parameters and
+    return the derivatives of L with respect to each non translation parameter
+    """
+
+    # linear part and its jacobians
+    if rigid:
+        angles = params[:-ndim] / scale
+        linear, jacobians = _rotation_and_jacobians(angles, ndim)
+        jacobians = [j / scale for j in jacobians]
+    else:
+        linear = np.eye(ndim) + params[:-ndim].reshape(ndim, ndim) / scale
+        jacobians = []
+        for iii in range(ndim**2):
+            j = np.zeros(ndim**2)
+            j[iii] = 1 / scale
+            jacobians.append(j.reshape(ndim, ndim))
+
+    # assemble
+    matrix = np.eye(ndim + 1)
+    matrix[:ndim, :ndim] = linear
+    matrix[:ndim, -1] = center - linear @ center + params[-ndim:]
+
+    # jacobians act on coordinates relative to the center
+    return matrix, [_centered(j, center) for j in jacobians]
+
+
+def _centered(jacobian, center):
+    """
+    Augmented jacobian [J, -J @ center], pairs with the gradient over raw
+    coordinates augmented by the translation gradient
+    """
+
+    augmented = np.zeros(jacobian.shape[0:1] + (jacobian.shape[1] + 1,))
+    augmented[:, :-1] = jacobian
+    augmented[:, -1] = -jacobian @ center
+    return augmented
+
+
+def _rotation_and_jacobians(angles, ndim):
+    """
+    Rotation matrix from angles about each axis and its derivatives
+    """
+
+    if ndim == 2:
+        c, s = np.cos(angles[0]), np.sin(angles[0])
+        return np.array([[c, -s], [s, c]]), [np.array([[-s, -c], [c, -s]])]
+
+    # rotations about each axis and their derivatives
+    rotations, derivatives = [], []
+    for axis, angle in enumerate(angles):
+        c, s = np.cos(angle), np.sin(angle)
+        i, j = [x for x in range(3) if x != axis]
+        r, d = np.eye(3), np.zeros((3, 3))
+        r[i, i], r[i, j], r[j, i], r[j, j] = c, -s, s, c
+        d[i, i], d[i, j], d[j, i], d[j, j] = -s, -c, c, -s
+        rotations.append(r)
+        derivatives.append(d)
+
+    # product rule
+    rotation = rotations[0] @ rotations[1] @ rotations[2]
+    jacobians = []
+    for axis in range(3):
+        factors = [derivatives[x] if x == axis else rotations[x] for x in range(3)]
+        jacobians.append(factors[0] @ factors[1] @ factors[2])
+    return rotation, jacobians
+
+
+def _sample_nearest(image, voxels):
+    """
+    Nearest neighbor lookup, coordinates outside the image read zero
+    """
+
+    index = np.round(voxels).astype(int)
+    inside = np.all((index >= 0) & (index < image.shape), axis=1)
+    result = np.zeros(len(index), dtype=image.dtype)
+    result[inside] = image[tuple(index[inside].T)]
+    return result
@@ -1,16 +1,20 @@
-import os, tempfile
+import os, json
 import numpy as np
 import time
+import zarr
 from itertools import product
+from collections import Counter
+from operator import itemgetter
 from scipy.interpolate import LinearNDInterpolator
-from dask.distributed import as_completed, wait
+from dask.distributed import as_completed, wait, get_worker
 from ClusterWrap.decorator import cluster
 import bigstream.utility as ut
 from bigstream.align import alignment_pipeline
 from bigstream.transform import apply_transform, compose_transform_list
 from bigstream.transform import apply_transform_to_coordinates
 from bigstream.transform import compose_transforms
-from distributed import Lock, MultiLock
+from bigstream.metrics import local_correlation_coefficient
+from bigstream.piecewise_transform import distributed_apply_transform
 
 
 @cluster
@@ -31,6 +35,15 @@ def distributed_piecewise_alignment_pipeline(
     temporary_directory=None,
     write_path=None,
     write_group_interval=30,
+    checkpoint_directory=None,
+    checkpoint_interval=60,
+    compact=False,
+    cost_model=None,
+    block_resources=None,
+    priority_tiers=8,
+    timing_report=None,
+    block_mask=None,
+    initial_transform=None,
     **kwargs,
 ):
     """
@@ -74,7 +87,11 @@ def distributed_piecewise_alignment_pipeline(
         for their specific step only.
 
     blocksize : iterable
-        The shape of blocks in voxels
+        The shape of blocks in voxels. It is used as given: it sets how local
+        the alignment is. Chunked inputs (zarr, N5, HDF5) are read through
+        their native chunks; temporary zarr copies of in memory inputs are
+        chunked to match the blocks and overlaps. See
+        bigstream.utility.plan_blocks.
 
     overlap : float in range [0, 1] (default: 0.5)
         Block overlap size as a percentage of block size
@@ -113,16 +130,88 @@ def distributed_piecewise_alignment_pipeline(
         Temporary files are created during alignment. The temporary files will be
         in their own folder within the `temporary_directory`. The default is the
         current directory. Temporary files are removed if the function completes
-        successfully.
+        successfully. zarr, N5, HDF5, and memory mapped inputs are read in place,
+        only inputs held in memory are written to temporary files.
 
     write_path : string (default: None)
         If the transform found by this function is too large to fit into main
         process memory, set this parameter to a location where the transform
         can be written to disk as a zarr file.
 
+        With write_path or checkpoint_directory (and compact False), blocks
+        first write their weighted fields to a scratch zarr array with 27
+        parity classes of the overlap padded output shape. Each block writes
+        its full padded region, about 8 output chunks, so scratch costs up to
+        about 8x the output field on disk and in writes (all zero chunks are
+        not stored). Scratch lives in `temporary_directory` and is removed
+        when the function returns or fails, unless checkpoint_directory is
+        given, in which case it is kept there for resuming.
+
     write_group_interval : float (default: 30.)
-        The time each of the 27 mutually exclusive write block groups have
-        each round to write finished data.
+        DEPRECATED. Blocks no longer take turns writing. Each block writes to
+        scratch space without locks and a final pass sums the contributions
+        into the output. This argument is ignored.
+
+    checkpoint_directory : string (default: None)
+        If given, copies of in memory inputs, the weighted field of every
+        finished block, and a manifest of finished block indices are kept
+        here. Calling again with the same arguments and checkpoint_directory
+        skips blocks that already finished, e.g. after the cluster is preempted.
+        The manifest records array shapes and parameters, not array data.
+        Remove the directory when you no longer need to resume.
+
+    checkpoint_interval : float (default: 60.)
+        The minimum number of seconds between manifest updates
+
+    compact : bool (default: False)
+        If True, blocks return their transforms in compact form (affine matrices
+        and b-spline parameters, see `alignment_pipeline` return_format 'compact')
+        instead of dense displacement fields. The result is a PiecewiseTransform
+        which renders the blended displacement field only for the regions that
+        are indexed, e.g. by `distributed_apply_transform`. If `write_path` is
+        given the compact transform is saved there, see PiecewiseTransform.save.
+
+    cost_model : string (default: None)
+        Blocks expected to be expensive are submitted first and with higher
+        dask priority, so long blocks do not form a tail at the end of the run.
+        By default the cost of a block is estimated from its foreground fraction
+        in `fix_mask`. If this is the path to a `timing_report` from a previous
+        run the measured block times are used instead.
+
+    block_resources : dict (default: None)
+        dask resources required by each alignment task, e.g. {'MEMORY': 1}
+        Workers must be started with matching resources.
+
+    priority_tiers : int (default: 8)
+        Blocks are split into this many cost tiers with decreasing priority
+
+    timing_report : string (default: None)
+        Path to write a telemetry report with one record per block: its index,
+        worker, total, read, alignment, and write times in seconds, and for
+        each step its time, initial and final metric, iterations, and whether
+        it fell back to its default. Json lines, or Parquet if the path ends
+        in '.parquet' (requires pandas). Can be given as `cost_model` later.
+        A summary is always printed and records are sent to the dask event
+        log under 'bigstream-blocks'.
+
+    block_mask : binary ndarray (default: None)
+        Restricts which blocks are aligned without affecting the metric. Only
+        blocks whose center is in the foreground of `block_mask` are aligned,
+        the displacement elsewhere is zero (see `initial_transform`). Either
+        one entry per block of the grid given by `blocksize`, used as is, or a
+        mask with the same domain as the fixed image, though sampling can be
+        different, which is sampled at block centers. Combined with the
+        `fix_mask` test.
+
+    initial_transform : ndarray or zarr array (default: None)
+        A displacement field, e.g. a coarser alignment, with the same domain
+        as the fixed image, though sampling can be different. Each block
+        starts from the least squares affine fit of this field over the
+        block instead of warping through the field, and the returned field
+        includes that affine, i.e. it is a total transform and not relative
+        to `initial_transform`. Blocks that are not aligned (e.g. background
+        or outside `block_mask`) are still written with their affine fit of
+        `initial_transform`, so the result covers the whole domain.
 
     kwargs : any additional arguments
         Arguments that will apply to all alignment steps. These are overruled by
@@ -130,100 +219,240 @@ def distributed_piecewise_alignment_pipeline(
 
     Returns
     -------
-    field : nd array or zarr.core.Array
+    field : nd array, zarr.core.Array, or PiecewiseTransform
         Local affines stitched together into a displacement field
         Shape is `fix.shape` + (3,) as the last dimension contains
-        the displacement vector.
+        the displacement vector. A PiecewiseTransform if `compact` is True.
+    """
+
+    # temporary files are removed on success or failure, unless checkpointing
+    temporary_directory = ut.LazyTemporaryDirectory(temporary_directory)
+    try:
+        return _distributed_piecewise_alignment_pipeline(
+            fix, mov, fix_spacing, mov_spacing, steps, blocksize, overlap,
+            fix_mask, mov_mask, foreground_percentage, static_transform_list,
+            cluster, temporary_directory, write_path, write_group_interval,
+            checkpoint_directory, checkpoint_interval, compact, cost_model,
+            block_resources, priority_tiers, timing_report, block_mask,
+            initial_transform, **kwargs,
+        )
+    finally:
+        if not checkpoint_directory: temporary_directory.cleanup()
+
+
+def _distributed_piecewise_alignment_pipeline(
+    fix,
+    mov,
+    fix_spacing,
+    mov_spacing,
+    steps,
+    blocksize,
+    overlap,
+    fix_mask,
+    mov_mask,
+    foreground_percentage,
+    static_transform_list,
+    cluster,
+    temporary_directory,
+    write_path,
+    write_group_interval,
+    checkpoint_directory,
+    checkpoint_interval,
+    compact,
+    cost_model,
+    block_resources,
+    priority_tiers,
+    timing_report,
+    block_mask,
+    initial_transform,
+    **kwargs,
+):
+    """
+    The work of distributed_piecewise_alignment_pipeline, all arguments are
+    the same except `temporary_directory` is a ut.LazyTemporaryDirectory
     """
 
-    # temporary file paths and create zarr images
-    temporary_directory = tempfile.TemporaryDirectory(
-        prefix='.', dir=temporary_directory or os.getcwd(),
+    # plan blocks and chunks together, reuse native chunks of zarr inputs
+    blocksize, overlaps, zarr_blocks, _ = ut.plan_blocks(
+        fix.shape, blocksize, overlap, fix.dtype.itemsize,
+        chunks=getattr(fix, 'chunks', None),
     )
-    zarr_blocks = [128,] * fix.ndim
-    fix_zarr_path = temporary_directory.name + '/fix.zarr'
-    mov_zarr_path = temporary_directory.name + '/mov.zarr'
-    fix_mask_zarr_path = temporary_directory.name + '/fix_mask.zarr'
-    mov_mask_zarr_path = temporary_directory.name + '/mov_mask.zarr'
-    fix_zarr = ut.numpy_to_zarr(fix, zarr_blocks, fix_zarr_path)
-    mov_zarr = ut.numpy_to_zarr(mov, zarr_blocks, mov_zarr_path)
+
+    # establish all keyword arguments
+    steps = [(a, {**kwargs, **b}) for a, b in steps]
+
+    # checkpoint state, blocks finished by a previous call are skipped
+    completed = set()
+    if checkpoint_directory:
+        os.makedirs(checkpoint_directory, exist_ok=True)
+        manifest_path = os.path.join(checkpoint_directory, 'manifest.json')
+        fingerprint = lambda x: None if x is None else ut.array_fingerprint(x)
+        arguments_hash = ut.hash_arguments(
+            fingerprint(fix), fingerprint(mov), fix_spacing, mov_spacing,
+            steps, blocksize, overlaps, foreground_percentage, compact,
+            fingerprint(fix_mask), fingerprint(mov_mask),
+            [x if x.shape == (4, 4) else fingerprint(x) for x in static_transform_list],
+            None if block_mask is None else np.asarray(block_mask) != 0,
+            fingerprint(initial_transform),
+        )
+        completed = ut.read_manifest(manifest_path, arguments_hash)
+        scratch_path = lambda name: os.path.join(checkpoint_directory, name)
+
+        # the stored results may be missing, e.g. removed by hand
+        store = 'compact' if compact else 'scratch.zarr'
+        if completed and not os.path.exists(scratch_path(store)):
+            print(f'CHECKPOINT {store} NOT FOUND, STARTING OVER', flush=True)
+            completed = set()
+    else:
+        scratch_path = temporary_directory.path
+    reuse = len(completed) > 0
+
+    # share inputs with workers, only in memory data is copied to disk
+    fix_zarr = ut.shared_array(fix, zarr_blocks, scratch_path('fix.zarr'), reuse)
+    mov_zarr = ut.shared_array(mov, zarr_blocks, scratch_path('mov.zarr'), reuse)
     fix_mask_zarr = None
-    if fix_mask is not None: fix_mask_zarr = ut.numpy_to_zarr(fix_mask, zarr_blocks, fix_mask_zarr_path)
+    if fix_mask is not None:
+        chunks = ut.relative_chunks(zarr_blocks, fix.shape, fix_mask.shape)
+        path = scratch_path('fix_mask.zarr')
+        fix_mask_zarr = ut.shared_array(fix_mask, chunks, path, reuse)
     mov_mask_zarr = None
-    if mov_mask is not None: mov_mask_zarr = ut.numpy_to_zarr(mov_mask, zarr_blocks, mov_mask_zarr_path)
+    if mov_mask is not None:
+        chunks = ut.relative_chunks(zarr_blocks, mov.shape, mov_mask.shape)
+        path = scratch_path('mov_mask.zarr')
+        mov_mask_zarr = ut.shared_array(mov_mask, chunks, path, reuse)
 
-    # zarr files for initial deformations
+    # share initial deformations
     new_list = []
     for iii, transform in enumerate(static_transform_list):
         if transform.shape != (4, 4) and len(transform.shape) != 1:
-            path = temporary_directory.name + f'/deform{iii}.zarr'
-            transform = ut.numpy_to_zarr(transform, tuple(zarr_blocks) + (transform.shape[-1],), path)
+            chunks = ut.relative_chunks(zarr_blocks, fix.shape, transform.shape)
+            path = scratch_path(f'deform{iii}.zarr')
+            transform = ut.shared_array(transform, chunks, path, reuse)
         new_list.append(transform)
     static_transform_list = new_list
+    if initial_transform is not None:
+        chunks = ut.relative_chunks(zarr_blocks, fix.shape, initial_transform.shape)
+        path = scratch_path('initial_transform.zarr')
+        initial_transform = ut.shared_array(initial_transform, chunks, path, reuse)
 
     # zarr file for output (if write_path is given)
-    if write_path:
+    if write_path and not compact:
         output_transform = ut.create_zarr(
             write_path,
             fix.shape + (fix.ndim,),
             tuple(blocksize) + (fix.ndim,),
             np.float32,
         )
-        # chunks will need locks for parallel writing
-        locks = [Lock(f'{x}') for x in np.ndindex(*output_transform.cdata_shape)]
 
-    # determine fixed image slices for blocking
-    blocksize = np.array(blocksize)
+    # blocks write to one of 27 parity classes, offset by the overlap
+    # no two blocks in the same class touch the same chunk, so no locks
+    use_scratch = not compact and (write_path or checkpoint_directory)
+    if use_scratch:
+        path = scratch_path('scratch.zarr')
+        if callable(path): path = path()
+        if reuse:
+            scratch = zarr.open(path, mode='r+')
+        else:
+            scratch = ut.create_zarr(
+                path,
+                (27,) + tuple(np.array(fix.shape) + 2 * overlaps) + (fix.ndim,),
+                (1,) + tuple(blocksize) + (fix.ndim,),
+                np.float32,
+                write_empty_chunks=False,
+            )
+
+    # determine foreground blocks
     nblocks = np.ceil(np.array(fix.shape) / blocksize).astype(int)
-    overlaps = np.round(blocksize * overlap).astype(int)
-    indices, slices = [], []
-    for (i, j, k) in np.ndindex(*nblocks):
-        start = blocksize * (i, j, k) - overlaps
-        stop = start + blocksize + 2 * overlaps
-        start = np.maximum(0, start)
-        stop = np.minimum(fix.shape, stop)
-        coords = tuple(slice(x, y) for x, y in zip(start, stop))
-
-        foreground = True
-        if fix_mask is not None:
-            start = blocksize * (i, j, k)
-            stop = start + blocksize
-            ratio = np.array(fix_mask.shape) / fix.shape
-            start = np.round( ratio * start ).astype(int)
-            stop = np.round( ratio * stop ).astype(int)
-            mask_crop = fix_mask[tuple(slice(a, b) for a, b in zip(start, stop))]
-            if not np.sum(mask_crop) / np.prod(mask_crop.shape) >= foreground_percentage:
-                foreground = False
-
-        if foreground:
-            indices.append((i, j, k,))
-            slices.append(coords)
-
-    # determine foreground neighbor structure
-    new_indices = []
+    fractions = np.ones(nblocks)
+    if fix_mask is not None:
+        fractions = ut.block_foreground_fractions(fix_mask, fix.shape, blocksize)
+    foreground = fractions >= foreground_percentage
+    if block_mask is not None:
+        foreground &= _sample_block_mask(block_mask, fix.shape, blocksize)
+
+    # with an initial transform every block is written, those that are
+    # not aligned carry the initial transform forward
+    aligned = foreground
+    if initial_transform is not None:
+        foreground = np.ones(nblocks, dtype=bool)
+
+    # determine neighbor structure by shifting the foreground grid
     neighbor_offsets = np.array(list(product([-1, 0, 1], repeat=3)))
-    for index, coords in zip(indices, slices):
-        neighbor_flags = {tuple(o): tuple(index + o) in indices for o in neighbor_offsets}
-        new_indices.append((index, coords, neighbor_flags))
-    indices = new_indices
-
-    # establish all keyword arguments
-    steps = [(a, {**kwargs, **b}) for a, b in steps]
+    padded = np.pad(foreground, 1)
+    flags = np.stack([
+        padded[tuple(slice(1 + x, 1 + x + n) for x, n in zip(o, nblocks))][foreground]
+        for o in neighbor_offsets
+    ], axis=-1)
 
+    # determine fixed image slices for blocking
+    block_indices = np.argwhere(foreground)
+    starts = np.maximum(0, block_indices * blocksize - overlaps)
+    stops = np.minimum(fix.shape, (block_indices + 1) * blocksize + overlaps)
+    offset_keys = [tuple(o) for o in neighbor_offsets]
+    indices = []
+    for index, start, stop, flag in zip(block_indices, starts, stops, flags):
+        coords = tuple(slice(int(x), int(y)) for x, y in zip(start, stop))
+        neighbor_flags = dict(zip(offset_keys, flag.tolist()))
+        indices.append((tuple(index.tolist()), coords, neighbor_flags))
 
     # closure for alignment pipeline
     def align_single_block(
         indices,
         static_transform_list,
+        weight_templates,
     ):
 
         # print some feedback
         print("Block index: ", indices[0], "\nSlices: ", indices[1], flush=True)
+        start_time = time.time()
 
         # get the coordinates, read fixed data
         block_index, fix_slices, neighbor_flags = indices
+        record = {'block_index': block_index, 'worker': get_worker().address}
         fix = fix_zarr[fix_slices]
 
+        # finish the telemetry record for this block
+        def finish(result):
+            record['seconds'] = time.time() - start_time
+            get_worker().log_event('bigstream-blocks', record)
+            return result, record
+
+        # weight and write or return the block transform
+        def render(transform):
+            write_start_time = time.time()
+
+            # compact transforms are only rendered when they are used
+            if compact:
+                record['write_seconds'] = time.time() - write_start_time
+                return finish((block_index, transform))
+
+            # ensure transform is a vector field
+            if transform.shape == (4, 4):
+                transform = ut.matrix_to_displacement_field(
+                    transform, fix.shape, spacing=fix_spacing,
+                )
+
+            # apply weights in place
+            key = _weights_key(block_index, neighbor_flags, nblocks)
+            weights = _get_weights(
+                weight_templates, key, blocksize, overlaps, transform.shape[:-1],
+            )
+            transform = transform.astype(np.float32, copy=False)
+            transform *= weights[..., None]
+
+            # if there's no scratch space, just return the transform block
+            if not use_scratch:
+                record['write_seconds'] = time.time() - write_start_time
+                return finish(transform)
+
+            # otherwise, write to the scratch array for this block's parity class
+            else:
+                parity = np.ravel_multi_index(tuple(x % 3 for x in block_index), (3,)*3)
+                region = tuple(slice(x.start + y, x.stop + y) for x, y in zip(fix_slices, overlaps))
+                scratch[(parity,) + region] = transform
+                record['write_seconds'] = time.time() - write_start_time
+                return finish(True)
+
         # get fixed image block corners in physical units
         fix_block_coords = []
         for corner in list(product([0, 1], repeat=3)):
@@ -232,6 +461,12 @@ def distributed_piecewise_alignment_pipeline(
         fix_block_coords = np.array(fix_block_coords)
         fix_block_coords_phys = fix_block_coords * fix_spacing
 
+        # the initial transform enters as its affine fit over this block
+        if initial_transform is not None:
+            static_transform_list = static_transform_list + [_block_affine_fit(
+                initial_transform, fix_block_coords, fix_zarr.shape, fix_spacing,
+            )]
+
         # parse initial transforms
         # recenter affines, read deforms, apply transforms to crop coordinates
         new_list = []
@@ -256,6 +491,12 @@ def distributed_piecewise_alignment_pipeline(
             new_list.append(transform)
         static_transform_list = new_list[::-1]
 
+        # blocks that are not aligned only render the initial affine
+        if not aligned[block_index]:
+            record['aligned'] = False
+            affine = static_transform_list[-1]
+            return render([affine] if compact else affine)
+
         # get moving image crop, read moving data 
         mov_block_coords = np.round(mov_block_coords_phys / mov_spacing).astype(int)
         mov_start = np.min(mov_block_coords, axis=0)
@@ -283,107 +524,521 @@ def distributed_piecewise_alignment_pipeline(
 
         # get moving image origin
         mov_origin = mov_start * mov_spacing - fix_block_coords_phys[0]
+        record['read_seconds'] = time.time() - start_time
 
         # run alignment pipeline
+        telemetry = []
         transform = alignment_pipeline(
             fix, mov, fix_spacing, mov_spacing, steps,
             fix_mask=fix_mask, mov_mask=mov_mask,
             mov_origin=mov_origin,
             static_transform_list=static_transform_list,
+            return_format='compact' if compact else 'flatten',
+            telemetry=telemetry,
         )
 
-        # ensure transform is a vector field
-        if transform.shape == (4, 4):
-            transform = ut.matrix_to_displacement_field(
-                transform, fix.shape, spacing=fix_spacing,
+        # flatten step telemetry into the block record
+        record['align_seconds'] = sum(x['seconds'] for x in telemetry)
+        record['fallbacks'] = sum(x.get('fallback', False) for x in telemetry)
+        for iii, step in enumerate(telemetry):
+            for key, value in step.items():
+                if key != 'step': record[f"step{iii}_{step['step']}_{key}"] = value
+
+        # include the initial affine, it is the last static transform
+        if initial_transform is not None and compact:
+            transform = [static_transform_list[-1]] + list(transform)
+        elif initial_transform is not None:
+            transform = compose_transforms(
+                static_transform_list[-1], transform, fix_spacing, fix_spacing,
             )
-
-        # create the standard weight array
-        core = tuple(x - 2*y + 2 for x, y in zip(blocksize, overlaps))
-        pad = tuple((2*y - 1, 2*y - 1) for y in overlaps)
-        weights = np.pad(np.ones(core, dtype=np.float64), pad, mode='linear_ramp')
-
-        # rebalance if any neighbors are missing
-        if not np.all(list(neighbor_flags.values())):
-
-            # define overlap slices
-            slices = {}
-            slices[-1] = tuple(slice(0, 2*y) for y in overlaps)
-            slices[0] = (slice(None),) * len(overlaps)
-            slices[1] = tuple(slice(-2*y, None) for y in overlaps)
-
-            missing_weights = np.zeros_like(weights)
-            for neighbor, flag in neighbor_flags.items():
-                if not flag:
-                    neighbor_region = tuple(slices[-1*b][a] for a, b in enumerate(neighbor))
-                    region = tuple(slices[b][a] for a, b in enumerate(neighbor))
-                    missing_weights[region] += weights[neighbor_region]
-
-            # rebalance the weights
-            weights = weights / (1 - missing_weights)
-            weights[np.isnan(weights)] = 0.  # edges of blocks are 0/0
-            weights = weights.astype(np.float32)
-
-        # crop weights if block is on edge of domain
-        for i in range(3):
-            region = [slice(None),]*3
-            if block_index[i] == 0:
-                region[i] = slice(overlaps[i], None)
-                weights = weights[tuple(region)]
-            if block_index[i] == nblocks[i] - 1:
-                region[i] = slice(None, -overlaps[i])
-                weights = weights[tuple(region)]
-
-        # crop any incomplete blocks (on the ends)
-        if np.any( weights.shape != transform.shape[:-1] ):
-            crop = tuple(slice(0, s) for s in transform.shape[:-1])
-            weights = weights[crop]
-
-        # apply weights
-        transform = transform * weights[..., None]
-
-        # if there's no write path, just return the transform block
-        if not write_path:
-            return transform
-
-        # otherwise, coordinate with neighboring blocks
-        else:
-            # block until locks for all write blocks are acquired
-            lock_strs = []
-            for delta in product((-1, 0, 1,), repeat=3):
-                lock_strs.append(str(tuple(a + b for a, b in zip(block_index, delta))))
-            lock = MultiLock(lock_strs)
-            lock.acquire()
-
-            # write result to disk
-            print(f'WRITING BLOCK {block_index} at {time.ctime(time.time())}', flush=True)
-            output_transform[fix_slices] = output_transform[fix_slices] + transform
-            print(f'FINISHED WRITING BLOCK {block_index} at {time.ctime(time.time())}', flush=True)
-
-            # release the lock
-            lock.release()
-            return True
+        return render(transform)
     # END CLOSURE
 
 
-    # submit all alignments to cluster
-    futures = cluster.client.map(
-        align_single_block, indices,
-        static_transform_list=static_transform_list,
-    )
+    # blend weight templates, computed once and sent to every worker
+    # at most WEIGHT_TEMPLATE_BUDGET bytes, other weights are made on workers
+    weight_templates = {}
+    if not compact:
+        keys = [_weights_key(x[0], x[2], nblocks) for x in indices]
+        weight_templates = _weight_templates(keys, blocksize, overlaps)
+    # a unique key, a content key can be released by a previous call
+    weight_templates = cluster.client.scatter(
+        [weight_templates], broadcast=True, hash=False,
+    )[0]
+
+    # estimate block costs from foreground or from a previous timing report
+    costs = np.array([fractions[x[0]] * aligned[x[0]] for x in indices]) + 0.1
+    if cost_model:
+        seconds = {tuple(r['block_index']): r['seconds'] for r in ut.read_records(cost_model)}
+        measured = np.array([seconds.get(x[0], np.nan) for x in indices])
+        if np.any(~np.isnan(measured)):
+            scale = np.nanmedian(measured / costs)
+            costs = np.where(np.isnan(measured), costs * scale, measured)
+
+    # expensive blocks first, dask priority decreases by cost tier
+    if completed:
+        print(f'RESUMING: {len(completed)} of {len(indices)} blocks complete', flush=True)
+    indices = [indices[iii] for iii in np.argsort(-costs, kind='stable')]
+    todo = [x for x in indices if x[0] not in completed]
+    tiers = np.array_split(np.arange(len(todo)), max(1, min(priority_tiers, len(todo))))
+    futures = []
+    for tier, members in enumerate(tiers):
+        futures += cluster.client.map(
+            align_single_block, [todo[iii] for iii in members],
+            static_transform_list=static_transform_list,
+            weight_templates=weight_templates,
+            priority=len(tiers) - tier,
+            resources=block_resources,
+        )
+    records = []
+
+    # compact results, gather the small per-block transforms
+    if compact:
+        blocks = {}
+        if checkpoint_directory and reuse:
+            blocks = PiecewiseTransform.load(scratch_path('compact')).blocks
+        last_write = time.time()
+        for batch in as_completed(futures, with_results=True, raise_errors=False).batches():
+            for future, result in batch:
+                if future.status != 'finished': continue
+                (block_index, transforms), record = result
+                blocks[block_index] = transforms
+                completed.add(block_index)
+                records.append(record)
+            if checkpoint_directory and time.time() - last_write > checkpoint_interval:
+                partial = PiecewiseTransform(fix.shape, fix_spacing, blocksize, overlaps, blocks)
+                partial.save(scratch_path('compact'))
+                ut.write_manifest(manifest_path, arguments_hash, completed)
+                last_write = time.time()
+        transform = PiecewiseTransform(fix.shape, fix_spacing, blocksize, overlaps, blocks)
+        if checkpoint_directory:
+            transform.save(scratch_path('compact'))
+            ut.write_manifest(manifest_path, arguments_hash, completed)
+        _raise_first_error(futures)
+        if write_path: transform.save(write_path)
+        ut.report_records(records, timing_report, cluster.client)
+        return transform
 
     # handle output for in memory and out of memory cases
-    if not write_path:
-        future_keys = [f.key for f in futures]
+    if not use_scratch:
+
+        # sum overlapping block contributions into disjoint tiles on workers
+        def sum_tile(tile_slices, block_slices, blocks):
+            shape = tuple(x.stop - x.start for x in tile_slices) + (fix_zarr.ndim,)
+            tile = np.zeros(shape, dtype=np.float32)
+            for slices, block in zip(block_slices, blocks):
+                start = [max(x.start, y.start) for x, y in zip(tile_slices, slices)]
+                stop = [min(x.stop, y.stop) for x, y in zip(tile_slices, slices)]
+                tile_crop = tuple(slice(a - x.start, b - x.start) for a, b, x in zip(start, stop, tile_slices))
+                block_crop = tuple(slice(a - y.start, b - y.start) for a, b, y in zip(start, stop, slices))
+                tile[tile_crop] += block[0][block_crop]
+            return tile
+
+        # each tile depends on the blocks in its neighborhood
+        block_futures = {x[0]: (x[1], f) for x, f in zip(indices, futures)}
+        tiles, tile_block_slices, tile_blocks = [], [], []
+        for tile_index in np.ndindex(*nblocks):
+            neighbors = [tuple(a + b for a, b in zip(tile_index, o)) for o in neighbor_offsets]
+            neighbors = [block_futures[x] for x in neighbors if x in block_futures]
+            if neighbors:
+                start = np.array(tile_index) * blocksize
+                stop = np.minimum(fix_zarr.shape, start + blocksize)
+                tiles.append(tuple(slice(a, b) for a, b in zip(start, stop)))
+                tile_block_slices.append([x[0] for x in neighbors])
+                tile_blocks.append([x[1] for x in neighbors])
+        tile_futures = cluster.client.map(sum_tile, tiles, tile_block_slices, tile_blocks)
+
+        # release block references, workers drop blocks once tiles are summed
+        record_futures = cluster.client.map(itemgetter(1), futures)
+        del futures, block_futures, tile_blocks
+
+        # each output voxel is received once
+        tile_keys = {f.key: iii for iii, f in enumerate(tile_futures)}
+        transform = np.zeros(fix.shape + (fix.ndim,), dtype=np.float32)
+        for batch in as_completed(tile_futures, with_results=True).batches():
+            for future, result in batch:
+                transform[tiles[tile_keys[future.key]]] = result
+        records = cluster.client.gather(record_futures)
+        ut.report_records(records, timing_report, cluster.client)
+        return transform
+    else:
+        # record finished blocks, scratch writes are done when futures finish
+        future_keys = {f.key: iii for iii, f in enumerate(futures)}
+        last_write = time.time()
+        for batch in as_completed(futures, with_results=True, raise_errors=False).batches():
+            for future, result in batch:
+                if future.status != 'finished': continue
+                completed.add(todo[future_keys[future.key]][0])
+                records.append(result[1])
+            if checkpoint_directory and time.time() - last_write > checkpoint_interval:
+                ut.write_manifest(manifest_path, arguments_hash, completed)
+                last_write = time.time()
+        if checkpoint_directory:
+            ut.write_manifest(manifest_path, arguments_hash, completed)
+        _raise_first_error(futures)
+        ut.report_records(records, timing_report, cluster.client)
+
+        # sum parity classes into each output chunk, chunks are disjoint
+        def reduce_chunk(chunk_index):
+            start = np.array(chunk_index) * blocksize
+            stop = np.minimum(fix_zarr.shape, start + blocksize)
+            region = tuple(slice(a + y, b + y) for a, b, y in zip(start, stop, overlaps))
+            chunk = np.sum(scratch[(slice(None),) + region], axis=0)
+            if not write_path: return chunk
+            output_transform[tuple(slice(a, b) for a, b in zip(start, stop))] = chunk
+            return True
+
+        chunk_indices = list(np.ndindex(*nblocks))
+        futures = cluster.client.map(reduce_chunk, chunk_indices)
+        if write_path:
+            wait(futures)
+            _raise_first_error(futures)
+            return output_transform
+
+        # checkpointed but in memory result
+        future_keys = {f.key: iii for iii, f in enumerate(futures)}
         transform = np.zeros(fix.shape + (fix.ndim,), dtype=np.float32)
         for batch in as_completed(futures, with_results=True).batches():
             for future, result in batch:
-                iii = future_keys.index(future.key)
-                transform[indices[iii][1]] += result
+                start = np.array(chunk_indices[future_keys[future.key]]) * blocksize
+                stop = np.minimum(fix.shape, start + blocksize)
+                transform[tuple(slice(a, b) for a, b in zip(start, stop))] = result
         return transform
+
+
+def _raise_first_error(futures):
+    """
+    Blocks that fail do not stop the others, so finished blocks can be
+    checkpointed; once all are done the first failure is raised
+    """
+
+    for future in futures:
+        if future.status == 'error': future.result()
+
+
+def _block_affine_fit(field, fix_block_coords, fix_shape, fix_spacing, samples=4096):
+    """
+    Least squares affine approximation, in physical coordinates of the
+    whole fixed image, of a displacement field over one block
+    """
+
+    # read the block region of the field, skip sampled to about samples voxels
+    ratio = np.array(field.shape[:-1]) / fix_shape
+    start = np.round(ratio * fix_block_coords[0]).astype(int)
+    stop = np.maximum(start + 1, np.round(ratio * (fix_block_coords[-1] + 1)).astype(int))
+    stride = max(1, int(np.ceil((np.prod(stop - start) / samples) ** (1 / len(start)))))
+    crop = np.asarray(field[tuple(slice(a, b, stride) for a, b in zip(start, stop))])
+
+    # fit, a translation only if the region is too thin for an affine
+    spacing = np.array(fix_spacing) / ratio
+    coords = (np.indices(crop.shape[:-1]).reshape(3, -1).T * stride + start) * spacing
+    displacements = crop.reshape(-1, 3)
+    matrix = np.eye(4)
+    if np.all(np.array(crop.shape[:-1]) > 1):
+        A = np.hstack((coords, np.ones((len(coords), 1))))
+        fit = np.linalg.lstsq(A, coords + displacements, rcond=None)[0]
+        matrix[:3] = fit.T
     else:
-        all_written = np.all( cluster.client.gather(futures) )
-        return output_transform
+        matrix[:3, -1] = displacements.mean(axis=0)
+    return matrix
+
+
+def _sample_block_mask(mask, shape, blocksize):
+    """
+    Sample a mask over the image domain at the center of every block,
+    returns a boolean array with one entry per block. A mask with one
+    entry per block already is returned as is.
+    """
+
+    mask = np.asarray(mask[...])
+    blocksize = np.array(blocksize)
+    nblocks = np.ceil(np.array(shape) / blocksize).astype(int)
+    if mask.shape == tuple(nblocks): return mask != 0
+    expand = (-1,) + (1,) * len(shape)
+    centers = (np.indices(nblocks) + 0.5) * blocksize.reshape(expand)
+    centers = np.minimum(centers, np.reshape(shape, expand) - 1)
+    ratio = np.reshape(np.array(mask.shape) / shape, expand)
+    return mask[tuple((centers * ratio).astype(int))] != 0
+
+
+def _refine_block_mask(mask, shape, blocksize, child_blocksize):
+    """
+    Map a boolean array over the block grid of `blocksize` to the block
+    grid of `child_blocksize` by integer block index. A child is selected
+    if any block it overlaps is selected.
+    """
+
+    mask = np.asarray(mask) != 0
+    shape, blocksize = np.array(shape), np.array(blocksize)
+    child_blocksize = np.array(child_blocksize)
+    nblocks = np.ceil(shape / child_blocksize).astype(int)
+
+    # first and last parent block overlapped by each child, per axis
+    parents = []
+    for n, b, c, s in zip(nblocks, blocksize, child_blocksize, shape):
+        start = np.arange(n) * c
+        stop = np.minimum(start + c, s) - 1
+        parents.append((start // b, stop // b))
+
+    # a child is selected if any of its parents is
+    child_mask = np.zeros(nblocks, dtype=bool)
+    for choice in product((0, 1), repeat=len(nblocks)):
+        index = [p[x] for p, x in zip(parents, choice)]
+        child_mask |= mask[np.ix_(*index)]
+    return child_mask
+
+
+# bytes of blend weight templates broadcast to each worker
+# every worker holds a copy, so this is kept small; weights for
+# keys beyond the budget are computed on the worker per block
+WEIGHT_TEMPLATE_BUDGET = 32 * 2**20
+
+
+def _weights_key(block_index, neighbor_flags, nblocks):
+    """
+    Blend weights depend only on which neighbors exist and which
+    domain edges a block touches; this is the key for weight templates
+    """
+
+    edges = tuple((x == 0, x == n - 1) for x, n in zip(block_index, nblocks))
+    return tuple(bool(x) for x in neighbor_flags.values()), edges
+
+
+def _block_weights(key, blocksize, overlaps):
+    """
+    Linear blending weights for one block, rebalanced for missing neighbors
+    and cropped to the part of the block inside the image domain
+    """
+
+    # create the standard weight array
+    flags, edges = key
+    core = tuple(x - 2*y + 2 for x, y in zip(blocksize, overlaps))
+    pad = tuple((2*y - 1, 2*y - 1) for y in overlaps)
+    weights = np.pad(np.ones(core, dtype=np.float32), pad, mode='linear_ramp')
+
+    # rebalance if any neighbors are missing
+    if not np.all(flags):
+
+        # define overlap slices
+        slices = {}
+        slices[-1] = tuple(slice(0, 2*y) for y in overlaps)
+        slices[0] = (slice(None),) * len(overlaps)
+        slices[1] = tuple(slice(-2*y, None) for y in overlaps)
+
+        missing_weights = np.zeros_like(weights)
+        for neighbor, flag in zip(product([-1, 0, 1], repeat=3), flags):
+            if not flag:
+                neighbor_region = tuple(slices[-1*b][a] for a, b in enumerate(neighbor))
+                region = tuple(slices[b][a] for a, b in enumerate(neighbor))
+                missing_weights[region] += weights[neighbor_region]
+
+        # rebalance the weights
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(weights, 1 - missing_weights, out=weights)
+        weights[~np.isfinite(weights)] = 0.  # edges of blocks are 0/0
+
+    # crop weights if block is on edge of domain
+    for i, (first, last) in enumerate(edges):
+        region = [slice(None),]*3
+        if first:
+            region[i] = slice(overlaps[i], None)
+            weights = weights[tuple(region)]
+        if last:
+            region[i] = slice(None, weights.shape[i] - overlaps[i])
+            weights = weights[tuple(region)]
+    return weights
+
+
+def _weight_templates(keys, blocksize, overlaps, budget=WEIGHT_TEMPLATE_BUDGET):
+    """
+    Weights for the most common keys shared by at least two blocks,
+    up to budget bytes. The total is at most the template size (about
+    the padded blocksize in float32) times the number of distinct keys.
+    """
+
+    templates, nbytes = {}, 0
+    for key, count in Counter(keys).most_common():
+        if count < 2: break
+        weights = _block_weights(key, blocksize, overlaps)
+        if nbytes + weights.nbytes > budget: break
+        templates[key] = weights
+        nbytes += weights.nbytes
+    return templates
+
+
+def _get_weights(templates, key, blocksize, overlaps, shape):
+    """
+    Weights from a template, or computed if there is no template,
+    cropped to blocks that are incomplete on the domain ends
+    """
+
+    weights = templates.get(key)
+    if weights is None: weights = _block_weights(key, blocksize, overlaps)
+    return weights[tuple(slice(0, s) for s in shape)]
+
+
+def _render_transforms(transforms, shape, spacing, origin):
+    """
+    Dense displacement field for a list of compact transforms
+    on a grid with the given shape, spacing, and origin
+    """
+
+    # affines only, compose and offset the translation
+    if all(x.shape == (4, 4) for x in transforms):
+        matrix = compose_transform_list(list(transforms), spacing)
+        matrix = np.copy(matrix)
+        matrix[:3, -1] += np.matmul(matrix[:3, :3], origin) - origin
+        return ut.matrix_to_displacement_field(matrix, shape, spacing=spacing)
+
+    # otherwise let sitk evaluate the composite transform
+    composite = ut.transform_list_to_composite_transform(list(transforms))
+    return ut.bspline_to_displacement_field(
+        composite, tuple(int(x) for x in shape),
+        spacing=tuple(float(x) for x in spacing),
+        origin=tuple(float(x) for x in origin),
+    )
+
+
+class PiecewiseTransform:
+    """
+    A displacement field stored as compact per-block transforms. Indexing
+    renders and blends only the blocks that overlap the requested region,
+    so it can be used anywhere a displacement field array is expected.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the fixed image
+
+    spacing : 1d array
+        The voxel spacing of the fixed image
+
+    blocksize : 1d array
+        The shape of blocks in voxels
+
+    overlaps : 1d array
+        The overlap on each side of a block in voxels
+
+    blocks : dict
+        Maps block indices to lists of transforms in block local coordinates;
+        4x4 affine matrices or b-spline parameters
+    """
+
+    def __init__(self, shape, spacing, blocksize, overlaps, blocks):
+        self.shape = tuple(shape) + (len(shape),)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(np.float32)
+        self.spacing = np.array(spacing)
+        self.blocksize = np.array(blocksize)
+        self.overlaps = np.array(overlaps)
+        self.blocks = blocks
+        self.nblocks = np.ceil(np.array(shape) / self.blocksize).astype(int)
+        self._templates = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_templates'] = {}
+        return state
+
+    def __getitem__(self, key):
+
+        # standardize the region, only slices are supported
+        if not isinstance(key, tuple): key = (key,)
+        if Ellipsis in key:
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i+1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        region = [slice(*k.indices(s)) for k, s in zip(key[:-1], self.shape)]
+        start = np.array([r.start for r in region])
+        stop = np.array([r.stop for r in region])
+        field = np.zeros(tuple(stop - start) + (self.ndim - 1,), dtype=np.float32)
+
+        # all blocks whose overlaps touch the region
+        bs, ov = self.blocksize, self.overlaps
+        lo = np.maximum(0, (start - ov) // bs)
+        hi = np.minimum(self.nblocks, -(-(stop + ov) // bs))
+        offsets = list(product([-1, 0, 1], repeat=3))
+        for block_index in product(*[range(a, b) for a, b in zip(lo, hi)]):
+            if block_index not in self.blocks: continue
+
+            # block extent and its intersection with the region
+            block_start = np.maximum(0, np.array(block_index) * bs - ov)
+            block_stop = np.minimum(self.shape[:-1], (np.array(block_index) + 1) * bs + ov)
+            a, b = np.maximum(start, block_start), np.minimum(stop, block_stop)
+            if np.any(b <= a): continue
+
+            # render the intersection, weight, and accumulate
+            flags = {o: tuple(x + y for x, y in zip(block_index, o)) in self.blocks for o in offsets}
+            weights_key = _weights_key(block_index, flags, self.nblocks)
+            if weights_key not in self._templates:
+                self._templates[weights_key] = _block_weights(weights_key, bs, ov)
+            weights = _get_weights(
+                self._templates, weights_key, bs, ov, block_stop - block_start,
+            )
+            crop = tuple(slice(x, y) for x, y in zip(a - block_start, b - block_start))
+            block = _render_transforms(
+                self.blocks[block_index], tuple(b - a), self.spacing,
+                (a - block_start) * self.spacing,
+            )
+            field[tuple(slice(x, y) for x, y in zip(a - start, b - start))] += block * weights[crop][..., None]
+
+        # apply any step or vector component selection
+        steps = tuple(slice(None, None, k.step) for k in key[:-1])
+        return field[steps + (key[-1],)]
+
+    def save(self, path):
+        """
+        Write to a folder; metadata.json and transforms.npz
+
+        Parameters
+        ----------
+        path : string
+            The folder to write to, created if it does not exist
+        """
+
+        os.makedirs(path, exist_ok=True)
+        indices = sorted(self.blocks.keys())
+        arrays = {}
+        for iii, index in enumerate(indices):
+            for jjj, transform in enumerate(self.blocks[index]):
+                arrays[f'{iii}_{jjj}'] = transform
+        np.savez(os.path.join(path, 'transforms.npz'), **arrays)
+        metadata = {
+            'shape': [int(x) for x in self.shape[:-1]],
+            'spacing': [float(x) for x in self.spacing],
+            'blocksize': [int(x) for x in self.blocksize],
+            'overlaps': [int(x) for x in self.overlaps],
+            'indices': [[int(x) for x in index] for index in indices],
+            'counts': [len(self.blocks[index]) for index in indices],
+        }
+        with open(os.path.join(path, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+    @staticmethod
+    def load(path):
+        """
+        Read a PiecewiseTransform written by PiecewiseTransform.save
+
+        Parameters
+        ----------
+        path : string
+            The folder written by PiecewiseTransform.save
+
+        Returns
+        -------
+        transform : PiecewiseTransform
+        """
+
+        with open(os.path.join(path, 'metadata.json')) as f:
+            metadata = json.load(f)
+        arrays = np.load(os.path.join(path, 'transforms.npz'))
+        blocks = {}
+        for iii, (index, count) in enumerate(zip(metadata['indices'], metadata['counts'])):
+            blocks[tuple(index)] = [arrays[f'{iii}_{jjj}'] for jjj in range(count)]
+        return PiecewiseTransform(
+            metadata['shape'], metadata['spacing'],
+            metadata['blocksize'], metadata['overlaps'], blocks,
+        )
 
 
 # TODO: THIS FUNCTION CURRENTLY DOES NOT WORK FOR LARGER THAN MEMORY TRANSFORMS
@@ -401,6 +1056,8 @@ def nested_distributed_piecewise_alignment_pipeline(
     cluster_kwargs={},
     temporary_directory=None,
     write_path=None,
+    checkpoint_directory=None,
+    pyramid=False,
     **kwargs,
 ):
     """
@@ -470,13 +1127,35 @@ def nested_distributed_piecewise_alignment_pipeline(
         Temporary files are created during alignment. The temporary files will be
         in their own folder within the `temporary_directory`. The default is the
         current directory. Temporary files are removed if the function completes
-        successfully.
+        successfully. zarr, N5, HDF5, and memory mapped inputs are read in place,
+        only inputs held in memory are written to temporary files.
 
     write_path : string (default: None)
         If the transforms found by this function are too large to fit into main
         process memory, set this parameter to a folder where the transforms
         can be written to disk as separate zarr files
 
+    checkpoint_directory : string (default: None)
+        If given, copies of in memory inputs are kept here and each level of
+        the schedule is checkpointed in its own subfolder. See the same argument
+        of `distributed_piecewise_alignment_pipeline`. A manifest of finished
+        levels records the inputs and schedule; if they changed, the copies
+        and the level checkpoints are not reused.
+
+    pyramid : bool (default: False)
+        If True, each level of the schedule is run on a skip sampled view of the
+        inputs matched to its blocksize. The sampling factor of a level is its
+        blocksize divided by the smallest blocksize in the schedule, so every
+        level aligns blocks of about the same number of voxels and coarse levels
+        cost a fraction of the finest one. The views are lazy; no downsampled
+        copies of the inputs are written. The result of each level is given
+        to the next level as its `initial_transform`, so each block starts
+        from the affine fit of the coarse field over that block rather than
+        warping through the whole coarse field, and the level result replaces
+        the coarse one. Blocks a level does not align (e.g. background) keep
+        the affine fit of the coarse field, so finer levels only refine the
+        coarse result. Masks are sampled with the same factors as the images.
+
     kwargs : any additional arguments
         Passed to `distributed_piecewise_alignment_pipeline`
 
@@ -486,53 +1165,356 @@ def nested_distributed_piecewise_alignment_pipeline(
         Composition of all alignments into a single displacement vector field.
     """
 
-    # temporary file paths and create zarr images
-    temporary_directory = tempfile.TemporaryDirectory(
-        prefix='.', dir=temporary_directory or os.getcwd(),
+    # plan chunks for the smallest blocksize in the schedule
+    smallest = np.min([x[0] for x in schedule], axis=0)
+    _, _, zarr_blocks, _ = ut.plan_blocks(
+        fix.shape, smallest, kwargs.get('overlap', 0.5), fix.dtype.itemsize,
+        chunks=getattr(fix, 'chunks', None),
     )
-    zarr_blocks = [128,] * fix.ndim
-    fix_zarr_path = temporary_directory.name + '/fix.zarr'
-    mov_zarr_path = temporary_directory.name + '/mov.zarr'
-    fix_mask_zarr_path = temporary_directory.name + '/fix_mask.zarr'
-    mov_mask_zarr_path = temporary_directory.name + '/mov_mask.zarr'
-    fix_zarr = ut.numpy_to_zarr(fix, zarr_blocks, fix_zarr_path)
-    mov_zarr = ut.numpy_to_zarr(mov, zarr_blocks, mov_zarr_path)
+
+    # share inputs with workers, only in memory data is copied to disk
+    temporary_directory = ut.LazyTemporaryDirectory(temporary_directory)
+    scratch_path = temporary_directory.path
+
+    # copies are reused only if the manifest shows they are from the same
+    # inputs and schedule; otherwise levels are not resumed either
+    completed, reuse = set(), False
+    if checkpoint_directory:
+        os.makedirs(checkpoint_directory, exist_ok=True)
+        scratch_path = lambda name: os.path.join(checkpoint_directory, name)
+        manifest_path = scratch_path('manifest.json')
+        fingerprint = lambda x: None if x is None else ut.array_fingerprint(x)
+        arguments_hash = ut.hash_arguments(
+            fingerprint(fix), fingerprint(mov), fix_spacing, mov_spacing,
+            schedule, pyramid, kwargs,
+            fingerprint(fix_mask), fingerprint(mov_mask),
+            [x if x.shape == (4, 4) else fingerprint(x) for x in static_transform_list or []],
+        )
+        completed = ut.read_manifest(manifest_path, arguments_hash)
+        reuse = len(completed) > 0
+        if not reuse:
+            for iii in range(len(schedule)):
+                path = os.path.join(checkpoint_directory, f'level{iii}', 'manifest.json')
+                if os.path.exists(path): os.remove(path)
+    fix_zarr = ut.shared_array(fix, zarr_blocks, scratch_path('fix.zarr'), reuse)
+    mov_zarr = ut.shared_array(mov, zarr_blocks, scratch_path('mov.zarr'), reuse)
     fix_mask_zarr = None
-    if fix_mask is not None: fix_mask_zarr = ut.numpy_to_zarr(fix_mask, zarr_blocks, fix_mask_zarr_path)
+    if fix_mask is not None:
+        chunks = ut.relative_chunks(zarr_blocks, fix.shape, fix_mask.shape)
+        path = scratch_path('fix_mask.zarr')
+        fix_mask_zarr = ut.shared_array(fix_mask, chunks, path, reuse)
     mov_mask_zarr = None
-    if mov_mask is not None: mov_mask_zarr = ut.numpy_to_zarr(mov_mask, zarr_blocks, mov_mask_zarr_path)
+    if mov_mask is not None:
+        chunks = ut.relative_chunks(zarr_blocks, mov.shape, mov_mask.shape)
+        path = scratch_path('mov_mask.zarr')
+        mov_mask_zarr = ut.shared_array(mov_mask, chunks, path, reuse)
 
-    # zarr files for initial deformations
+    # share initial deformations
+    if static_transform_list is None: static_transform_list = []
     new_list = []
     for iii, transform in enumerate(static_transform_list):
         if transform.shape != (4, 4) and len(transform.shape) != 1:
-            path = temporary_directory.name + f'/deform{iii}.zarr'
-            transform = ut.numpy_to_zarr(transform, tuple(zarr_blocks) + (transform.shape[-1],), path)
+            chunks = ut.relative_chunks(zarr_blocks, fix.shape, transform.shape)
+            path = scratch_path(f'deform{iii}.zarr')
+            transform = ut.shared_array(transform, chunks, path, reuse)
         new_list.append(transform)
     static_transform_list = new_list
 
     # loop over the schedule
+    fix_spacing, mov_spacing = np.array(fix_spacing), np.array(mov_spacing)
+    previous_spacing = fix_spacing
     for iii, (blocksize, steps) in enumerate(schedule):
+
+        # inputs, spacings, and blocksize for this level
+        level_fix, level_mov = fix_zarr, mov_zarr
+        level_fix_mask, level_mov_mask = fix_mask_zarr, mov_mask_zarr
+        level_fix_spacing, level_mov_spacing = fix_spacing, mov_spacing
+        if pyramid:
+            factors = np.maximum(np.round(np.array(blocksize) / smallest), 1).astype(int)
+            if np.any(factors > 1):
+                level_fix = ut.SkipSampledArray(fix_zarr, factors)
+                level_mov = ut.SkipSampledArray(mov_zarr, factors)
+                if fix_mask_zarr is not None:
+                    level_fix_mask = ut.SkipSampledArray(fix_mask_zarr, factors)
+                if mov_mask_zarr is not None:
+                    level_mov_mask = ut.SkipSampledArray(mov_mask_zarr, factors)
+                level_fix_spacing = fix_spacing * factors
+                level_mov_spacing = mov_spacing * factors
+                blocksize = np.ceil(np.array(blocksize) / factors).astype(int)
+                print(f'LEVEL {iii}: sampling factors {factors.tolist()}, '
+                      f'shape {level_fix.shape}', flush=True)
+
+        # with a pyramid the previous level is a per block initial affine
+        initial_transform = None
+        if pyramid and iii > 0:
+            initial_transform = static_transform_list.pop()
+
         local_write_path = None
-        if write_path: local_write_path = write_path + '/{iii}.zarr'
+        if write_path: local_write_path = write_path + f'/{iii}.zarr'
+        level_checkpoint = None
+        if checkpoint_directory:
+            level_checkpoint = os.path.join(checkpoint_directory, f'level{iii}')
         deform = distributed_piecewise_alignment_pipeline(
-            fix_zarr, mov_zarr, fix_spacing, mov_spacing,
+            level_fix, level_mov, level_fix_spacing, level_mov_spacing,
             steps, blocksize,
             static_transform_list=static_transform_list,
-            fix_mask=fix_mask_zarr,
-            mov_mask=mov_mask_zarr,
+            fix_mask=level_fix_mask,
+            mov_mask=level_mov_mask,
             write_path=local_write_path,
+            checkpoint_directory=level_checkpoint,
+            initial_transform=initial_transform,
             cluster=cluster,
             **kwargs,
         )
+        if checkpoint_directory:
+            completed.add((iii,))
+            ut.write_manifest(manifest_path, arguments_hash, completed)
         # TODO: THIS DOES NOT WORK WITH LARGER THAN MEMORY TRANSFORMS
-        if iii > 0:
+        if iii > 0 and not pyramid:
             deform = compose_transforms(
                 static_transform_list.pop(), deform,
-                fix_spacing, fix_spacing,
+                previous_spacing, level_fix_spacing,
             )
         static_transform_list.append(deform)
+        previous_spacing = level_fix_spacing
+
+    # bring a coarse result to full resolution
+    deform = static_transform_list.pop()
+    if deform.shape[:-1] != tuple(fix.shape):
+        deform = compose_transforms(
+            deform, np.zeros(fix.shape + (fix.ndim,), dtype=np.float32),
+            previous_spacing, fix_spacing,
+        )
+    static_transform_list.append(deform)
 
     # return in the requested format
     return static_transform_list.pop()
 
+
+@cluster
+def adaptive_distributed_piecewise_alignment_pipeline(
+    fix,
+    mov,
+    fix_spacing,
+    mov_spacing,
+    steps,
+    blocksize,
+    min_blocksize,
+    threshold=0.5,
+    radius=None,
+    overlap=0.5,
+    static_transform_list=None,
+    fix_mask=None,
+    mov_mask=None,
+    foreground_percentage=0.5,
+    cluster=None,
+    cluster_kwargs={},
+    temporary_directory=None,
+    **kwargs,
+):
+    """
+    Piecewise alignment with adaptive block refinement. All blocks are first
+    aligned at `blocksize`. The moving image is then resampled through the
+    result and the local correlation coefficient between fixed and resampled
+    moving is computed in every block. Blocks scoring below `threshold` are
+    split in half along every axis and only those children are aligned again,
+    starting from the current result. This repeats until no block scores
+    below `threshold` or the next blocksize would be smaller than
+    `min_blocksize`. Compute is concentrated where deformation is complex.
+
+    Parameters
+    ----------
+    fix : ndarray
+        the fixed image
+
+    mov : ndarray
+        the moving image; if `static_transform_list` is None then
+        `fix.shape` must equal `mov.shape`
+
+    fix_spacing : 1d array
+        The spacing in physical units (e.g. mm or um) between voxels
+        of the fixed image.
+        Length must equal `fix.ndim`
+
+    mov_spacing : 1d array
+        The spacing in physical units (e.g. mm or um) between voxels
+        of the moving image.
+        Length must equal `mov.ndim`
+
+    steps : list of tuples in this form [(str, dict), (str, dict), ...]
+        The alignment steps run in every block at every level. See
+        `distributed_piecewise_alignment_pipeline`.
+
+    blocksize : iterable
+        The shape of blocks in voxels at the first (coarsest) level
+
+    min_blocksize : iterable
+        Blocks are not split below this shape in voxels
+
+    threshold : float (default: 0.5)
+        Blocks whose mean local correlation coefficient after alignment is
+        below this value are refined. See
+        `bigstream.metrics.local_correlation_coefficient`, values are in [0, 1].
+
+    radius : float (default: None)
+        The neighborhood half width in physical units for the local
+        correlation coefficient. If None, four voxels of the largest spacing.
+
+    overlap : float in range [0, 1] (default: 0.5)
+        Block overlap size as a percentage of block size
+
+    static_transform_list : list of numpy arrays (default: [])
+        Transforms applied to moving image before applying query transform
+        Assumed to have the same domain as the fixed image, though sampling
+        can be different. I.e. the origin and span are the same (in physical
+        units) but the number of voxels can be different.
+
+    fix_mask : binary ndarray (default: None)
+        A mask limiting metric evaluation region of the fixed image
+        Assumed to have the same domain as the fixed image, though sampling
+        can be different. Blocks below `foreground_percentage` are neither
+        aligned nor refined.
+
+    mov_mask : binary ndarray (default: None)
+        A mask limiting metric evaluation region of the moving image
+        Assumed to have the same domain as the moving image, though sampling
+        can be different.
+
+    foreground_percentage : float in range [0, 1] (default: 0.5)
+        See `distributed_piecewise_alignment_pipeline`
+
+    cluster : ClusterWrap.cluster object (default: None)
+        Only set if you have constructed your own static cluster. The default behavior
+        is to construct a cluster for the duration of this function, then close it
+        when the function is finished.
+
+    cluster_kwargs : dict (default: {})
+        Arguments passed to ClusterWrap.cluster
+        If working with an LSF cluster, this will be
+        ClusterWrap.janelia_lsf_cluster. If on a workstation
+        this will be ClusterWrap.local_cluster.
+        This is how distribution parameters are specified.
+
+    temporary_directory : string (default: None)
+        Temporary files are created during alignment. The temporary files will be
+        in their own folder within the `temporary_directory`. The default is the
+        current directory. Temporary files are removed if the function completes
+        successfully. zarr, N5, HDF5, and memory mapped inputs are read in place,
+        only inputs held in memory are written to temporary files.
+
+    kwargs : any additional arguments
+        Passed to `distributed_piecewise_alignment_pipeline`
+
+    Returns
+    -------
+    field : nd array
+        Composition of all levels into a single displacement vector field.
+    """
+
+    # defaults
+    fix_spacing, mov_spacing = np.array(fix_spacing), np.array(mov_spacing)
+    if static_transform_list is None: static_transform_list = []
+    if radius is None: radius = 4 * np.max(fix_spacing)
+    blocksize = np.array(blocksize)
+    min_blocksize = np.array(min_blocksize)
+
+    # share inputs with workers once for all levels
+    _, _, zarr_blocks, _ = ut.plan_blocks(
+        fix.shape, min_blocksize, overlap, fix.dtype.itemsize,
+        chunks=getattr(fix, 'chunks', None),
+    )
+    temporary_directory = ut.LazyTemporaryDirectory(temporary_directory)
+    fix_zarr = ut.shared_array(fix, zarr_blocks, temporary_directory.path('fix.zarr'))
+    mov_zarr = ut.shared_array(mov, zarr_blocks, temporary_directory.path('mov.zarr'))
+    fix_mask_zarr = None
+    if fix_mask is not None:
+        chunks = ut.relative_chunks(zarr_blocks, fix.shape, fix_mask.shape)
+        path = temporary_directory.path('fix_mask.zarr')
+        fix_mask_zarr = ut.shared_array(fix_mask, chunks, path)
+    mov_mask_zarr = None
+    if mov_mask is not None:
+        chunks = ut.relative_chunks(zarr_blocks, mov.shape, mov_mask.shape)
+        path = temporary_directory.path('mov_mask.zarr')
+        mov_mask_zarr = ut.shared_array(mov_mask, chunks, path)
+
+    # closure to score one block of the resampled moving image
+    def score_block(slices, warped_zarr):
+        fix_block = fix_zarr[slices]
+        warped_block = warped_zarr[slices]
+        if np.ptp(fix_block) == 0 or np.ptp(warped_block) == 0:
+            return np.nan
+        return local_correlation_coefficient(
+            fix_block, warped_block, fix_spacing, radius,
+        )
+
+    # refine until no block is poor or blocks would be too small
+    # the base pipeline uses blocksize exactly, so blocks scored and
+    # selected here are the blocks it aligns at the next level
+    field, block_mask, level = None, None, 0
+    while True:
+
+        # align the selected blocks on top of the current result
+        transform_list = static_transform_list + ([field] if field is not None else [])
+        deform = distributed_piecewise_alignment_pipeline(
+            fix_zarr, mov_zarr, fix_spacing, mov_spacing,
+            steps, blocksize,
+            overlap=overlap,
+            fix_mask=fix_mask_zarr,
+            mov_mask=mov_mask_zarr,
+            foreground_percentage=foreground_percentage,
+            static_transform_list=transform_list,
+            block_mask=block_mask,
+            cluster=cluster,
+            temporary_directory=temporary_directory.name,
+            **kwargs,
+        )
+        # TODO: THIS DOES NOT WORK WITH LARGER THAN MEMORY TRANSFORMS
+        if field is not None:
+            deform = compose_transforms(field, deform, fix_spacing, fix_spacing)
+        field = deform
+
+        # stop if blocks cannot be split further
+        next_blocksize = np.ceil(blocksize / 2).astype(int)
+        if np.any(next_blocksize < min_blocksize): break
+
+        # candidates are the blocks aligned at this level
+        nblocks = np.ceil(np.array(fix.shape) / blocksize).astype(int)
+        candidates = np.ones(nblocks, dtype=bool)
+        if fix_mask_zarr is not None:
+            fractions = ut.block_foreground_fractions(fix_mask_zarr, fix.shape, blocksize)
+            candidates &= fractions >= foreground_percentage
+        if block_mask is not None:
+            candidates &= block_mask
+
+        # resample moving image through the current result and score blocks
+        warped = distributed_apply_transform(
+            fix_zarr, mov_zarr, fix_spacing, mov_spacing,
+            static_transform_list + [field], blocksize,
+            overlap=overlap,
+            temporary_directory=temporary_directory.name,
+            cluster=cluster,
+        )
+        path = temporary_directory.path(f'warped{level}.zarr')
+        warped_zarr = ut.shared_array(warped, zarr_blocks, path)
+        block_indices = np.argwhere(candidates)
+        slices = [
+            tuple(slice(int(x*b), int(min((x+1)*b, s))) for x, b, s in zip(i, blocksize, fix.shape))
+            for i in block_indices
+        ]
+        futures = cluster.client.map(score_block, slices, warped_zarr=warped_zarr)
+        scores = np.full(nblocks, np.nan)
+        scores[tuple(block_indices.T)] = cluster.client.gather(futures)
+
+        # select poor blocks for refinement
+        with np.errstate(invalid='ignore'):
+            selected = candidates & (scores < threshold)
+        print(f'LEVEL {level}: blocksize {blocksize.tolist()}, '
+              f'median LCC {np.nanmedian(scores) if block_indices.size else np.nan:.3f}, '
+              f'refining {selected.sum()} of {candidates.sum()} blocks', flush=True)
+        if not np.any(selected): break
+        block_mask = _refine_block_mask(selected, fix.shape, blocksize, next_blocksize)
+        blocksize, level = next_blocksize, level + 1
+
+    # return the composed result
+    return field
+
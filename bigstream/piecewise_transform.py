@@ -1,11 +1,11 @@
 import numpy as np
 from itertools import product
 import bigstream.utility as ut
-import os, tempfile
+import os
 from ClusterWrap.decorator import cluster
-import dask.array as da
 import zarr
 import bigstream.transform as bs_transform
+from scipy.ndimage import maximum_filter
 
 
 @cluster
@@ -18,6 +18,11 @@ def distributed_apply_transform(
     overlap=0.5,
     dataset_path=None,
     temporary_directory=None,
+    mov_foreground_mask=None,
+    skip_missing_chunks=False,
+    resume=False,
+    max_pending_blocks=None,
+    round_blocksize=False,
     cluster=None,
     cluster_kwargs={},
     **kwargs,
@@ -26,6 +31,13 @@ def distributed_apply_transform(
     Resample a larger-than-memory moving image onto a fixed image through a
     list of transforms
 
+    Blocks are submitted to the cluster in bounded batches and each block
+    writes its result directly to its own chunk of the output zarr array.
+
+    Blocks whose moving image footprint contains no data can be skipped.
+    Their output chunks are never written, so they read as the zarr fill
+    value (zero) and take no space on disk.
+
     Parameters
     ----------
     fix : zarr array
@@ -48,7 +60,9 @@ def distributed_apply_transform(
         Zarr arrays work just fine.
 
     blocksize : iterable
-        The shape of blocks in voxels
+        The shape of blocks in voxels. Temporary zarr copies of in memory
+        inputs are chunked to match the blocks and overlaps. Chunked inputs
+        are read through their native chunks; see `round_blocksize`.
 
     write_path : string (default: None)
         Location on disk to write the resampled data as a zarr array
@@ -61,7 +75,32 @@ def distributed_apply_transform(
 
     temporary_directory : string (default: None)
         A parent directory for temporary data written to disk during computation
-        If None then the current directory is used
+        If None then the current directory is used. zarr, N5, HDF5, and memory
+        mapped inputs are read in place, only inputs held in memory are copied.
+
+    mov_foreground_mask : binary ndarray (default: None)
+        A (typically low resolution) foreground mask for the moving image.
+        Assumed to have the same domain as the moving image, though sampling
+        can be different. Blocks whose moving image footprint contains no
+        foreground are not resampled.
+
+    skip_missing_chunks : bool (default: False)
+        Only valid if mov is a zarr array. Blocks whose moving image footprint
+        touches only chunks that were never written to disk are not resampled.
+
+    resume : bool (default: False)
+        Only valid if write_path is not None. If a compatible output array
+        already exists at write_path, blocks whose output chunk is already
+        on disk are not recomputed. Use this to finish an interrupted run.
+
+    max_pending_blocks : int (default: None)
+        The maximum number of blocks submitted to the cluster at once.
+        If None, four times the total number of worker threads is used.
+
+    round_blocksize : bool (default: False)
+        If True and `fix_zarr` is chunked, round the blocksize to a multiple
+        of its native chunk shape so block cores start on chunk boundaries.
+        This also sets the output chunk shape.
 
     cluster : ClusterWrap.cluster object (default: None)
         Only set if you have constructed your own static cluster. The default behavior
@@ -85,23 +124,31 @@ def distributed_apply_transform(
         this will be a zarr array. Otherwise it is a numpy array.
     """
 
-    # temporary file paths and ensure inputs are zarr
-    temporary_directory = tempfile.TemporaryDirectory(
-        prefix='.', dir=temporary_directory or os.getcwd(),
+    # chunk metadata is only meaningful for data that is already zarr
+    if skip_missing_chunks and not isinstance(mov_zarr, zarr.Array):
+        print('skip_missing_chunks requires a zarr moving image, ignoring', flush=True)
+        skip_missing_chunks = False
+
+    # plan blocks and chunks together, reuse native chunks of chunked inputs
+    blocksize, overlap, zarr_blocks, _ = ut.plan_blocks(
+        fix_zarr.shape, blocksize, overlap, fix_zarr.dtype.itemsize,
+        chunks=getattr(fix_zarr, 'chunks', None),
+        round_to_chunks=round_blocksize,
     )
-    fix_zarr_path = temporary_directory.name + '/fix.zarr'
-    mov_zarr_path = temporary_directory.name + '/mov.zarr'
-    zarr_blocks = (128,)*fix_zarr.ndim
-    fix_zarr = ut.numpy_to_zarr(fix_zarr, zarr_blocks, fix_zarr_path)
-    mov_zarr = ut.numpy_to_zarr(mov_zarr, zarr_blocks, mov_zarr_path)
 
-    # ensure all deforms are zarr
+    # share inputs with workers, only in memory data is copied to disk
+    temporary_directory = ut.LazyTemporaryDirectory(temporary_directory)
+    fix_shape = fix_zarr.shape
+    fix_zarr = ut.shared_array(fix_zarr, zarr_blocks, temporary_directory.path('fix.zarr'))
+    mov_zarr = ut.shared_array(mov_zarr, zarr_blocks, temporary_directory.path('mov.zarr'))
+
+    # share all deforms
     new_list = []
-    zarr_blocks = (128,)*3 + (3,)
     for iii, transform in enumerate(transform_list):
         if transform.shape != (4, 4):
-            zarr_path = temporary_directory.name + f'/deform{iii}.zarr'
-            transform = ut.numpy_to_zarr(transform, zarr_blocks, zarr_path)
+            chunks = ut.relative_chunks(zarr_blocks, fix_shape, transform.shape)
+            path = temporary_directory.path(f'deform{iii}.zarr')
+            transform = ut.shared_array(transform, chunks, path)
         new_list.append(transform)
     transform_list = new_list
 
@@ -111,27 +158,69 @@ def distributed_apply_transform(
     if not isinstance(kwargs['transform_spacing'], tuple):
         kwargs['transform_spacing'] = (kwargs['transform_spacing'],) * len(transform_list)
 
-    # get overlap and number of blocks
-    blocksize = np.array(blocksize)
-    overlap = np.round(blocksize * overlap).astype(int)  # NOTE: default overlap too big?
+    # get number of blocks
     nblocks = np.ceil(np.array(fix_zarr.shape) / blocksize).astype(int)
 
-    # store block coordinates in a dask array
-    block_coords = np.empty(nblocks, dtype=tuple)
-    for (i, j, k) in np.ndindex(*nblocks):
-        start = blocksize * (i, j, k) - overlap
-        stop = start + blocksize + 2 * overlap
-        start = np.maximum(0, start)
-        stop = np.minimum(fix_zarr.shape, stop)
-        block_coords[i, j, k] = tuple(slice(x, y) for x, y in zip(start, stop))
-    block_coords = da.from_array(block_coords, chunks=(1,)*block_coords.ndim)
+    # zarr file for output, one chunk per block so blocks write independently
+    # empty chunks are not written, skipped blocks are left as the fill value
+    resuming = False
+    if write_path:
+        if resume and os.path.isfile(os.path.join(write_path, dataset_path or '', '.zarray')):
+            output = zarr.open(write_path, 'r+', path=dataset_path, write_empty_chunks=False)
+            resuming = isinstance(output, zarr.Array)
+            resuming = resuming and output.shape == fix_zarr.shape
+            resuming = resuming and output.chunks == tuple(blocksize)
+        if not resuming:
+            output = ut.create_zarr(
+                write_path, fix_zarr.shape, tuple(blocksize), fix_zarr.dtype,
+                dataset_path=dataset_path, write_empty_chunks=False,
+            )
+    else:
+        output = np.zeros(fix_zarr.shape, dtype=fix_zarr.dtype)
+
+    # block coordinates: the core written to output, and core plus overlap
+    blocks = []
+    for index in np.ndindex(*nblocks):
+        if resuming and output._chunk_key(index) in output.chunk_store: continue
+        start = blocksize * index
+        stop = np.minimum(fix_zarr.shape, start + blocksize)
+        core_slices = tuple(slice(x, y) for x, y in zip(start, stop))
+        start = np.maximum(0, start - overlap)
+        stop = np.minimum(fix_zarr.shape, stop + overlap)
+        fix_slices = tuple(slice(x, y) for x, y in zip(start, stop))
+        blocks.append((core_slices, fix_slices))
+
+    # determine if a region of the moving image contains any data
+    def has_foreground(mov_slices):
+
+        # footprint falls entirely outside the moving image
+        if np.any([s.stop <= s.start for s in mov_slices]):
+            return False
+
+        # check the low resolution foreground mask
+        if mov_foreground_mask is not None:
+            ratio = np.array(mov_foreground_mask.shape) / mov_zarr.shape
+            start = np.floor([s.start * r for s, r in zip(mov_slices, ratio)]).astype(int)
+            stop = np.ceil([s.stop * r for s, r in zip(mov_slices, ratio)]).astype(int)
+            mask_slices = tuple(slice(a, b) for a, b in zip(start, stop))
+            if not np.any(mov_foreground_mask[mask_slices]):
+                return False
+
+        # check which chunks exist on disk
+        if skip_missing_chunks:
+            chunks = mov_zarr.chunks
+            ranges = [range(s.start // c, (s.stop - 1) // c + 1) for s, c in zip(mov_slices, chunks)]
+            keys = (mov_zarr._chunk_key(x) for x in product(*ranges))
+            if not any(key in mov_zarr.chunk_store for key in keys):
+                return False
+
+        return True
 
     # pipeline to run on each block
-    def transform_single_block(coords, transform_list):
+    def transform_single_block(block, transform_list):
 
-        # fetch fixed image slices and read fix
-        fix_slices = coords.item()
-        fix = fix_zarr[fix_slices]
+        # fetch fixed image slices
+        core_slices, fix_slices = block
         fix_origin = fix_spacing * [s.start for s in fix_slices]
 
         # read relevant region of transforms
@@ -157,62 +246,54 @@ def distributed_apply_transform(
         mov_block_coords = bs_transform.apply_transform_to_coordinates(
             fix_block_coords, transform_list, kwargs['transform_spacing'], transform_origin,
         )
-        mov_block_coords = np.round(mov_block_coords / mov_spacing).astype(int)
-        mov_block_coords = np.maximum(0, mov_block_coords)
-        mov_block_coords = np.minimum(mov_zarr.shape, mov_block_coords)
-        mov_start = np.min(mov_block_coords, axis=0)
-        mov_stop = np.max(mov_block_coords, axis=0)
+        # the crop includes the last voxel needed for interpolation
+        mov_block_coords = mov_block_coords / mov_spacing
+        mov_start = np.floor(np.min(mov_block_coords, axis=0)).astype(int)
+        mov_stop = np.ceil(np.max(mov_block_coords, axis=0)).astype(int) + 1
+        mov_start = np.maximum(0, mov_start)
+        mov_stop = np.minimum(mov_zarr.shape, mov_stop)
         mov_slices = tuple(slice(a, b) for a, b in zip(mov_start, mov_stop))
-        mov = mov_zarr[mov_slices]
-        mov_origin = mov_spacing * [s.start for s in mov_slices]
-
-        # resample
-        aligned = bs_transform.apply_transform(
-            fix, mov, fix_spacing, mov_spacing,
-            transform_list=transform_list,
-            transform_origin=transform_origin,
-            fix_origin=fix_origin,
-            mov_origin=mov_origin,
-            **kwargs,
-        )
 
-        # crop out overlap
-        for axis in range(aligned.ndim):
-
-            # left side
-            slc = [slice(None),]*aligned.ndim
-            if fix_slices[axis].start != 0:
-                slc[axis] = slice(overlap[axis], None)
-                aligned = aligned[tuple(slc)]
+        # resample, unless the moving footprint has no data
+        if has_foreground(mov_slices):
+            fix = fix_zarr[fix_slices]
+            mov = mov_zarr[mov_slices]
+            mov_origin = mov_spacing * [s.start for s in mov_slices]
+            aligned = bs_transform.apply_transform(
+                fix, mov, fix_spacing, mov_spacing,
+                transform_list=transform_list,
+                transform_origin=transform_origin,
+                fix_origin=fix_origin,
+                mov_origin=mov_origin,
+                **kwargs,
+            )
+        else:
+            shape = tuple(s.stop - s.start for s in fix_slices)
+            aligned = np.zeros(shape, dtype=fix_zarr.dtype)
 
-            # right side
-            slc = [slice(None),]*aligned.ndim
-            if aligned.shape[axis] > blocksize[axis]:
-                slc[axis] = slice(None, blocksize[axis])
-                aligned = aligned[tuple(slc)]
+        # crop out overlap
+        crop = tuple(slice(x.start - y.start, x.stop - y.start) for x, y in zip(core_slices, fix_slices))
+        aligned = aligned[crop]
 
-        # return result
+        # write result or return it
+        if write_path:
+            output[core_slices] = aligned
+            return True
         return aligned
     # END: closure
 
-    # align all blocks
-    aligned = da.map_blocks(
-        transform_single_block,
-        block_coords,
+    # transform all blocks, a bounded number at a time
+    results = ut.bounded_map(
+        cluster.client, transform_single_block, blocks,
+        max_pending=max_pending_blocks,
         transform_list=transform_list,
-        dtype=fix_zarr.dtype,
-        chunks=blocksize,
     )
-
-    # crop to original size
-    aligned = aligned[tuple(slice(s) for s in fix_zarr.shape)]
+    for iii, result in results:
+        if not write_path:
+            output[blocks[iii][0]] = result
 
     # return
-    if write_path:
-        da.to_zarr(aligned, write_path, component=dataset_path)
-        return zarr.open(write_path, 'r+')
-    else:
-        return aligned.compute()
+    return output
 
 
 @cluster
@@ -261,7 +342,8 @@ def distributed_apply_transform_to_coordinates(
 
     temporary_directory : string (default: None)
         A parent directory for temporary data written to disk during computation
-        If None then the current directory is used
+        If None then the current directory is used. zarr, N5, HDF5, and memory
+        mapped inputs are read in place, only inputs held in memory are copied.
 
     cluster : ClusterWrap.cluster object (default: None)
         Only set if you have constructed your own static cluster. The default behavior
@@ -283,19 +365,14 @@ def distributed_apply_transform_to_coordinates(
 
     # TODO: check this for multiple deforms and transform_origin as a list
 
-    # ensure temporary directory exists
-    temporary_directory = temporary_directory or os.getcwd()
-    temporary_directory = tempfile.TemporaryDirectory(
-        prefix='.', dir=temporary_directory,
-    )
-
-    # ensure all deforms are zarr
+    # share all deforms, only in memory data is copied to disk
+    temporary_directory = ut.LazyTemporaryDirectory(temporary_directory)
     new_list = []
     zarr_blocks = (128,)*3 + (3,)  # TODO: generalize
     for iii, transform in enumerate(transform_list):
         if transform.shape != (4, 4):
-            zarr_path = temporary_directory.name + f'/deform{iii}.zarr'
-            transform = ut.numpy_to_zarr(transform, zarr_blocks, zarr_path)
+            path = temporary_directory.path(f'deform{iii}.zarr')
+            transform = ut.shared_array(transform, zarr_blocks, path)
         new_list.append(transform)
     transform_list = new_list
 
@@ -361,12 +438,20 @@ def distributed_invert_displacement_vector_field(
     sqrt_order=2,
     sqrt_step=0.5,
     sqrt_iterations=5,
+    halo_scale=1.5,
+    min_halo=4,
     cluster=None,
     cluster_kwargs={},
 ):
     """
     Numerically find the inverse of a larger-than-memory displacement vector field
 
+    Blocks are given a halo sized to the largest displacement in their
+    neighborhood, so smooth or small fields are inverted with little
+    redundant work and large displacements still see all the data they need.
+    Blocks whose neighborhood contains only zero displacement are skipped;
+    their region of the output is left at the zarr fill value (zero).
+
     Parameters
     ----------
     field_zarr : zarr array
@@ -397,6 +482,13 @@ def distributed_invert_displacement_vector_field(
     sqrt_iterations : scalar int (default: 5)
         The number of iterations to find the field composition square root.
 
+    halo_scale : float (default: 1.5)
+        The halo around each block is this multiple of the largest displacement
+        magnitude found in the block and its neighbors
+
+    min_halo : scalar int (default: 4)
+        Voxels added to every halo, regardless of displacement magnitude
+
     cluster : ClusterWrap.cluster object (default: None)
         Only set if you have constructed your own static cluster. The default behavior
         is to construct a cluster for the duration of this function, then close it
@@ -415,28 +507,55 @@ def distributed_invert_displacement_vector_field(
         The numerical inverse of the given displacement vector field as a zarr array.
     """
 
-    # get overlap and number of blocks
+    # get number of blocks and core slices for all blocks
+    spacing = np.array(spacing)
     blocksize = np.array(blocksize)
-    overlap = np.round(blocksize * 0.25).astype(int)
-    nblocks = np.ceil(np.array(field_zarr.shape[:-1]) / blocksize).astype(int)
-
-    # TODO: eliminate use of dask array
-    # store block coordinates in a dask array
-    block_coords = np.empty(nblocks, dtype=tuple)
-    for (i, j, k) in np.ndindex(*nblocks):
-        start = blocksize * (i, j, k) - overlap
-        stop = start + blocksize + 2 * overlap
-        start = np.maximum(0, start)
-        stop = np.minimum(field_zarr.shape[:-1], stop)
-        coords = tuple(slice(x, y) for x, y in zip(start, stop))
-        block_coords[i, j, k] = coords
-    block_coords = da.from_array(block_coords, chunks=(1,)*block_coords.ndim)
+    field_shape = np.array(field_zarr.shape[:-1])
+    nblocks = np.ceil(field_shape / blocksize).astype(int)
+    indices, core_slices = [], []
+    for index in np.ndindex(*nblocks):
+        start = blocksize * index
+        stop = np.minimum(field_shape, start + blocksize)
+        indices.append(index)
+        core_slices.append(tuple(slice(x, y) for x, y in zip(start, stop)))
+
+    # find the largest displacement magnitude in every block
+    def max_displacement(slices):
+        field = field_zarr[slices]
+        return np.sqrt(np.max(np.sum(field.astype(np.float64)**2, axis=-1)))
+
+    futures = cluster.client.map(max_displacement, core_slices)
+    magnitudes = np.array(cluster.client.gather(futures)).reshape(nblocks)
+
+    # spread magnitudes over block neighborhoods large enough to contain the halo
+    reach = np.ceil(halo_scale * np.max(magnitudes) / spacing) + min_halo
+    radius = np.maximum(1, np.ceil(reach / blocksize)).astype(int)
+    magnitudes = maximum_filter(magnitudes, size=tuple(2*radius + 1), mode='constant')
+
+    # halo per block, skip blocks with no displacement in their neighborhood
+    blocks = []
+    for index, slices in zip(indices, core_slices):
+        if magnitudes[index] == 0: continue
+        halo = np.ceil(halo_scale * magnitudes[index] / spacing).astype(int) + min_halo
+        blocks.append((slices, halo))
+
+    # zarr file for output, chunks align with blocks so writes never collide
+    output = ut.create_zarr(
+        write_path,
+        field_zarr.shape,
+        tuple(blocksize) + (field_zarr.shape[-1],),
+        field_zarr.dtype,
+    )
 
+    def invert_block(block):
 
-    def invert_block(slices):
+        # read block with halo
+        slices, halo = block
+        start = np.maximum(0, [s.start - h for s, h in zip(slices, halo)])
+        stop = np.minimum(field_shape, [s.stop + h for s, h in zip(slices, halo)])
+        field = field_zarr[tuple(slice(x, y) for x, y in zip(start, stop))]
 
-        slices = slices.item()
-        field = field_zarr[slices]
+        # invert
         inverse = bs_transform.invert_displacement_vector_field(
             field,
             spacing,
@@ -447,39 +566,13 @@ def distributed_invert_displacement_vector_field(
             sqrt_iterations=sqrt_iterations,
         )
 
-        # crop out overlap
-        for axis in range(inverse.ndim - 1):
-
-            # left side
-            slc = [slice(None),]*(inverse.ndim - 1)
-            if slices[axis].start != 0:
-                slc[axis] = slice(overlap[axis], None)
-                inverse = inverse[tuple(slc)]
-
-            # right side
-            slc = [slice(None),]*(inverse.ndim - 1)
-            if inverse.shape[axis] > blocksize[axis]:
-                slc[axis] = slice(None, blocksize[axis])
-                inverse = inverse[tuple(slc)]
-
-        # return result
-        return inverse
+        # crop out halo and write result
+        crop = tuple(slice(s.start - x, s.stop - x) for s, x in zip(slices, start))
+        output[slices] = inverse[crop]
+        return True
 
     # invert all blocks
-    inverse = da.map_blocks(
-        invert_block,
-        block_coords,
-        dtype=field_zarr.dtype,
-        new_axis=[3,],
-        chunks=tuple(blocksize) + (3,),
-    )
-
-    # crop to original size
-    inverse = inverse[tuple(slice(0, s) for s in field_zarr.shape[:-1])]
-
-    # compute result, write to zarr array
-    da.to_zarr(inverse, write_path)
-
-    # return reference to result
-    return zarr.open(write_path, 'r+')
-
+    futures = cluster.client.map(invert_block, blocks)
+    all_written = np.all( cluster.client.gather(futures) )
+    if not all_written: print('SOMETHING FAILED, CHECK LOGS')
+    return output
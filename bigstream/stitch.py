@@ -127,15 +127,15 @@ def distributed_stitch(
     # define how to align a single pair of neighbors
     def align_neighbors(neighbors):
 
-        # get number of cores
-        ncores = ut.get_number_of_cores()
+        # get thread budget
+        ncores = ut.get_thread_budget()
 
         # read the first region
         other_reader = aicspylibczi.CziFile(czi_file_path)
         A_read_spec = {
             reader.dims.order[channel_axis]:channel,
             reader.dims.order[tile_axis]:neighbors[0],
-            'cores':2*ncores,
+            'cores':ncores,
         }
         A_slice = [slice(None),] * len(spatial_axes)
         A_slice[neighbors[2]] = slice(-overlaps[neighbors[2]], None)
@@ -147,7 +147,7 @@ def distributed_stitch(
         B_read_spec = {
             reader.dims.order[channel_axis]:channel,
             reader.dims.order[tile_axis]:neighbors[1],
-            'cores':2*ncores,
+            'cores':ncores,
         }
         B_slice = [slice(None),] * len(spatial_axes)
         B_slice[neighbors[2]] = slice(0, overlaps[neighbors[2]])
@@ -304,15 +304,15 @@ def distributed_apply_stitch(
 
         print(f'starting {tile_number}', flush=True)
 
-        # get number of cores
-        ncores = ut.get_number_of_cores()
+        # get thread budget
+        ncores = ut.get_thread_budget()
 
         # read tile data
         other_reader = aicspylibczi.CziFile(czi_file_path)
         read_spec = {
             reader.dims.order[channel_axis]:channel,
             reader.dims.order[tile_axis]:tile_number,
-            'cores':2*ncores,
+            'cores':ncores,
         }
         tile = other_reader.read_image(**read_spec)[0].squeeze()
         mov_origin = tile_positions[tile_number]
@@ -364,7 +364,7 @@ def distributed_apply_stitch(
 
         # register as ready to write
         write_region = tuple(slice(a, b) for a, b in zip(fix_origin, fix_end))
-        blosc.set_nthreads(2*ncores)
+        blosc.set_nthreads(ncores)
 
         # get neighbors info
         neighbor_events = []
@@ -16,6 +16,7 @@ def apply_transform(
     mov_origin=None,
     interpolator='1',
     extrapolate_with_nn=False,
+    threads=None,
 ):
     """
     Resample moving image onto fixed image through a list
@@ -74,6 +75,10 @@ def apply_transform(
         segmentation/multi-label data. Also prevents edge effects from padding
         when warping image data.
 
+    threads : int (default: None)
+        Number of threads used by this resampling. By default the budget from
+        bigstream.utility.get_thread_budget
+
     Returns
     -------
     warped image : ndarray
@@ -81,9 +86,9 @@ def apply_transform(
         fixed image grid.
     """
 
-    # set global number of threads
-    ncores = ut.get_number_of_cores()
-    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(2*ncores)
+    # apply the process budget, this resampler may use a different number of threads
+    ut.set_thread_budget()
+    threads = ut.get_thread_budget(threads)
 
     # construct transform
     fix_spacing = np.array(fix_spacing)
@@ -94,7 +99,7 @@ def apply_transform(
 
     # set up resampler object
     resampler = sitk.ResampleImageFilter()
-    resampler.SetNumberOfThreads(2*ncores)
+    resampler.SetNumberOfThreads(threads)
 
     # set reference data
     if isinstance(fix, tuple):
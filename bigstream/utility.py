@@ -1,11 +1,16 @@
 import numpy as np
 from scipy.spatial.transform import Rotation
+from scipy.ndimage import gaussian_filter
 import SimpleITK as sitk
 import zarr
 from zarr.indexing import BasicIndexer
-from distributed import Lock
+from distributed import Lock, as_completed, get_worker
+from itertools import islice
 import glob
 import os , psutil
+import tempfile
+import json, hashlib
+import threading
 import h5py
 from ClusterWrap.decorator import cluster
 from zarr import blosc
@@ -373,7 +378,7 @@ def bspline_parameters_to_transform(parameters):
 
     # number of fixed parameters depends on dimension, stored in parameters[0]
     nfp = 10 if parameters[0] == 2 else 18
-    t = sitk.BSplineTransform(parameters[0], 3)
+    t = sitk.BSplineTransform(int(parameters[0]), 3)
     t.SetFixedParameters(parameters[1:nfp+1])
     t.SetParameters(parameters[nfp+1:])
     return t
@@ -481,7 +486,7 @@ def transform_list_to_composite_transform(transform_list, spacing=None, origin=N
     elif len(transform_list[0].shape) > 2:
         ndims = transform_list[0].ndim - 1
     else:
-        ndims = transform_list[0][0]
+        ndims = int(transform_list[0][0])
 
     transform = sitk.CompositeTransform(ndims)
     for iii, t in enumerate(transform_list):
@@ -505,6 +510,8 @@ def create_zarr(
     multithreaded=False,
     chunk_locked=False,
     client=None,
+    dataset_path=None,
+    **kwargs,
 ):
     """
     Create a new zarr array on disk
@@ -529,6 +536,12 @@ def create_zarr(
     client : dask.client (default: None)
         DEPRECATED
 
+    dataset_path : string (default: None)
+        A subpath within the zarr container at which to create the array
+
+    **kwargs : any additional keyword arguments
+        Passed to zarr.open, e.g. `write_empty_chunks`
+
     Returns
     -------
     zarr_array : zarr array
@@ -545,6 +558,8 @@ def create_zarr(
         chunks=chunks,
         dtype=dtype,
         synchronizer=synchronizer,
+        path=dataset_path,
+        **kwargs,
     )
 
     # this code is currently never used within bigstream
@@ -591,18 +606,886 @@ def numpy_to_zarr(array, chunks, path):
         return array
 
 
+def hash_arguments(*args):
+    """
+    A short stable hash of the repr of some arguments. Used to check that a
+    checkpoint was made by a call with the same parameters. Array data is
+    not hashed; pass shapes and dtypes for arrays instead.
+
+    Parameters
+    ----------
+    *args : any objects with a deterministic repr
+
+    Returns
+    -------
+    hash : string
+        Hexadecimal sha1 digest
+    """
+
+    with np.printoptions(threshold=np.inf):
+        return hashlib.sha1(repr(args).encode()).hexdigest()
+
+
+def array_fingerprint(array, samples=2**20):
+    """
+    A short description of an array for hash_arguments. Arrays held in
+    memory are copied to disk by shared_array, so for those a hash of up to
+    `samples` evenly strided values is included to detect changed data.
+    Arrays read in place are described by shape and dtype only.
+
+    Parameters
+    ----------
+    array : nd-array or array-like
+        The array to describe
+
+    samples : int (default: 2**20)
+        The maximum number of values hashed
+
+    Returns
+    -------
+    fingerprint : tuple
+        Shape, dtype, and for in memory arrays a hexadecimal sha1 digest
+    """
+
+    description = (tuple(array.shape), str(array.dtype))
+    if type(array) is not np.ndarray: return description
+    stride = max(1, array.size // samples)
+    values = np.ascontiguousarray(array.reshape(-1)[::stride])
+    return description + (hashlib.sha1(values.view(np.uint8)).hexdigest(),)
+
+
+def read_manifest(path, arguments_hash):
+    """
+    Read the completed block indices recorded in a checkpoint manifest
+
+    Parameters
+    ----------
+    path : string
+        Location of the manifest json file
+
+    arguments_hash : string
+        The hash of the arguments of the current call, see hash_arguments
+
+    Returns
+    -------
+    completed : set of tuples
+        Indices of completed blocks. Empty if the manifest does not exist
+        or was written by a call with different arguments.
+    """
+
+    if not os.path.exists(path): return set()
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest['arguments'] != arguments_hash:
+        print('CHECKPOINT ARGUMENTS CHANGED, STARTING OVER', flush=True)
+        return set()
+    return set(tuple(x) for x in manifest['completed'])
+
+
+def write_manifest(path, arguments_hash, completed):
+    """
+    Atomically write the completed block indices to a checkpoint manifest
+
+    Parameters
+    ----------
+    path : string
+        Location of the manifest json file
+
+    arguments_hash : string
+        The hash of the arguments of the current call, see hash_arguments
+
+    completed : iterable of tuples
+        Indices of completed blocks
+    """
+
+    manifest = {
+        'arguments': arguments_hash,
+        'completed': sorted([int(y) for y in x] for x in completed),
+    }
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def write_records(path, records):
+    """
+    Write a list of dictionaries as a json lines file, one record per line.
+    If path ends in '.parquet' a Parquet table is written instead, this
+    requires pandas.
+
+    Parameters
+    ----------
+    path : string
+        Location of the file
+
+    records : list of dicts
+        The records, values must be json serializable or numpy scalars/arrays
+    """
+
+    convert = lambda x: x.tolist() if isinstance(x, (np.ndarray, np.generic)) else x
+    if path.endswith('.parquet'):
+        import pandas
+        records = [json.loads(json.dumps(x, default=convert)) for x in records]
+        pandas.DataFrame.from_records(records).to_parquet(path)
+        return
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record, default=convert) + '\n')
+
+
+def read_records(path):
+    """
+    Read a json lines file written by write_records
+
+    Parameters
+    ----------
+    path : string
+        Location of the file
+
+    Returns
+    -------
+    records : list of dicts
+    """
+
+    if path.endswith('.parquet'):
+        import pandas
+        return pandas.read_parquet(path).to_dict('records')
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def report_records(records, path=None, client=None):
+    """
+    Summarize per-block telemetry records. The summary is printed and sent
+    to the dask event log under 'bigstream-summary'; records are optionally
+    written to disk.
+
+    Parameters
+    ----------
+    records : list of dicts
+        One record per block with at least 'block_index' and 'seconds'
+
+    path : string (default: None)
+        If given, records are written here with write_records
+
+    client : dask.distributed.Client (default: None)
+        If given, the summary is sent to the dask event log
+
+    Returns
+    -------
+    summary : dict
+        Block count, time statistics, fallback count, and slowest blocks
+    """
+
+    if path: write_records(path, records)
+    if not records: return {}
+    seconds = np.array([x['seconds'] for x in records])
+    slowest = np.argsort(-seconds)[:5]
+    summary = {
+        'blocks': len(records),
+        'total_seconds': float(np.sum(seconds)),
+        'median_seconds': float(np.median(seconds)),
+        'max_seconds': float(np.max(seconds)),
+        'fallbacks': int(sum(x.get('fallbacks', 0) for x in records)),
+        'slowest': [
+            (tuple(int(y) for y in records[i]['block_index']), float(seconds[i]))
+            for i in slowest
+        ],
+    }
+    print(f"BLOCKS: {summary['blocks']} median seconds: {summary['median_seconds']:.3g}",
+          f"max seconds: {summary['max_seconds']:.3g} fallbacks: {summary['fallbacks']}\n",
+          f"slowest blocks: {summary['slowest']}", flush=True)
+    if client is not None: client.log_event('bigstream-summary', summary)
+    return summary
+
+
+class HDF5Reader:
+    """
+    A picklable reference to a dataset in an HDF5 file. h5py datasets cannot
+    be sent to workers; this holds only the file name and dataset path and
+    opens the file on first access in each process.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the HDF5 file
+
+    dataset_path : string
+        Path to the dataset within the file
+    """
+
+    def __init__(self, filename, dataset_path):
+        self.filename = filename
+        self.dataset_path = dataset_path
+        self._dataset = None
+        with h5py.File(filename, 'r') as f:
+            dataset = f[dataset_path]
+            self.shape = dataset.shape
+            self.dtype = dataset.dtype
+            self.chunks = dataset.chunks
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key):
+        if self._dataset is None:
+            self._dataset = h5py.File(self.filename, 'r')[self.dataset_path]
+        return self._dataset[key]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_dataset'] = None
+        return state
+
+
+class MemmapReader:
+    """
+    A picklable reference to a memory mapped numpy array. Pickling an
+    np.memmap copies all of its data; this holds only the file name and
+    layout and maps the file on first access in each process.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the raw file
+
+    shape : tuple
+        The shape of the array
+
+    dtype : numpy dtype
+        The data type of the array
+
+    offset : int (default: 0)
+        Byte offset of the array in the file
+
+    order : string (default: 'C')
+        Memory layout of the array
+    """
+
+    def __init__(self, filename, shape, dtype, offset=0, order='C'):
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+        self.order = order
+        self.chunks = None
+        self.ndim = len(self.shape)
+        self._array = None
+
+    def __getitem__(self, key):
+        if self._array is None:
+            self._array = np.memmap(
+                self.filename, dtype=self.dtype, mode='r', offset=self.offset,
+                shape=self.shape, order=self.order,
+            )
+        return np.array(self._array[key])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
+
+
+class SkipSampledArray:
+    """
+    A lazy, picklable, skip sampled view of an array. Nothing is read or
+    copied until the view is indexed; then only the requested voxels of
+    the underlying array are read. Use to run coarse alignments directly
+    on zarr, N5, HDF5, or memory mapped inputs.
+
+    Parameters
+    ----------
+    array : array like
+        Any object with a shape, dtype, and numpy style slicing
+
+    factors : tuple of int
+        The sampling interval along each of the leading axes of array.
+        Trailing axes not covered by factors are not sampled.
+    """
+
+    def __init__(self, array, factors):
+        self.array = array
+        self.factors = tuple(int(x) for x in factors)
+        self.factors += (1,) * (len(array.shape) - len(self.factors))
+        self.shape = tuple(
+            int(np.ceil(s / f)) for s, f in zip(array.shape, self.factors)
+        )
+        self.dtype = array.dtype
+        self.ndim = len(self.shape)
+        self.chunks = None
+        if getattr(array, 'chunks', None) is not None:
+            self.chunks = tuple(
+                max(int(np.ceil(c / f)), 1) for c, f in zip(array.chunks, self.factors)
+            )
+
+    def __getitem__(self, key):
+
+        # expand key to one entry per axis
+        if not isinstance(key, tuple): key = (key,)
+        ellipsis = [iii for iii, k in enumerate(key) if k is Ellipsis]
+        if ellipsis:
+            iii = ellipsis[0]
+            fill = (slice(None),) * (self.ndim - len(key) + 1)
+            key = key[:iii] + fill + key[iii+1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        # map view coordinates to coordinates of the underlying array
+        base_key = []
+        for k, f, s in zip(key, self.factors, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(s)
+                if step < 0:
+                    raise ValueError("SkipSampledArray does not support negative steps")
+                base_stop = (stop - 1) * f + 1 if stop > start else start * f
+                base_key.append(slice(start * f, base_stop, step * f))
+            else:
+                base_key.append(int(k) % s * f)
+        return np.array(self.array[tuple(base_key)])
+
+
+def shared_array(array, chunks, path, reuse=False):
+    """
+    Return a version of array that workers can read directly. zarr and N5
+    arrays, HDF5 datasets, and file backed np.memmap arrays are referenced
+    in place. Other picklable array-like objects that render data on demand
+    (e.g. bigstream.piecewise_align.PiecewiseTransform) are passed through.
+    Only arrays held in memory are copied to a zarr array on disk.
+
+    Parameters
+    ----------
+    array : nd-array, zarr.Array, h5py.Dataset, or np.memmap
+        The array to share with workers
+
+    chunks : tuple
+        The chunk shape used if a copy must be made
+
+    path : string or callable
+        On disk location for the copy if one must be made. If callable, it
+        is called with no arguments only when a copy is needed, which lets
+        callers create temporary directories lazily.
+
+    reuse : bool (default: False)
+        If a copy must be made and a zarr array with the same shape and dtype
+        already exists at path, return it instead of copying again. Used to
+        resume from a checkpoint.
+
+    Returns
+    -------
+    shared : zarr.Array, HDF5Reader, or MemmapReader
+        A reference to the data that can be sent to workers
+    """
+
+    if isinstance(array, (zarr.Array, HDF5Reader, MemmapReader)):
+        return array
+    if isinstance(array, h5py.Dataset):
+        return HDF5Reader(array.file.filename, array.name)
+    if isinstance(array, np.memmap) and array.filename is not None:
+        base = array
+        while isinstance(base.base, np.memmap): base = base.base
+        if base.flags.c_contiguous and array.flags.c_contiguous:
+            offset = base.offset + (
+                array.__array_interface__['data'][0] -
+                base.__array_interface__['data'][0]
+            )
+            return MemmapReader(array.filename, array.shape, array.dtype, offset)
+    if not isinstance(array, np.ndarray) and not hasattr(array, 'dask'):
+        if hasattr(array, 'shape') and hasattr(array, '__getitem__'):
+            return array
+    if callable(path): path = path()
+    if reuse and os.path.exists(os.path.join(path, '.zarray')):
+        existing = zarr.open(path, mode='r')
+        if existing.shape == array.shape and existing.dtype == array.dtype:
+            return existing
+    return numpy_to_zarr(np.asarray(array), chunks, path)
+
+
+class PyramidCache:
+    """
+    Smoothed and downsampled levels of images, computed once and shared
+    by every alignment that asks for the same level of the same image.
+    Levels are built with a separable Gaussian (sigma in physical units,
+    as in configure_irm) followed by strided decimation. Pass one cache to
+    several calls of affine_align or deformable_align, e.g. the steps of
+    alignment_pipeline, so their pyramids are not rebuilt by every
+    registration. Images are identified by object identity, so keep
+    passing the same arrays.
+    """
+
+    def __init__(self):
+        self.levels = {}
+
+    def level(self, image, spacing, alignment_spacing=None, shrink_factor=1, smooth_sigma=0.):
+        """
+        Get (and cache) one level of an image pyramid
+
+        Parameters
+        ----------
+        image : nd-array
+            The full resolution image
+
+        spacing : 1d-array
+            The voxel spacing of image
+
+        alignment_spacing : float (default: None)
+            Skip sample image to approximately this spacing first,
+            see `skip_sample`
+
+        shrink_factor : int (default: 1)
+            Decimation factor along every axis
+
+        smooth_sigma : float (default: 0.)
+            Gaussian sigma in physical units applied before decimation
+
+        Returns
+        -------
+        level : nd-array
+            The smoothed and decimated image
+
+        level_spacing : 1d-array
+            The voxel spacing of level
+        """
+
+        key = (id(image), tuple(spacing), alignment_spacing, shrink_factor, smooth_sigma)
+        if key in self.levels and self.levels[key][0] is image:
+            return self.levels[key][1:]
+
+        level, level_spacing = image, np.array(spacing, dtype=np.float64)
+        if alignment_spacing:
+            level, level_spacing = skip_sample(level, level_spacing, alignment_spacing)
+        if smooth_sigma:
+            sigma = smooth_sigma / level_spacing
+            level = gaussian_filter(level.astype(np.float32), sigma, mode='nearest')
+        if shrink_factor > 1:
+            level = level[(slice(None, None, shrink_factor),) * level.ndim]
+            level_spacing = level_spacing * shrink_factor
+        level = np.ascontiguousarray(level)
+        self.levels[key] = (image, level, level_spacing)
+        return level, level_spacing
+
+
+class LazyTemporaryDirectory:
+    """
+    A temporary directory that is only created the first time its name
+    is used. Removed when this object is garbage collected.
+
+    Parameters
+    ----------
+    dir : string (default: None)
+        The parent directory. The default is the current directory.
+    """
+
+    def __init__(self, dir=None):
+        self.dir = dir or os.getcwd()
+        self._directory = None
+
+    @property
+    def name(self):
+        if self._directory is None:
+            self._directory = tempfile.TemporaryDirectory(prefix='.', dir=self.dir)
+        return self._directory.name
+
+    def path(self, name):
+        """Return a callable giving `name` inside the directory, for shared_array"""
+        return lambda: os.path.join(self.name, name)
+
+    def cleanup(self):
+        """Remove the directory now, if it was ever created"""
+        if self._directory is not None:
+            self._directory.cleanup()
+            self._directory = None
+
+
+def chunk_read_bytes(starts, stops, chunks, itemsize):
+    """
+    The number of bytes decompressed to read regions from a chunked array
+
+    Parameters
+    ----------
+    starts : NxD array
+        The first voxel of N regions in D dimensions
+
+    stops : NxD array
+        One past the last voxel of N regions in D dimensions
+
+    chunks : tuple
+        The chunk shape of the array
+
+    itemsize : int
+        The number of bytes per voxel
+
+    Returns
+    -------
+    read_bytes : 1d array of length N
+        The size of all chunks touched by each region in bytes
+    """
+
+    starts, stops = np.atleast_2d(starts), np.atleast_2d(stops)
+    chunks = np.array(chunks)
+    nchunks = (stops - 1) // chunks - starts // chunks + 1
+    return np.prod(nchunks * chunks, axis=1) * itemsize
+
+
+def plan_blocks(
+    shape,
+    blocksize,
+    overlap,
+    itemsize,
+    chunks=None,
+    min_chunk=32,
+    round_to_chunks=False,
+    verbose=False,
+):
+    """
+    Choose block overlaps and zarr chunk shape for a blocksize so that
+    reading a block with its overlaps touches as little extra data as possible.
+
+    If the data is already chunked (e.g. an existing zarr array) its chunks
+    are used for reading. The blocksize is kept as requested unless
+    `round_to_chunks` is True; a warning is printed if it is not a multiple
+    of the chunk shape. Otherwise the chunk shape for a temporary copy
+    is chosen from the divisors of the blocksize to minimize bytes read per
+    block.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the array to be blocked
+
+    blocksize : iterable
+        The requested shape of blocks in voxels
+
+    overlap : float in range [0, 1]
+        Block overlap size as a percentage of block size
+
+    itemsize : int
+        The number of bytes per voxel
+
+    chunks : tuple (default: None)
+        The native chunk shape of the data if it is already chunked
+
+    min_chunk : int (default: 32)
+        The smallest chunk edge length considered for temporary copies
+
+    round_to_chunks : bool (default: False)
+        If True and `chunks` is given, round the blocksize to the nearest
+        multiple of the chunk shape (at least one chunk), so every block core
+        starts on a chunk boundary. Only use this where the blocksize is a
+        pure performance parameter: in alignment it sets how local the
+        registration is.
+
+    verbose : bool (default: False)
+        If True, print the plan and the expected bytes read per block
+
+    Returns
+    -------
+    blocksize : 1d array
+        The block shape in voxels, as requested unless rounded
+
+    overlaps : 1d array
+        The overlap on each side of a block in voxels
+
+    chunks : tuple
+        The chunk shape to use for temporary copies and for reading
+
+    read_bytes : float
+        The mean number of bytes decompressed to read one block with overlaps
+    """
+
+    # ensure arrays, determine overlaps
+    shape = np.array(shape)
+    blocksize = np.minimum(np.array(blocksize), shape)
+
+    # align blocks to existing chunks, or warn if they are not aligned
+    if chunks is not None:
+        chunks = np.array(chunks[:len(shape)])
+        if round_to_chunks:
+            blocksize = np.maximum(1, np.round(blocksize / chunks)).astype(int) * chunks
+            blocksize = np.minimum(blocksize, shape)
+        elif np.any((blocksize % chunks != 0) & (blocksize < shape)):
+            print(f'WARNING: blocksize {tuple(blocksize.tolist())} is not a multiple of',
+                  f'the native chunks {tuple(chunks.tolist())}, blocks will read',
+                  'partial chunks', flush=True)
+    overlaps = np.round(blocksize * overlap).astype(int)
+
+    # otherwise choose the divisor of blocksize that reads the fewest bytes
+    if chunks is None:
+        chunks = []
+        for bs, ov in zip(blocksize, overlaps):
+            candidates = [d for d in range(1, bs + 1) if bs % d == 0 and d >= min(min_chunk, bs)]
+            read = [chunk_read_bytes([[bs - ov]], [[2*bs + ov]], [d], 1)[0] for d in candidates]
+            chunks.append(max(d for d, r in zip(candidates, read) if r == min(read)))
+        chunks = np.array(chunks)
+
+    # bytes read per block over the whole block grid
+    nblocks = np.ceil(shape / blocksize).astype(int)
+    starts = np.array(list(np.ndindex(*nblocks))) * blocksize
+    stops = np.minimum(shape, starts + blocksize + overlaps)
+    starts = np.maximum(0, starts - overlaps)
+    read_bytes = np.mean(chunk_read_bytes(starts, stops, chunks, itemsize))
+    used_bytes = np.mean(np.prod(stops - starts, axis=1) * itemsize)
+
+    # report the plan
+    if verbose:
+        print(f'BLOCK PLAN blocksize: {tuple(blocksize.tolist())}',
+              f'overlaps: {tuple(overlaps.tolist())}',
+              f'chunks: {tuple(chunks.tolist())} blocks: {np.prod(nblocks)}\n',
+              f'bytes read per block: {read_bytes:.4g} ',
+              f'bytes used per block: {used_bytes:.4g}', flush=True)
+    return blocksize, overlaps, tuple(int(x) for x in chunks), read_bytes
+
+
+def block_foreground_fractions(mask, shape, blocksize):
+    """
+    The fraction of foreground voxels in every block of a block grid. The mask
+    can be sampled at any resolution over the same domain and can be any array
+    that supports slicing, e.g. zarr. It is read one row of blocks at a time.
+
+    Parameters
+    ----------
+    mask : nd-array
+        The foreground mask, nonzero values are foreground
+
+    shape : tuple
+        The shape of the image that is blocked
+
+    blocksize : iterable
+        The shape of blocks in voxels of the image
+
+    Returns
+    -------
+    fractions : nd-array
+        The foreground fraction of each block, shape is the number of blocks
+        along each axis. Blocks with no mask voxels have fraction 0.
+    """
+
+    # block boundaries in mask voxels
+    nblocks = np.ceil(np.array(shape) / blocksize).astype(int)
+    ratio = np.array(mask.shape) / shape
+    edges = []
+    for n, b, r, s in zip(nblocks, blocksize, ratio, mask.shape):
+        edges.append(np.minimum(np.round(r * b * np.arange(n + 1)).astype(int), s))
+
+    # sum each row slab, then take differences of cumulative sums over blocks
+    sums = np.zeros(nblocks, dtype=np.int64)
+    for i in range(nblocks[0]):
+        slab = np.sum(mask[edges[0][i]:edges[0][i+1]] != 0, axis=0, dtype=np.int64)
+        for axis, e in enumerate(edges[1:]):
+            slab = np.cumsum(slab, axis=axis)
+            slab = np.concatenate([np.zeros_like(slab.take([0], axis=axis)), slab], axis=axis)
+            slab = np.diff(slab.take(e, axis=axis), axis=axis)
+        sums[i] = slab
+
+    # normalize by block size in mask voxels
+    counts = np.ones(nblocks, dtype=np.int64)
+    for axis, e in enumerate(edges):
+        size = np.diff(e).reshape([-1 if a == axis else 1 for a in range(len(nblocks))])
+        counts = counts * size
+    fractions = np.zeros(nblocks)
+    np.divide(sums, counts, out=fractions, where=counts > 0)
+    return fractions
+
+
+def relative_chunks(chunks, reference_shape, shape):
+    """
+    Scale a chunk shape chosen for one array to another array over the
+    same domain, e.g. a displacement field sampled at a different resolution.
+    Trailing axes of shape beyond the reference (e.g. vector components)
+    are not chunked.
+
+    Parameters
+    ----------
+    chunks : tuple
+        The chunk shape for the reference array
+
+    reference_shape : tuple
+        The shape of the reference array
+
+    shape : tuple
+        The shape of the array that needs a chunk shape
+
+    Returns
+    -------
+    chunks : tuple
+        The chunk shape for the array
+    """
+
+    ndim = len(reference_shape)
+    ratio = np.array(shape[:ndim]) / reference_shape
+    scaled = np.maximum(1, np.round(np.array(chunks[:ndim]) * ratio)).astype(int)
+    return tuple(int(x) for x in scaled) + tuple(shape[ndim:])
+
+
 def get_number_of_cores():
     """
-    Get number of physical cores available to the python process.
-    Currently only considers LSF environment variable. If not an LSF
-    cluster job the uses psutil.cpu_count
+    Get number of cores available to the python process. This is the
+    smallest of: the physical core count, the cpu affinity of the process,
+    the cgroup cpu quota (containers), and the LSF slot count if this is
+    an LSF cluster job.
     """
 
+    limits = [psutil.cpu_count(logical=False) or os.cpu_count() or 1]
+    if hasattr(os, 'sched_getaffinity'):
+        limits.append(len(os.sched_getaffinity(0)))
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        limits.append(int(np.ceil(quota)))
     if "LSB_DJOB_NUMPROC" in os.environ:
-        ncores = int(os.environ["LSB_DJOB_NUMPROC"])
-    else:
-        ncores = psutil.cpu_count(logical=False)
-    return ncores
+        limits.append(int(os.environ["LSB_DJOB_NUMPROC"]))
+    return max(1, min(limits))
+
+
+def _cgroup_cpu_quota():
+    """
+    The cpu quota of the cgroup containing this process, in cores,
+    or None if there is no quota. Handles cgroup v2 and v1.
+    """
+
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        if quota == 'max': return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota <= 0: return None
+        return quota / period
+    except (OSError, ValueError):
+        return None
+
+
+# cores available to this process, found once on first use
+_number_of_cores = None
+
+
+def get_thread_budget(threads=None):
+    """
+    Number of threads a single task may use for ITK, BLAS, and blosc.
+    Inside a dask worker the available cores are split evenly over the
+    worker's task threads, so concurrent tasks do not oversubscribe the
+    cpu. Outside a worker all available cores are used.
+
+    Parameters
+    ----------
+    threads : int (default: None)
+        Explicit budget. If given it is returned unchanged.
+
+    Returns
+    -------
+    threads : int
+        The number of threads a task should use
+    """
+
+    global _number_of_cores
+    if threads is not None: return max(1, int(threads))
+    if _number_of_cores is None: _number_of_cores = get_number_of_cores()
+    ncores = _number_of_cores
+    try:
+        worker = get_worker()
+        state = getattr(worker, 'state', worker)
+        worker_threads = state.nthreads
+    except ValueError:
+        worker_threads = 1
+    return max(1, ncores // max(1, worker_threads))
+
+
+# the budget applied in this process, and a lock to apply it once
+# the settings are process wide, so per call thread counts never change them
+_thread_budget = None
+_thread_budget_lock = threading.Lock()
+
+
+def set_thread_budget():
+    """
+    Apply the thread budget of this process, see `get_thread_budget`, to
+    SimpleITK's global default, blosc, and (if threadpoolctl is installed)
+    the BLAS/OpenMP libraries used by numpy and scipy. These settings are
+    process wide and shared by every task running in the process (e.g. a
+    dask worker), so they are applied once, by the first call, and later
+    calls return immediately. Per call thread counts are set on the objects
+    that take them instead, e.g. ImageRegistrationMethod.SetNumberOfThreads.
+
+    Within a task the three libraries run one after another and not at
+    the same time, so each is given the whole budget rather than a share.
+
+    Returns
+    -------
+    threads : int
+        The budget of this process
+    """
+
+    global _thread_budget
+    if _thread_budget is not None: return _thread_budget
+    with _thread_budget_lock:
+        if _thread_budget is None:
+            threads = get_thread_budget()
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+            blosc.set_nthreads(threads)
+            try:
+                from threadpoolctl import threadpool_limits
+                threadpool_limits(threads)
+            except ImportError:
+                pass
+            _thread_budget = threads
+    return _thread_budget
+
+
+def bounded_map(client, func, items, max_pending=None, **kwargs):
+    """
+    Map a function over items on a dask cluster without submitting
+    everything at once. At most `max_pending` tasks are in flight, new
+    tasks are submitted in batches as old ones finish. This keeps the
+    scheduler small when there are very many items.
+
+    Parameters
+    ----------
+    client : dask.distributed.Client
+        The client used to submit tasks
+
+    func : callable
+        The function to run on every item
+
+    items : iterable
+        The first argument to func for every task
+
+    max_pending : int (default: None)
+        The maximum number of tasks submitted but not yet complete.
+        If None, four times the total number of worker threads is used.
+
+    **kwargs : any additional keyword arguments
+        Passed to func for every task
+
+    Returns
+    -------
+    results : generator of tuples
+        Yields (index, result) in order of completion, index is the
+        position of the item in items
+    """
+
+    # default to a few tasks per worker thread
+    if max_pending is None:
+        max_pending = 4 * max(1, sum(client.nthreads().values()))
+    batch_size = max(1, max_pending // 4)
+
+    # submit batches of items, remember which item each future belongs to
+    items = enumerate(items)
+    keys = {}
+    def submit(n):
+        batch = list(islice(items, n))
+        if not batch: return []
+        futures = client.map(func, [x for _, x in batch], pure=False, **kwargs)
+        for (iii, _), future in zip(batch, futures):
+            keys[future.key] = iii
+        return futures
+
+    # top up the queue whenever enough tasks have finished
+    completed = as_completed(submit(max_pending), with_results=True)
+    for future, result in completed:
+        yield keys.pop(future.key), result
+        if len(keys) <= max_pending - batch_size:
+            completed.update(submit(batch_size))
 
 
 @cluster
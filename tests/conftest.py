@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from distributed import Client, LocalCluster
+from scipy.ndimage import gaussian_filter, shift
+
+
+class _Cluster:
+    """Minimal stand in for a ClusterWrap cluster: an object with a client"""
+
+    def __init__(self):
+        self.client = Client(LocalCluster(
+            n_workers=2, threads_per_worker=1,
+            processes=False, dashboard_address=None,
+        ))
+
+    def close(self):
+        cluster = self.client.cluster
+        self.client.close()
+        cluster.close()
+
+
+@pytest.fixture(scope='session')
+def cluster():
+    cluster = _Cluster()
+    yield cluster
+    cluster.close()
+
+
+@pytest.fixture(scope='session')
+def image_pair():
+    """A smooth random image and a copy shifted by (1, 0.5, 0) voxels"""
+
+    rng = np.random.default_rng(0)
+    fix = gaussian_filter(rng.random((48, 48, 40)), 2).astype(np.float32)
+    mov = shift(fix, (1, 0.5, 0), order=1).astype(np.float32)
+    return fix, mov
+
+
+@pytest.fixture(scope='session')
+def affine_steps():
+    """A cheap single level affine step for piecewise alignment"""
+
+    return [('affine', {
+        'alignment_spacing': 1,
+        'shrink_factors': (1,),
+        'smooth_sigmas': (0.,),
+        'optimizer_args': {
+            'learningRate': 0.1,
+            'minStep': 0.,
+            'numberOfIterations': 3,
+        },
+    })]
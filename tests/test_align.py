@@ -0,0 +1,72 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter, shift
+import bigstream.utility as ut
+from bigstream.align import affine_align, alignment_pipeline
+
+
+def test_early_stopping(image_pair):
+    fix, mov = image_pair
+    rng = np.random.default_rng(1)
+    mov = (mov + 0.01 * rng.standard_normal(mov.shape)).astype(np.float32)
+    spacing = np.ones(3)
+    results = {}
+    for window in (None, 5):
+        telemetry = {}
+        affine_align(
+            fix, mov, spacing, spacing,
+            rigid=True,
+            metric='MS',
+            shrink_factors=(1,),
+            smooth_sigmas=(0.,),
+            optimizer_args={
+                'learningRate': 0.05,
+                'minStep': 0.,
+                'gradientMagnitudeTolerance': 0.,
+                'numberOfIterations': 200,
+            },
+            early_stopping_window=window,
+            early_stopping_tolerance=1e-3,
+            telemetry=telemetry,
+        )
+        results[window] = telemetry
+
+    # with noise the metric plateaus, the controller ends the level there
+    full, early = results[None], results[5]
+    assert not full['stopped_early'] and full['iterations'] == 200
+    assert early['stopped_early'] and early['iterations'] < 100
+    assert early['final_metric'] <= 1.1 * full['final_metric']
+
+
+def test_shared_pyramid(monkeypatch):
+    # contrast and edge padding so the metric is not dominated by the borders
+    rng = np.random.default_rng(0)
+    fix = (100 * gaussian_filter(rng.random((48, 48, 40)), 3)).astype(np.float32)
+    mov = shift(fix, (1, 0.5, 0), order=3, mode='nearest').astype(np.float32)
+    spacing = np.ones(3)
+    level_args = {
+        'metric': 'MS',
+        'shrink_factors': (2, 1),
+        'smooth_sigmas': (1., 0.),
+        'optimizer_args': {
+            'learningRate': 0.1,
+            'minStep': 0.,
+            'numberOfIterations': 30,
+        },
+    }
+    steps = [('rigid', level_args), ('affine', level_args)]
+
+    # keep the cache made by the pipeline
+    caches = []
+    class RecordingCache(ut.PyramidCache):
+        def __init__(self):
+            super().__init__()
+            caches.append(self)
+    monkeypatch.setattr(ut, 'PyramidCache', RecordingCache)
+    shared = alignment_pipeline(fix, mov, spacing, spacing, steps, share_pyramid=True)
+    assert len(caches) == 1
+
+    # two levels of two images, built once for both steps
+    assert len(caches[0].levels) == 4
+    expected = alignment_pipeline(fix, mov, spacing, spacing, steps)
+    np.testing.assert_allclose(shared[:3, -1], (1, 0.5, 0), atol=0.1)
+    np.testing.assert_allclose(shared, expected, atol=0.05)
@@ -0,0 +1,67 @@
+import numpy as np
+from scipy.ndimage import shift
+from bigstream.align import affine_align
+from bigstream.configure_irm import configure_irm
+
+
+def _align(fix, mov, **kwargs):
+    spacing = np.ones(3)
+    return affine_align(
+        fix, mov, spacing, spacing,
+        rigid=True,
+        metric='MS',
+        shrink_factors=(2, 1),
+        smooth_sigmas=(1., 0.),
+        optimizer_args={
+            'learningRate': 0.1,
+            'minStep': 0.,
+            'numberOfIterations': 20,
+        },
+        **kwargs,
+    )
+
+
+def test_pooled_irm_matches_fresh(image_pair):
+    fix, mov = image_pair
+
+    # dirty the pooled object with other images, a mask, and an initial transform
+    other = shift(fix, (-2, 1, 0), order=1)
+    fix_mask = np.zeros(fix.shape, dtype=np.uint8)
+    fix_mask[8:-8, 8:-8, 8:-8] = 1
+    initial_condition = np.eye(4)
+    initial_condition[:3, -1] = [1, 2, 3]
+    _align(fix, other, fix_mask=fix_mask, initial_condition=initial_condition, reuse=True)
+
+    fresh = _align(fix, mov)
+    pooled = _align(fix, mov, reuse=True)
+    np.testing.assert_array_equal(pooled, fresh)
+
+
+def test_pool_returns_the_same_object():
+    arguments = {'metric': 'MS', 'optimizer_args': {'learningRate': 0.1, 'minStep': 0., 'numberOfIterations': 5}}
+    first = configure_irm(reuse=True, **arguments)
+    assert configure_irm(reuse=True, **arguments) is first
+    assert configure_irm(**arguments) is not first
+    assert configure_irm(reuse=True, sampling='REGULAR', sampling_percentage=0.5, **arguments) is not first
+
+
+def test_progress_is_silent_by_default(image_pair, capsys):
+    fix, mov = image_pair
+    telemetry = {}
+    _align(fix, mov, telemetry=telemetry)
+    assert 'LEVEL:' not in capsys.readouterr().out
+    assert 'trace' not in telemetry and telemetry['iterations'] > 0
+
+    # every Nth iteration is printed
+    _align(fix, mov, progress=5)
+    lines = [x for x in capsys.readouterr().out.splitlines() if x.startswith('LEVEL:')]
+    assert 0 < len(lines) <= 8
+    assert all(int(x.split()[3]) % 5 == 0 for x in lines)
+
+    # a trace is recorded instead of printed
+    telemetry = {}
+    _align(fix, mov, progress='trace', telemetry=telemetry)
+    assert 'LEVEL:' not in capsys.readouterr().out
+    trace = telemetry['trace']
+    assert [x[1] for x in trace if x[0] == 0] == list(range(20))
+    assert telemetry['metric_curve'] == [x[2] for x in trace]
@@ -0,0 +1,124 @@
+import numpy as np
+import zarr
+from bigstream.metrics import (
+    local_correlation_coefficient,
+    distributed_local_correlation_coefficient,
+    roi_correlations,
+    patch_mutual_information,
+)
+
+
+def test_distributed_lcc_matches_in_memory(cluster, image_pair, tmp_path):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    _, expected = local_correlation_coefficient(
+        fix, mov, spacing, 3, return_image=True,
+    )
+    image, block_stats = distributed_local_correlation_coefficient(
+        fix, mov, spacing, 3, (24, 24, 24), cluster=cluster,
+    )
+    np.testing.assert_allclose(image, expected, atol=1e-4)
+    assert len(block_stats) == 8
+
+    # zarr input with other chunks, blocksize is kept
+    fix_zarr = zarr.open(
+        str(tmp_path / 'fix.zarr'), 'w',
+        shape=fix.shape, chunks=(16, 16, 16), dtype=fix.dtype,
+    )
+    fix_zarr[...] = fix
+    written, _ = distributed_local_correlation_coefficient(
+        fix_zarr, mov, spacing, 3, (24, 24, 24),
+        write_path=str(tmp_path / 'lcc.zarr'),
+        cluster=cluster,
+    )
+    assert written.chunks == (24, 24, 24)
+    np.testing.assert_allclose(written[...], expected, atol=1e-4)
+
+
+def test_roi_correlations_batched_matches_unbatched(cluster, image_pair):
+    fix, mov = image_pair
+    rng = np.random.default_rng(1)
+    starts = rng.integers(0, 36, (200, 3))
+    sizes = rng.integers(3, 10, (200, 3))
+    rois = [
+        tuple(slice(int(a), int(min(a + b, s))) for a, b, s in zip(x, y, fix.shape))
+        for x, y in zip(starts, sizes)
+    ]
+    unbatched = roi_correlations(fix, mov, rois, radius=2, batched=False, cluster=cluster)
+    batched = roi_correlations(fix, mov, rois, radius=2, cluster=cluster)
+    np.testing.assert_allclose(batched, unbatched, atol=1e-6)
+
+
+def test_roi_correlations_no_rois(cluster, image_pair):
+    fix, mov = image_pair
+    for batched in (True, False):
+        result = roi_correlations(fix, mov, [], batched=batched, cluster=cluster)
+        assert result.shape == (0,)
+
+
+def test_patch_mutual_information_numpy_engine(image_pair, capsys):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    fix_mask = np.zeros(fix.shape, dtype=bool)
+    fix_mask[:, :30] = True
+    score, image = patch_mutual_information(
+        fix, mov, spacing, 3, 5, fix_mask=fix_mask,
+        return_metric_image=True, engine='numpy', bins=8, threads=2,
+    )
+
+    # a patch by patch reference with the same binning
+    binned = [
+        np.minimum(((x - x.min()) * (8 / (x.max() - x.min()))).astype(int), 7)
+        for x in (fix, mov)
+    ]
+    expected = []
+    for center in np.argwhere(fix_mask[3:-3:5, 3:-3:5, 3:-3:5]) * 5 + 3:
+        patch = tuple(slice(c - 3, c + 4) for c in center)
+        joint = np.histogram2d(
+            binned[0][patch].ravel(), binned[1][patch].ravel(),
+            bins=8, range=((0, 8), (0, 8)),
+        )[0] / 343
+        outer = np.outer(joint.sum(axis=1), joint.sum(axis=0))
+        nonzero = joint > 0
+        expected.append(-np.sum(joint[nonzero] * np.log(joint[nonzero] / outer[nonzero])))
+    np.testing.assert_allclose(score, np.mean(expected), rtol=1e-6)
+    assert image.shape == fix.shape and np.all(image[:, 36:] == 0)
+
+    # single threaded is the same, and alignment lowers the score
+    assert patch_mutual_information(
+        fix, mov, spacing, 3, 5, fix_mask=fix_mask, engine='numpy', bins=8, threads=1,
+    ) == score
+    assert patch_mutual_information(
+        fix, fix, spacing, 3, 5, fix_mask=fix_mask, engine='numpy', bins=8,
+    ) < score
+
+    # irm arguments select the itk engine
+    irm_kwargs = {
+        'metric': 'MMI',
+        'optimizer_args': {'learningRate': 0.1, 'minStep': 0., 'numberOfIterations': 1},
+    }
+    expected = patch_mutual_information(fix, mov, spacing, 3, 10, **irm_kwargs)
+    capsys.readouterr()
+    routed = patch_mutual_information(fix, mov, spacing, 3, 10, engine='numpy', **irm_kwargs)
+    assert "using the 'itk' engine" in capsys.readouterr().out
+    assert routed == expected
+
+
+def test_local_correlation_coefficient_precision(image_pair):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    mean, image = local_correlation_coefficient(fix, mov, spacing, 2, return_image=True)
+
+    # squared correlation over the window around some interior voxels
+    rng = np.random.default_rng(0)
+    for center in rng.integers(2, np.array(fix.shape) - 2, (20, 3)):
+        window = tuple(slice(c - 2, c + 3) for c in center)
+        expected = np.corrcoef(fix[window].ravel(), mov[window].ravel())[0, 1]**2
+        np.testing.assert_allclose(image[tuple(center)], expected, rtol=1e-4)
+
+    # single precision intermediates stay close to double precision
+    mean32, image32 = local_correlation_coefficient(
+        fix, mov, spacing, 2, return_image=True, dtype=np.float32,
+    )
+    np.testing.assert_allclose(image32, image, atol=1e-3)
+    np.testing.assert_allclose(mean32, mean, rtol=1e-4)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter, affine_transform, shift
+from scipy.spatial.transform import Rotation
+from bigstream.align import affine_align
+from bigstream.numpy_align import numpy_affine_align
+
+
+@pytest.fixture(scope='module')
+def rigid_pair():
+    """An anisotropic image and a copy moved by a known rigid transform"""
+
+    rng = np.random.default_rng(0)
+    fix = (100 * gaussian_filter(rng.random((24, 40, 36)), 3)).astype(np.float32)
+    spacing = np.array([2., 1., 1.])
+    center = (np.array(fix.shape) - 1) * spacing / 2
+    matrix = np.eye(4)
+    matrix[:3, :3] = Rotation.from_euler('xyz', [3, -2, 4], degrees=True).as_matrix()
+    matrix[:3, -1] = center - matrix[:3, :3] @ center + [1.5, -2, 1]
+
+    # resample in voxel units, edges are padded so the metric is not
+    # dominated by zeros moving in from outside the image
+    scale = np.diag(np.append(spacing, 1))
+    voxel_matrix = np.linalg.inv(scale) @ np.linalg.inv(matrix) @ scale
+    mov = affine_transform(fix, voxel_matrix, order=3, mode='nearest')
+    return fix, mov.astype(np.float32), spacing, matrix
+
+
+@pytest.mark.parametrize('rigid', [True, False])
+def test_numpy_affine_align_matches_itk(rigid_pair, rigid):
+    fix, mov, spacing, matrix = rigid_pair
+    numpy_matrix, telemetry = numpy_affine_align(
+        fix, mov, spacing, spacing,
+        rigid=rigid,
+        metric='MS',
+        shrink_factors=(2, 1),
+        smooth_sigmas=(2., 0.),
+        iterations=200,
+    )
+    itk_matrix = affine_align(
+        fix, mov, spacing, spacing,
+        rigid=rigid,
+        metric='MS',
+        shrink_factors=(2, 1),
+        smooth_sigmas=(2., 0.),
+        optimizer_args={
+            'learningRate': 0.1,
+            'minStep': 0.,
+            'numberOfIterations': 200,
+        },
+    )
+    np.testing.assert_allclose(numpy_matrix, matrix, atol=0.1)
+    np.testing.assert_allclose(itk_matrix, matrix, atol=0.15)
+    np.testing.assert_allclose(numpy_matrix, itk_matrix, atol=0.1)
+
+
+def test_numpy_affine_align_singleton_axis():
+    # a single plane, e.g. one frame of a 2D time series
+    rng = np.random.default_rng(0)
+    fix = (100 * gaussian_filter(rng.random((1, 64, 64)), (0, 3, 3))).astype(np.float32)
+    mov = shift(fix, (0, 1.5, -1), order=3, mode='nearest').astype(np.float32)
+    matrix, telemetry = numpy_affine_align(
+        fix, mov, np.ones(3), np.ones(3), rigid=True, metric='MS', iterations=100,
+    )
+    expected = np.eye(4)
+    expected[:3, -1] = [0, 1.5, -1]
+    np.testing.assert_allclose(matrix, expected, atol=0.05)
+    assert telemetry['final_metric'] < telemetry['initial_metric']
@@ -0,0 +1,373 @@
+import json
+from itertools import product
+import numpy as np
+import pytest
+import bigstream.utility as ut
+from bigstream.transform import compose_transforms
+from bigstream.piecewise_align import (
+    distributed_piecewise_alignment_pipeline,
+    nested_distributed_piecewise_alignment_pipeline,
+    adaptive_distributed_piecewise_alignment_pipeline,
+    PiecewiseTransform,
+    _refine_block_mask,
+    _sample_block_mask,
+    _weights_key,
+    _block_weights,
+    _weight_templates,
+    _get_weights,
+)
+
+
+def test_refine_block_mask_non_divisible_shape():
+    # 130 voxels: 3 blocks of 64 (the last partial) and 5 children of 32
+    mask = np.zeros((3, 3, 3), dtype=bool)
+    mask[0, 0, 0] = True
+    child_mask = _refine_block_mask(mask, (130,) * 3, (64,) * 3, (32,) * 3)
+    expected = np.zeros((5, 5, 5), dtype=bool)
+    expected[:2, :2, :2] = True
+    np.testing.assert_array_equal(child_mask, expected)
+
+    # the partial last block covers only the last child
+    mask = np.zeros((3, 3, 3), dtype=bool)
+    mask[2, 1, 0] = True
+    child_mask = _refine_block_mask(mask, (130,) * 3, (64,) * 3, (32,) * 3)
+    assert set(map(tuple, np.argwhere(child_mask))) == {(4, 2, 0), (4, 2, 1), (4, 3, 0), (4, 3, 1)}
+
+    # children straddling two odd sized parents are selected by either
+    mask = np.zeros((4,), dtype=bool)
+    mask[1] = True
+    np.testing.assert_array_equal(
+        _refine_block_mask(mask, (100,), (33,), (17,)),
+        [False, True, True, True, False, False],
+    )
+
+
+def test_sample_block_mask_uses_block_grids_as_is():
+    mask = np.random.default_rng(0).random((5, 5, 5)) > 0.5
+    np.testing.assert_array_equal(
+        _sample_block_mask(mask, (130,) * 3, (32,) * 3), mask,
+    )
+
+
+def test_blend_weights_are_a_partition_of_unity():
+    shape, blocksize, overlaps = (70, 60, 30), np.array((16,) * 3), np.array((8,) * 3)
+    nblocks = np.ceil(np.array(shape) / blocksize).astype(int)
+    offsets = list(product([-1, 0, 1], repeat=3))
+
+    def blend(foreground, budget):
+        keys, slices = [], []
+        for index in map(tuple, np.argwhere(foreground)):
+            flags = {}
+            for o in offsets:
+                neighbor = np.array(index) + o
+                inside = np.all(neighbor >= 0) and np.all(neighbor < nblocks)
+                flags[o] = bool(inside and foreground[tuple(neighbor)])
+            start = np.maximum(0, np.array(index) * blocksize - overlaps)
+            stop = np.minimum(shape, (np.array(index) + 1) * blocksize + overlaps)
+            keys.append(_weights_key(index, flags, nblocks))
+            slices.append(tuple(slice(a, b) for a, b in zip(start, stop)))
+        templates = _weight_templates(keys, blocksize, overlaps, budget=budget)
+        for key, weights in templates.items():
+            np.testing.assert_array_equal(weights, _block_weights(key, blocksize, overlaps))
+        total = np.zeros(shape, dtype=np.float32)
+        for key, region in zip(keys, slices):
+            block_shape = tuple(x.stop - x.start for x in region)
+            weights = _get_weights(templates, key, blocksize, overlaps, block_shape)
+            assert weights.dtype == np.float32
+            total[region] += weights
+        return total, templates
+
+    # every block, with templates and with all weights made on demand
+    foreground = np.ones(nblocks, dtype=bool)
+    total, templates = blend(foreground, 2**30)
+    assert len(templates) > 0
+    np.testing.assert_allclose(total, 1, atol=1e-5)
+    total, templates = blend(foreground, 0)
+    assert len(templates) == 0
+    np.testing.assert_allclose(total, 1, atol=1e-5)
+
+    # missing neighbors, weights are rebalanced over the cores of the rest
+    foreground[1:, 1:] = False
+    total, _ = blend(foreground, 2**30)
+    for index in map(tuple, np.argwhere(foreground)):
+        start = np.array(index) * blocksize
+        core = tuple(slice(a, b) for a, b in zip(start, start + blocksize))
+        np.testing.assert_allclose(total[core], 1, atol=1e-5)
+    assert np.all(total[32:, 32:] == 0)
+
+
+def test_adaptive_refines_only_selected_blocks(cluster, image_pair, affine_steps, capsys):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+
+    # a mask over half the image, so only those blocks are candidates
+    fix_mask = np.zeros(fix.shape, dtype=np.uint8)
+    fix_mask[:24] = 1
+    field = adaptive_distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, affine_steps, (24, 24, 20), (12, 12, 10),
+        threshold=2., fix_mask=fix_mask, cluster=cluster,
+    )
+    output = capsys.readouterr().out
+    assert 'refining 4 of 4 blocks' in output
+    assert field.shape == fix.shape + (3,)
+    # blocks reach one overlap (half a block) past the mask
+    assert np.all(field[36:] == 0)
+
+
+def test_resume_from_manifest(cluster, image_pair, affine_steps, tmp_path):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    checkpoint_directory = str(tmp_path / 'checkpoint')
+    run = lambda: distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, affine_steps, (24, 24, 24),
+        checkpoint_directory=checkpoint_directory,
+        cluster=cluster,
+    )
+    expected = run()
+
+    # forget most blocks, a second call recomputes only those
+    manifest_path = tmp_path / 'checkpoint' / 'manifest.json'
+    manifest = json.loads(manifest_path.read_text())
+    assert len(manifest['completed']) > 2
+    manifest['completed'] = manifest['completed'][:2]
+    manifest_path.write_text(json.dumps(manifest))
+    resumed = run()
+    np.testing.assert_allclose(resumed, expected, atol=1e-5)
+
+
+def test_compact_round_trip(cluster, image_pair, affine_steps, tmp_path):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    dense = distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, affine_steps, (24, 24, 24),
+        cluster=cluster,
+    )
+    write_path = str(tmp_path / 'compact')
+    compact = distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, affine_steps, (24, 24, 24),
+        compact=True, write_path=write_path,
+        cluster=cluster,
+    )
+    assert isinstance(compact, PiecewiseTransform)
+    np.testing.assert_allclose(compact[...], dense, atol=1e-4)
+    np.testing.assert_allclose(compact[5:30, 10:40, 20:], dense[5:30, 10:40, 20:], atol=1e-4)
+
+    loaded = PiecewiseTransform.load(write_path)
+    np.testing.assert_allclose(loaded[...], compact[...], atol=1e-6)
+
+
+def test_checkpoint_with_compact_flipped(cluster, image_pair, affine_steps, tmp_path):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    run = lambda compact: distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, affine_steps, (24, 24, 24),
+        checkpoint_directory=str(tmp_path / 'checkpoint'),
+        compact=compact,
+        cluster=cluster,
+    )
+    dense = run(False)
+    compact = run(True)
+    np.testing.assert_allclose(compact[...], dense, atol=1e-4)
+    np.testing.assert_allclose(run(False), dense, atol=1e-5)
+
+
+def test_nested_checkpoint_detects_changed_inputs(cluster, image_pair, affine_steps, tmp_path):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    schedule = [((24, 24, 24), affine_steps)]
+    run = lambda mov: nested_distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, schedule,
+        checkpoint_directory=str(tmp_path / 'checkpoint'),
+        cluster=cluster,
+    )
+    run(mov)
+
+    # same shape and dtype, different data
+    changed = np.roll(mov, 2, axis=1)
+    expected = nested_distributed_piecewise_alignment_pipeline(
+        fix, changed, spacing, spacing, schedule, cluster=cluster,
+    )
+    np.testing.assert_allclose(run(changed), expected, atol=1e-5)
+
+
+def test_pyramid_levels_only_refine(cluster, image_pair, affine_steps, capsys):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    schedule = [((48, 48, 40), affine_steps), ((24, 24, 20), affine_steps)]
+
+    # the fine level aligns only the first half of the blocks
+    block_mask = np.zeros((5, 5, 5), dtype=bool)
+    block_mask[:3] = True
+    run = lambda schedule: nested_distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, schedule, pyramid=True,
+        block_mask=block_mask, cluster=cluster,
+    )
+    field = run(schedule)
+
+    # the coarse level by itself, on 2x skip sampled views
+    coarse = distributed_piecewise_alignment_pipeline(
+        ut.SkipSampledArray(fix, (2, 2, 2)), ut.SkipSampledArray(mov, (2, 2, 2)),
+        2 * spacing, 2 * spacing, affine_steps, (24, 24, 20),
+        block_mask=block_mask, cluster=cluster,
+    )
+    expected = compose_transforms(
+        coarse, np.zeros(fix.shape + (3,), dtype=np.float32), 2 * spacing, spacing,
+    )
+    assert 'LEVEL 0: sampling factors [2, 2, 2]' in capsys.readouterr().out
+    assert field.shape == fix.shape + (3,)
+    # voxels past the last coarse sample are extrapolated by the affine fit
+    np.testing.assert_allclose(field[36:-1, :-1, :-1], expected[36:-1, :-1, :-1], atol=1e-3)
+    assert not np.allclose(field[:12], expected[:12], atol=1e-3)
+
+
+def test_write_path_matches_in_memory(cluster, image_pair, affine_steps, tmp_path):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    temporary_directory = tmp_path / 'temporary'
+    temporary_directory.mkdir()
+    expected = distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, affine_steps, (24, 24, 24),
+        cluster=cluster,
+    )
+    written = distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, affine_steps, (24, 24, 24),
+        write_path=str(tmp_path / 'field.zarr'),
+        temporary_directory=str(temporary_directory),
+        cluster=cluster,
+    )
+    np.testing.assert_allclose(written[...], expected, atol=1e-5)
+    assert list(temporary_directory.iterdir()) == []
+
+
+def test_failed_blocks_raise_after_checkpoint(cluster, image_pair, tmp_path):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    temporary_directory = tmp_path / 'temporary'
+    temporary_directory.mkdir()
+    with pytest.raises(KeyError):
+        distributed_piecewise_alignment_pipeline(
+            fix, mov, spacing, spacing, [('not a step', {})], (24, 24, 24),
+            write_path=str(tmp_path / 'field.zarr'),
+            temporary_directory=str(temporary_directory),
+            cluster=cluster,
+        )
+    assert list(temporary_directory.iterdir()) == []
+
+    with pytest.raises(KeyError):
+        distributed_piecewise_alignment_pipeline(
+            fix, mov, spacing, spacing, [('not a step', {})], (24, 24, 24),
+            checkpoint_directory=str(tmp_path / 'checkpoint'),
+            cluster=cluster,
+        )
+    manifest = json.loads((tmp_path / 'checkpoint' / 'manifest.json').read_text())
+    assert manifest['completed'] == []
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_blocks_not_aligned_keep_initial_transform(cluster, image_pair, affine_steps, compact):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+
+    # a coarse initial field, only the first half of the blocks is aligned
+    shift = np.array([1., 0.5, 0.], dtype=np.float32)
+    initial_transform = np.broadcast_to(shift, (24, 24, 20, 3)).copy()
+    block_mask = np.zeros((2, 2, 2), dtype=bool)
+    block_mask[0] = True
+    field = distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, affine_steps, (24, 24, 20),
+        block_mask=block_mask, initial_transform=initial_transform,
+        compact=compact, cluster=cluster,
+    )
+    field = field[...]
+    assert field.shape == fix.shape + (3,)
+    np.testing.assert_allclose(field[36:], np.broadcast_to(shift, field[36:].shape), atol=1e-4)
+    np.testing.assert_allclose(field[:12], np.broadcast_to(shift, field[:12].shape), atol=0.2)
+
+
+def test_tile_reduction_with_partial_and_empty_tiles(cluster, image_pair, affine_steps, tmp_path):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+
+    # 20 voxel blocks leave partial tiles at the edges, the mask leaves
+    # tiles without any block contributions
+    fix_mask = np.zeros(fix.shape, dtype=np.uint8)
+    fix_mask[:20, :20] = 1
+    run = lambda **kwargs: distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, affine_steps, (20, 20, 20),
+        fix_mask=fix_mask, cluster=cluster, **kwargs,
+    )
+    reduced = run()
+    written = run(write_path=str(tmp_path / 'field.zarr'))
+    np.testing.assert_allclose(reduced, written[...], atol=1e-5)
+    assert np.any(reduced[:20, :20] != 0)
+    assert np.all(reduced[40:] == 0) and np.all(reduced[:, 40:] == 0)
+
+
+def test_block_telemetry_records(cluster, image_pair, affine_steps, tmp_path):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    timing_report = str(tmp_path / 'timing.jsonl')
+    before = len(cluster.client.get_events('bigstream-blocks'))
+    distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, affine_steps, (24, 24, 24),
+        timing_report=timing_report, cluster=cluster,
+    )
+
+    # one record per block, written to the report and to the event log
+    records = ut.read_records(timing_report)
+    assert sorted(tuple(x['block_index']) for x in records) == list(np.ndindex(2, 2, 2))
+    assert len(cluster.client.get_events('bigstream-blocks')) - before == 8
+    for record in records:
+        assert record['seconds'] >= record['read_seconds'] + record['align_seconds']
+        assert record['write_seconds'] >= 0
+        assert record['step0_affine_iterations'] == 3
+        assert record['step0_affine_final_metric'] <= record['step0_affine_initial_metric']
+        assert record['fallbacks'] == record['step0_affine_fallback']
+    summary = cluster.client.get_events('bigstream-summary')[-1][1]
+    assert summary['blocks'] == 8
+
+
+class _RecordingClient:
+    """Forwards to a dask client, recording blocks and priorities given to map"""
+
+    def __init__(self, client):
+        self.client, self.submitted = client, []
+
+    def map(self, func, *iterables, **kwargs):
+        if getattr(func, '__name__', None) == 'align_single_block':
+            priority = kwargs.get('priority')
+            self.submitted += [(x[0], priority) for x in iterables[0]]
+        return self.client.map(func, *iterables, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def test_cost_model_priorities(cluster, image_pair, affine_steps, tmp_path):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    recording = type('Cluster', (), {})()
+    recording.client = _RecordingClient(cluster.client)
+    run = lambda **kwargs: distributed_piecewise_alignment_pipeline(
+        fix, mov, spacing, spacing, affine_steps, (24, 24, 20),
+        priority_tiers=2, cluster=recording, **kwargs,
+    )
+
+    # foreground dense blocks go first, in the higher priority tier
+    fix_mask = np.zeros(fix.shape, dtype=np.uint8)
+    fix_mask[:24, :24] = 1
+    fix_mask[24:, 24:, :10] = 1
+    timing_report = str(tmp_path / 'timing.jsonl')
+    run(fix_mask=fix_mask, foreground_percentage=0.1, timing_report=timing_report)
+    order = [x[0] for x in recording.client.submitted]
+    assert set(order[:2]) == {(0, 0, 0), (0, 0, 1)} and order[2] == (1, 1, 0)
+    assert [x[1] for x in recording.client.submitted] == [2, 2, 1]
+
+    # measured seconds from a previous report overrule the foreground estimate
+    records = ut.read_records(timing_report)
+    for record in records:
+        record['seconds'] = 100. if tuple(record['block_index']) == (1, 1, 0) else 1.
+    ut.write_records(timing_report, records)
+    recording.client.submitted = []
+    run(fix_mask=fix_mask, foreground_percentage=0.1, cost_model=timing_report)
+    assert recording.client.submitted[0] == ((1, 1, 0), 2)
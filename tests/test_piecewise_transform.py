@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import zarr
+from scipy.ndimage import gaussian_filter
+import bigstream.transform as bs_transform
+from bigstream.transform import apply_transform, invert_displacement_vector_field
+from bigstream.piecewise_transform import (
+    distributed_apply_transform,
+    distributed_invert_displacement_vector_field,
+)
+
+
+def test_invert_skips_zero_blocks(cluster, tmp_path):
+    # a smooth displacement confined to one corner of the field
+    field = np.zeros((48, 48, 48, 3), dtype=np.float32)
+    field[4:12, 4:12, 4:12] = 2.
+    field = gaussian_filter(field, (2, 2, 2, 0))
+    field[16:, :, :] = 0
+    field[:, 16:, :] = 0
+    field[:, :, 16:] = 0
+    field_zarr = zarr.open(
+        str(tmp_path / 'field.zarr'), 'w',
+        shape=field.shape, chunks=(16, 16, 16, 3), dtype=field.dtype,
+    )
+    field_zarr[...] = field
+
+    write_path = str(tmp_path / 'inverse.zarr')
+    inverse = distributed_invert_displacement_vector_field(
+        field_zarr, np.ones(3), (16, 16, 16), write_path, cluster=cluster,
+    )
+    expected = invert_displacement_vector_field(field, np.ones(3))
+    np.testing.assert_allclose(inverse[...], expected, atol=1e-4)
+
+    # blocks far from the displacement are never written
+    assert os.path.exists(os.path.join(write_path, '0.0.0.0'))
+    assert not os.path.exists(os.path.join(write_path, '2.2.2.0'))
+
+
+def test_apply_transform_skips_background_blocks(cluster, tmp_path, monkeypatch):
+    # moving data only in the first corner block
+    mov = np.zeros((48, 48, 48), dtype=np.float32)
+    mov[:16, :16, :16] = gaussian_filter(
+        np.random.default_rng(0).random((16, 16, 16)), 1,
+    )
+    matrix = np.eye(4)
+    matrix[:3, -1] = (0.5, -1, 0)
+    expected = apply_transform(mov, mov, np.ones(3), np.ones(3), [matrix])
+
+    # count the blocks that are resampled, workers are threads of this process
+    calls = []
+    def counted(*args, **kwargs):
+        calls.append(1)
+        return apply_transform(*args, **kwargs)
+    monkeypatch.setattr(bs_transform, 'apply_transform', counted)
+
+    # a low resolution foreground mask
+    mask = np.zeros((6, 6, 6), dtype=bool)
+    mask[:2, :2, :2] = True
+    resampled = distributed_apply_transform(
+        mov, mov, np.ones(3), np.ones(3), [matrix], (16, 16, 16),
+        write_path=str(tmp_path / 'masked.zarr'),
+        mov_foreground_mask=mask, cluster=cluster,
+    )
+    np.testing.assert_allclose(resampled[...], expected, atol=1e-4)
+    assert 0 < len(calls) < 27
+
+    # chunk existence of a zarr moving image, empty chunks are never written
+    mov_zarr = zarr.open(
+        str(tmp_path / 'mov.zarr'), 'w', shape=mov.shape, chunks=(16, 16, 16),
+        dtype=mov.dtype, write_empty_chunks=False,
+    )
+    mov_zarr[...] = mov
+    calls.clear()
+    resampled = distributed_apply_transform(
+        mov, mov_zarr, np.ones(3), np.ones(3), [matrix], (16, 16, 16),
+        write_path=str(tmp_path / 'missing.zarr'),
+        skip_missing_chunks=True, cluster=cluster,
+    )
+    np.testing.assert_allclose(resampled[...], expected, atol=1e-4)
+    assert 0 < len(calls) < 27
+
+    # without either every block is resampled
+    calls.clear()
+    distributed_apply_transform(
+        mov, mov_zarr, np.ones(3), np.ones(3), [matrix], (16, 16, 16),
+        cluster=cluster,
+    )
+    assert len(calls) == 27
+
+
+def test_apply_transform_blocks_match_in_memory(cluster, image_pair, tmp_path, monkeypatch):
+    fix, mov = image_pair
+    spacing = np.ones(3)
+    field = np.zeros(fix.shape + (3,), dtype=np.float32)
+    field[..., 0] = gaussian_filter(np.random.default_rng(1).random(fix.shape), 4)
+    matrix = np.eye(4)
+    matrix[:3, -1] = (1, 0.5, 0)
+    expected = apply_transform(fix, mov, spacing, spacing, [matrix, field])
+
+    # in memory deformations and output, few blocks in flight at once
+    resampled = distributed_apply_transform(
+        fix, mov, spacing, spacing, [matrix, field], (24, 24, 20),
+        max_pending_blocks=2, cluster=cluster,
+    )
+    np.testing.assert_allclose(resampled, expected, atol=1e-4)
+
+    # an interrupted run resumes, only the missing chunk is recomputed
+    write_path = str(tmp_path / 'resampled.zarr')
+    run = lambda: distributed_apply_transform(
+        fix, mov, spacing, spacing, [matrix, field], (24, 24, 20),
+        write_path=write_path, resume=True, cluster=cluster,
+    )
+    run()
+    os.remove(os.path.join(write_path, '1.0.1'))
+    calls = []
+    def counted(*args, **kwargs):
+        calls.append(1)
+        return apply_transform(*args, **kwargs)
+    monkeypatch.setattr(bs_transform, 'apply_transform', counted)
+    np.testing.assert_allclose(run()[...], expected, atol=1e-4)
+    assert len(calls) == 1
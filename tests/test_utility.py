@@ -0,0 +1,139 @@
+import pickle
+import h5py
+import numpy as np
+import zarr
+from scipy.ndimage import gaussian_filter
+import SimpleITK as sitk
+from distributed import Client, LocalCluster
+import bigstream.utility as ut
+from bigstream.configure_irm import configure_irm
+from bigstream.transform import apply_transform
+
+
+def test_thread_budget_splits_cores_over_worker_threads(monkeypatch):
+    monkeypatch.setattr(ut, '_number_of_cores', 4)
+    assert ut.get_thread_budget() == 4
+    assert ut.get_thread_budget(3) == 3
+    with LocalCluster(
+        n_workers=1, threads_per_worker=2,
+        processes=False, dashboard_address=':0',
+    ) as cluster, Client(cluster) as client:
+        assert client.submit(ut.get_thread_budget).result() == 2
+
+
+def test_thread_overrides_leave_process_settings(monkeypatch):
+    # pretend this process already applied a budget of 3
+    previous = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(3)
+    monkeypatch.setattr(ut, '_thread_budget', 3)
+    try:
+        assert ut.set_thread_budget() == 3
+        irm = configure_irm(
+            metric='MS',
+            optimizer_args={'learningRate': 0.1, 'minStep': 0., 'numberOfIterations': 5},
+            threads=1,
+        )
+        assert irm.GetNumberOfThreads() == 1
+        image = np.random.default_rng(0).random((8, 8, 8)).astype(np.float32)
+        apply_transform(image, image, np.ones(3), np.ones(3), [np.eye(4)], threads=1)
+        assert sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() == 3
+    finally:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(previous)
+
+
+def test_plan_blocks_keeps_requested_blocksize(capsys):
+    blocksize, overlaps, chunks, _ = ut.plan_blocks(
+        (512, 4096, 4096), (128, 128, 128), 0.5, 2, chunks=(1, 2048, 2048),
+    )
+    assert tuple(blocksize) == (128, 128, 128)
+    assert tuple(overlaps) == (64, 64, 64)
+    assert chunks == (1, 2048, 2048)
+    output = capsys.readouterr().out
+    assert 'not a multiple of the native chunks' in output
+    assert 'BLOCK PLAN' not in output
+
+    # rounding is opt in
+    blocksize, _, _, _ = ut.plan_blocks((256,) * 3, (32,) * 3, 0.5, 2, chunks=(64,) * 3)
+    assert tuple(blocksize) == (32, 32, 32)
+    blocksize, _, _, _ = ut.plan_blocks(
+        (256,) * 3, (32,) * 3, 0.5, 2, chunks=(64,) * 3, round_to_chunks=True,
+    )
+    assert tuple(blocksize) == (64, 64, 64)
+
+
+def test_plan_blocks_chooses_divisor_chunks(capsys):
+    blocksize, overlaps, chunks, read_bytes = ut.plan_blocks(
+        (200, 200, 200), (64, 64, 64), 0.25, 4, verbose=True,
+    )
+    assert all(64 % c == 0 and c >= 32 for c in chunks)
+    assert read_bytes >= np.prod(blocksize) * 4
+    assert 'BLOCK PLAN' in capsys.readouterr().out
+
+
+def test_shared_array_reads_inputs_in_place(tmp_path):
+    data = np.random.default_rng(0).random((12, 10, 8)).astype(np.float32)
+    def no_copy():
+        raise AssertionError('a copy was made')
+
+    # zarr arrays are passed through
+    z = zarr.open(str(tmp_path / 'data.zarr'), 'w', shape=data.shape, chunks=(4, 4, 4), dtype=data.dtype)
+    z[...] = data
+    assert ut.shared_array(z, (4, 4, 4), no_copy) is z
+
+    # hdf5 datasets and memmap views become small picklable references
+    with h5py.File(tmp_path / 'data.h5', 'w') as f:
+        f.create_dataset('image', data=data)
+    mm = np.memmap(tmp_path / 'data.raw', dtype=data.dtype, mode='w+', shape=data.shape)
+    mm[...] = data
+    mm.flush()
+    with h5py.File(tmp_path / 'data.h5', 'r') as f:
+        for array, expected in ((f['image'], data), (mm[3:7], data[3:7])):
+            shared = ut.shared_array(array, (4, 4, 4), no_copy)
+            assert len(pickle.dumps(shared)) < 1000
+            shared = pickle.loads(pickle.dumps(shared))
+            assert shared.shape == expected.shape
+            np.testing.assert_array_equal(shared[1:3, :, 2:], expected[1:3, :, 2:])
+
+    # in memory arrays are copied once, reuse returns the copy
+    path = str(tmp_path / 'copy.zarr')
+    copy = ut.shared_array(data, (4, 4, 4), path)
+    np.testing.assert_array_equal(copy[...], data)
+    assert ut.shared_array(data, (4, 4, 4), path, reuse=True).chunks == copy.chunks
+    assert ut.shared_array(np.zeros_like(data), (4, 4, 4), path, reuse=True)[0, 0, 0] == data[0, 0, 0]
+
+
+def test_block_foreground_fractions_match_a_loop(tmp_path):
+    shape, blocksize = (100, 90, 70), np.array((32, 32, 32))
+    nblocks = np.ceil(np.array(shape) / blocksize).astype(int)
+    rng = np.random.default_rng(0)
+
+    # full resolution, half resolution, and a zarr mask
+    full = rng.random(shape) > 0.7
+    half = rng.random((50, 45, 35)) > 0.3
+    half_zarr = zarr.open(str(tmp_path / 'mask.zarr'), 'w', shape=half.shape, chunks=(16, 16, 16), dtype=bool)
+    half_zarr[...] = half
+    for mask, expected_mask in ((full, full), (half, half), (half_zarr, half)):
+        ratio = np.array(mask.shape) / shape
+        expected = np.zeros(nblocks)
+        for index in np.ndindex(*nblocks):
+            start = np.round(ratio * blocksize * index).astype(int)
+            stop = np.minimum(mask.shape, np.round(ratio * blocksize * (np.array(index) + 1)).astype(int))
+            expected[index] = np.mean(expected_mask[tuple(slice(a, b) for a, b in zip(start, stop))])
+        fractions = ut.block_foreground_fractions(mask, shape, blocksize)
+        np.testing.assert_allclose(fractions, expected)
+
+
+def test_pyramid_cache_builds_each_level_once():
+    image = np.random.default_rng(0).random((40, 36, 30)).astype(np.float32)
+    spacing = np.array([2., 1., 1.])
+    cache = ut.PyramidCache()
+    level, level_spacing = cache.level(image, spacing, shrink_factor=2, smooth_sigma=2.)
+    expected = gaussian_filter(image, 2. / spacing, mode='nearest')[::2, ::2, ::2]
+    np.testing.assert_allclose(level, expected, atol=1e-6)
+    np.testing.assert_array_equal(level_spacing, spacing * 2)
+
+    # the same request is a cache hit, other levels and images are not
+    assert cache.level(image, spacing, shrink_factor=2, smooth_sigma=2.)[0] is level
+    assert cache.level(image, spacing)[0] is not level
+    assert cache.level(image.copy(), spacing, shrink_factor=2, smooth_sigma=2.)[0] is not level
+    assert len(cache.levels) == 3